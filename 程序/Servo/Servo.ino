@@ -28,6 +28,15 @@ Adafruit_PWMServoDriver pwm = Adafruit_PWMServoDriver(PCA9685_ADDRESS);
 
 #define SERVO_FREQ 50    // 舵机频率 50Hz
 #define SERVO_PROTECTION_TIMEOUT 5000  // 舵机保护超时时间 (5秒)
+#define SEGMENT_TICK_MS 20      // 分段插值更新周期，与PWM周期一致
+#define MAX_SEGMENT_MS 65535    // 分段插值最长时长
+#define SCHEDULE_SIZE 16        // 定时执行命令队列长度
+
+// 分段插值缓动曲线（与上位机 servo_protocol.EASINGS 一致）
+#define EASE_LINEAR 0
+#define EASE_IN_OUT 1
+#define EASE_IN     2
+#define EASE_OUT    3
 
 // 存储每个舵机的当前角度
 int servoAngles[16] = {90, 90, 90, 90, 90, 90, 90, 90, 
@@ -45,6 +54,31 @@ unsigned long servoLastMoveTime[16] = {0};  // 每个舵机最后一次移动的
 bool servoProtectionActive[16] = {false};    // 每个舵机的保护状态
 int servoHoldPosition[16] = {90};            // 每个舵机的保持位置
 
+// 分段插值：servoAngles 为目标角度，servoCurrent 为插值过程中实际输出的角度
+struct Segment {
+  bool active;
+  unsigned long startTime;
+  unsigned long duration;
+  int easing;
+  int fromAngle;
+  int toAngle;
+};
+Segment servoSegments[16];
+int servoCurrent[16] = {90, 90, 90, 90, 90, 90, 90, 90,
+                        90, 90, 90, 90, 90, 90, 90, 90};
+unsigned long lastSegmentUpdate = 0;
+
+// 定时执行队列：@<ms>:<命令> 在 millis() 到达 ms 时执行
+struct ScheduledCommand {
+  bool used;
+  unsigned long at;
+  unsigned long seq;
+  String command;
+};
+ScheduledCommand scheduledCommands[SCHEDULE_SIZE];
+unsigned long scheduleSeq = 0;
+unsigned long commandReceivedAt = 0;  // 当前命令行读入时的 millis()，用于对时
+
 // 调试模式
 bool debugMode = true;
 
@@ -219,9 +253,16 @@ void loop() {
   // 检查舵机保护状态
   checkServoProtection();
   
+  // 执行到期的定时命令
+  runScheduledCommands();
+  
+  // 推进分段插值
+  updateSegments();
+  
   if (Serial.available() > 0) {
     // 读取完整的一行
     String command = Serial.readStringUntil('\n');
+    commandReceivedAt = millis();
     
     // 清理命令
     command.trim();
@@ -237,40 +278,149 @@ void loop() {
       Serial.println("'");
     }
     
-    if (command.startsWith("S")) {
-      // 检查是否包含分号，表示批量命令
-      if (command.indexOf(';') != -1) {
-        parseAndExecuteBatchCommand(command);
-      } else {
-        parseAndExecuteCommand(command);
-      }
-    }
-    else if (command == "STATUS") {
-      reportStatus();
-    }
-    else if (command == "DEBUG") {
-      debugMode = !debugMode;
-      Serial.print("DEBUG:Debug mode ");
-      Serial.println(debugMode ? "ON" : "OFF");
+    executeCommand(command);
+  }
+}
+
+// 执行一行命令（串口收到的命令和到期的定时命令）
+void executeCommand(String command) {
+  // STATUS 也以 S 开头，必须先于舵机命令判断
+  if (command == "STATUS") {
+    reportStatus();
+  }
+  else if (command.startsWith("S")) {
+    // 检查是否包含分号，表示批量命令
+    if (command.indexOf(';') != -1) {
+      parseAndExecuteBatchCommand(command);
+    } else {
+      parseAndExecuteCommand(command);
     }
-    else if (command == "HELP") {
-      printHelp();
+  }
+  else if (command == "DEBUG") {
+    debugMode = !debugMode;
+    Serial.print("DEBUG:Debug mode ");
+    Serial.println(debugMode ? "ON" : "OFF");
+  }
+  else if (command == "HELP") {
+    printHelp();
+  }
+  else if (command == "RESET") {
+    resetAllServos();
+  }
+  else if (command == "CAPS") {
+    reportCapabilities();
+  }
+  else if (command.startsWith("JS")) {
+    // 解析并执行下颚同步命令 (格式: JS<angle>)
+    // 同时控制舵机0和1，实现真正的同步停止
+    String angleStr = command.substring(2);
+    angleStr.trim();
+    int angle = angleStr.toInt();
+    setJawServosSync(angle);
+  }
+  else if (command.startsWith("M")) {
+    parseAndExecuteSegmentCommand(command);
+  }
+  else if (command.startsWith("T")) {
+    // 对时 (格式: T<seq>)，应答收到该行和发出应答时的 millis()
+    Serial.print("TIME:");
+    Serial.print(command.substring(1));
+    Serial.print(",");
+    Serial.print(commandReceivedAt);
+    Serial.print(",");
+    Serial.println(millis());
+  }
+  else if (command.startsWith("@")) {
+    scheduleCommand(command);
+  }
+  else {
+    Serial.print("ERROR:Unknown command: ");
+    Serial.println(command);
+  }
+}
+
+// 定时执行命令 (格式: @<ms>:<命令>)，ms 为本机 millis()，已经过了的立即执行
+// 命令执行时才输出它的 OK 应答；无法排队时立即应答 ERROR:@<ms> <原因>
+void scheduleCommand(String command) {
+  int colonIndex = command.indexOf(':');
+  String atStr = colonIndex > 1 ? command.substring(1, colonIndex) : "";
+  String inner = colonIndex > 1 ? command.substring(colonIndex + 1) : "";
+  atStr.trim();
+  inner.trim();
+  
+  bool valid = atStr.length() > 0 && atStr.length() <= 10 && inner.length() > 0 && !inner.startsWith("@");
+  for (int i = 0; valid && i < atStr.length(); i++) {
+    valid = isDigit(atStr[i]);
+  }
+  if (!valid) {
+    Serial.print("ERROR:");
+    Serial.print(colonIndex > 0 ? command.substring(0, colonIndex) : command);
+    Serial.println(" Invalid schedule");
+    return;
+  }
+  
+  // toInt() 是有符号32位，millis() 的后半段会溢出
+  unsigned long at = strtoul(atStr.c_str(), NULL, 10);
+  long remaining = (long)(at - millis());
+  if (remaining <= 0) {
+    if (debugMode) {
+      Serial.print("DEBUG:Late schedule ");
+      Serial.print(-remaining);
+      Serial.println("ms");
     }
-    else if (command == "RESET") {
-      resetAllServos();
+    executeCommand(inner);
+    return;
+  }
+  
+  for (int i = 0; i < SCHEDULE_SIZE; i++) {
+    if (!scheduledCommands[i].used) {
+      scheduledCommands[i].used = true;
+      scheduledCommands[i].at = at;
+      scheduledCommands[i].seq = scheduleSeq++;
+      scheduledCommands[i].command = inner;
+      if (debugMode) {
+        Serial.print("DEBUG:Scheduled at ");
+        Serial.print(at);
+        Serial.print(" in ");
+        Serial.print(remaining);
+        Serial.println("ms");
+      }
+      return;
     }
-    else if (command.startsWith("JS")) {
-      // 解析并执行下颚同步命令 (格式: JS<angle>)
-      // 同时控制舵机0和1，实现真正的同步停止
-      String angleStr = command.substring(2);
-      angleStr.trim();
-      int angle = angleStr.toInt();
-      setJawServosSync(angle);
+  }
+  
+  Serial.print("ERROR:@");
+  Serial.print(at);
+  Serial.println(" Schedule queue full");
+}
+
+// 按执行时刻（相同时按收到顺序）执行所有到期的定时命令
+void runScheduledCommands() {
+  while (true) {
+    unsigned long currentTime = millis();
+    int next = -1;
+    for (int i = 0; i < SCHEDULE_SIZE; i++) {
+      ScheduledCommand &entry = scheduledCommands[i];
+      if (!entry.used || (long)(currentTime - entry.at) < 0) {
+        continue;
+      }
+      if (next < 0) {
+        next = i;
+        continue;
+      }
+      long diff = (long)(entry.at - scheduledCommands[next].at);
+      if (diff < 0 || (diff == 0 && (long)(entry.seq - scheduledCommands[next].seq) < 0)) {
+        next = i;
+      }
     }
-    else {
-      Serial.print("ERROR:Unknown command: ");
-      Serial.println(command);
+    if (next < 0) {
+      return;
     }
+    
+    String command = scheduledCommands[next].command;
+    scheduledCommands[next].used = false;
+    scheduledCommands[next].command = "";
+    executeCommand(command);
   }
 }
 
@@ -398,9 +548,11 @@ void setServoAngle(int channel, int angle) {
   // 限制角度范围
   angle = constrain(angle, 0, 180);
   
-  // 保存角度
+  // 保存角度，取消该通道正在进行的分段插值
   servoAngles[channel] = angle;
   servoHoldPosition[channel] = angle;
+  servoCurrent[channel] = angle;
+  servoSegments[channel].active = false;
   
   // 根据舵机类型选择不同的脉冲范围
   int pulse;
@@ -475,9 +627,13 @@ void setJawServosSync(int angle) {
   int servo0_angle = angle;
   int servo1_angle = 180 - angle;
   
-  // 更新内部角度记录
+  // 更新内部角度记录，取消正在进行的分段插值
   servoAngles[0] = servo0_angle;
   servoAngles[1] = servo1_angle;
+  servoCurrent[0] = servo0_angle;
+  servoCurrent[1] = servo1_angle;
+  servoSegments[0].active = false;
+  servoSegments[1].active = false;
   
   // 计算两个舵机的脉冲值
   int pulse0, pulse1;
@@ -542,6 +698,190 @@ void setJawServosSync(int angle) {
   if (debugMode) {
     Serial.println("DEBUG:Jaw servos synced successfully");
   }
+  
+  // 应答，上位机据此释放发送窗口
+  Serial.print("OK:JS");
+  Serial.println(angle);
+}
+
+// 解析并执行分段插值命令 (格式: M<ms>,<easing>:<ch>,<angle>;<ch>,<angle>;...)
+// 各舵机从当前角度在 ms 毫秒内按缓动曲线转到目标，由 updateSegments 每个PWM周期更新
+void parseAndExecuteSegmentCommand(String command) {
+  int colonIndex = command.indexOf(':');
+  if (colonIndex < 0) {
+    Serial.println("ERROR:Invalid segment format");
+    return;
+  }
+  
+  String header = command.substring(1, colonIndex);
+  String body = command.substring(colonIndex + 1);
+  String durationStr = header;
+  String easingStr = "1";
+  int commaIndex = header.indexOf(',');
+  if (commaIndex >= 0) {
+    durationStr = header.substring(0, commaIndex);
+    easingStr = header.substring(commaIndex + 1);
+  }
+  durationStr.trim();
+  easingStr.trim();
+  if (easingStr.length() == 0) {
+    easingStr = "1";
+  }
+  
+  // 检查是否为有效数字
+  if (durationStr.length() == 0) {
+    Serial.println("ERROR:Invalid segment format");
+    return;
+  }
+  for (int i = 0; i < durationStr.length(); i++) {
+    if (!isDigit(durationStr[i])) {
+      Serial.println("ERROR:Invalid segment format");
+      return;
+    }
+  }
+  for (int i = 0; i < easingStr.length(); i++) {
+    if (!isDigit(easingStr[i])) {
+      Serial.println("ERROR:Invalid segment format");
+      return;
+    }
+  }
+  
+  long duration = durationStr.toInt();
+  int easing = easingStr.toInt();
+  if (durationStr.length() > 5 || duration > MAX_SEGMENT_MS || easing > EASE_OUT) {
+    Serial.println("ERROR:Invalid segment header");
+    return;
+  }
+  
+  if (debugMode) {
+    Serial.print("DEBUG:Segment ");
+    Serial.print(duration);
+    Serial.print("ms easing=");
+    Serial.println(easing);
+  }
+  
+  // 逐个处理目标，格式与批量命令相同
+  while (body.length() > 0) {
+    int semicolonIndex = body.indexOf(';');
+    String part = semicolonIndex >= 0 ? body.substring(0, semicolonIndex) : body;
+    body = semicolonIndex >= 0 ? body.substring(semicolonIndex + 1) : "";
+    if (part.length() == 0) {
+      continue;
+    }
+    
+    int partComma = part.indexOf(',');
+    String channelStr = partComma >= 0 ? part.substring(0, partComma) : part;
+    String angleStr = partComma >= 0 ? part.substring(partComma + 1) : "";
+    channelStr.trim();
+    angleStr.trim();
+    
+    bool valid = channelStr.length() > 0 && angleStr.length() > 0;
+    for (int i = 0; valid && i < channelStr.length(); i++) {
+      valid = isDigit(channelStr[i]);
+    }
+    for (int i = 0; valid && i < angleStr.length(); i++) {
+      valid = isDigit(angleStr[i]);
+    }
+    if (!valid) {
+      Serial.println("ERROR:Invalid segment target");
+      continue;
+    }
+    
+    int channel = channelStr.toInt();
+    int angle = angleStr.toInt();
+    if (channel < 0 || channel >= 16 || angle < 0 || angle > 180) {
+      Serial.print("ERROR:Invalid range - channel=");
+      Serial.print(channel);
+      Serial.print(", angle=");
+      Serial.println(angle);
+      continue;
+    }
+    
+    startSegment(channel, angle, duration, easing);
+    Serial.print("OK:M");
+    Serial.print(channel);
+    Serial.print(",");
+    Serial.println(angle);
+  }
+}
+
+// 开始一个舵机的分段插值，起点为当前实际角度（可能正在插值中）
+void startSegment(int channel, int angle, unsigned long duration, int easing) {
+  if (duration == 0) {
+    setServoAngle(channel, angle);
+    return;
+  }
+  
+  servoSegments[channel].active = true;
+  servoSegments[channel].startTime = millis();
+  servoSegments[channel].duration = duration;
+  servoSegments[channel].easing = easing;
+  servoSegments[channel].fromAngle = servoCurrent[channel];
+  servoSegments[channel].toAngle = angle;
+  servoAngles[channel] = angle;
+  servoHoldPosition[channel] = angle;
+}
+
+// 缓动曲线：t 为 0~1 的时间进度，返回 0~1 的位置进度
+float easeProgress(int easing, float t) {
+  t = constrain(t, 0.0, 1.0);
+  switch (easing) {
+    case EASE_LINEAR:
+      return t;
+    case EASE_IN:
+      return t * t;
+    case EASE_OUT:
+      return t * (2.0 - t);
+    default:
+      return t * t * (3.0 - 2.0 * t);
+  }
+}
+
+// 每个PWM周期推进一次分段插值，只在角度变化时写 PCA9685
+void updateSegments() {
+  unsigned long currentTime = millis();
+  if (currentTime - lastSegmentUpdate < SEGMENT_TICK_MS) {
+    return;
+  }
+  lastSegmentUpdate = currentTime;
+  
+  for (int channel = 0; channel < 16; channel++) {
+    Segment &segment = servoSegments[channel];
+    if (!segment.active) {
+      continue;
+    }
+    
+    unsigned long elapsed = currentTime - segment.startTime;
+    int angle;
+    if (elapsed >= segment.duration) {
+      angle = segment.toAngle;
+      segment.active = false;
+    } else {
+      float progress = easeProgress(segment.easing, (float)elapsed / segment.duration);
+      angle = segment.fromAngle + (int)round((segment.toAngle - segment.fromAngle) * progress);
+    }
+    
+    if (angle != servoCurrent[channel] || !segment.active) {
+      writeServoPulse(channel, angle);
+    }
+  }
+}
+
+// 输出插值过程中的角度（不改变目标角度）
+void writeServoPulse(int channel, int angle) {
+  servoCurrent[channel] = angle;
+  
+  int pulse;
+  if (servoTypes[channel] == 0) {
+    pulse = map(angle, 0, 180, MG996R_MIN, MG996R_MAX);
+  } else {
+    pulse = map(angle, 0, 180, MG90S_MIN, MG90S_MAX);
+  }
+  pwm.setPWM(channel, 0, pulse);
+  
+  // 插值期间保持供电，结束后按最后一次移动时间计算保护超时
+  servoLastMoveTime[channel] = millis();
+  servoProtectionActive[channel] = false;
 }
 
 // 报告所有舵机状态
@@ -557,14 +897,26 @@ void reportStatus() {
   Serial.println();
 }
 
+// 报告固件支持的协议功能，供上位机连接时协商
+// 格式: CAPS:version=1,batch=1,js=1,js_ack=1,binary=0,status=1,segment=1,schedule=1,debug=1,baud=115200
+void reportCapabilities() {
+  Serial.print("CAPS:version=1,batch=1,js=1,js_ack=1,binary=0,status=1,segment=1,schedule=1,debug=");
+  Serial.print(debugMode ? 1 : 0);
+  Serial.println(",baud=115200");
+}
+
 // 打印帮助信息
 void printHelp() {
   Serial.println("=== ESP32-S3 Servo Controller Commands ===");
   Serial.println("S<ch>,<angle> - Set servo channel (0-15) to angle (0-180)");
   Serial.println("JS<angle> - Synchronously control jaw servos 0 and 1 (reverse motion)");
+  Serial.println("M<ms>,<easing>:<ch>,<angle>;... - Move servos over ms with easing (0=linear,1=in-out,2=in,3=out)");
+  Serial.println("T<seq> - Report device clock (TIME:<seq>,<received ms>,<reply ms>)");
+  Serial.println("@<ms>:<command> - Execute command when device millis() reaches ms");
   Serial.println("STATUS - Get current status of all servos");
   Serial.println("DEBUG - Toggle debug mode");
   Serial.println("RESET - Reset all servos to 90 degrees");
+  Serial.println("CAPS - Report supported protocol features");
   Serial.println("HELP - Show this help message");
   Serial.println("==========================================");
 }
@@ -1,16 +1,28 @@
+import time
+
+# 启动计时从这里开始，main() 报告的启动用时包括模块导入
+STARTUP_TIME = time.perf_counter()
+
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, filedialog
-import serial
-import serial.tools.list_ports
 import threading
-import time
+import argparse
 import json
 import os
 import re
+import contextlib
 from datetime import datetime
 
+import servo_pose
+import servo_caps
+import servo_trajectory
+from servo_script import AUTO_DELAY_WORDS
+from servo_metrics import TransportMetrics
+from ui_queue import UiUpdateQueue
+# 串口、传输层、仲裁、录制、脚本执行和文件监视模块在第一次使用时才导入，不计入启动时间
+
 class ServoControlGUI:
-    def __init__(self, root):
+    def __init__(self, root, metrics_file=None, refresh_caps=False):
         self.root = root
         self.root.title("仿生人头控制系统 - 增强版")
         
@@ -42,13 +54,53 @@ class ServoControlGUI:
         # 保存初始安全边际
         self.jaw_safety_margin = 2
         
+        # 为 True 时连接时忽略能力缓存重新探测（--refresh）
+        self.refresh_caps = refresh_caps
+        
+        # 命令传输层与统计（连接后创建传输层）
+        self.transport = None
+        # 脚本/归零/滑条之间按舵机组所有权仲裁（连接后创建）
+        self.arbiter = None
+        self.metrics = TransportMetrics()
+        # Prometheus文本文件导出默认关闭，由 --metrics-file 或配置项 metrics_file 开启
+        metrics_file = metrics_file or self.servo_config.get('metrics_file')
+        self.metrics_file = os.path.join(base_dir, metrics_file) if metrics_file else None
+        self._metrics_error = None
+        
+        # 滑条动作录制与回放（第一次录制时创建录制器）
+        self.recorder = None
+        self.replay_stop = threading.Event()
+        
+        # 滑条目标按每个舵机的速度/加速度限制逐周期发送
+        self.motion = servo_trajectory.MotionLimiter(self.servo_config)
+        self.motion_after_id = None
+        
+        # 校准面板（最小/最大/中间值输入框）在第一次打开时才创建
+        self._calibration_panels = []
+        self._calibration_widgets = None
+        self.calibration_visible = False
+        self._port_scan = None
+        
         # 创建界面
         self.create_widgets()
         
+        # 后台线程的界面更新经队列合并后由主循环执行
+        self.ui_queue = UiUpdateQueue(self.root).start()
+        
+        # 配置文件或表情脚本目录中已加载的脚本被外部修改时自动重新加载，不需要重启和重新连接
+        self.loaded_script_path = None
+        self._loaded_script_text = None
+        # 窗口显示后再启动监视线程
+        self.watcher = None
+        self.root.after(200, self.start_file_watcher)
+        
         # 根据加载的配置更新所有滑条范围
         self.update_servo_scales()
         
-        # 自动刷新串口列表
+        # 先显示上次使用的串口，串口枚举在后台进行（Windows/树莓派上可能需要数秒）
+        saved_port = self.servo_config.get('saved_port', '')
+        if saved_port:
+            self.port_var.set(saved_port)
         self.refresh_ports()
         
         # 添加窗口关闭事件处理
@@ -56,6 +108,7 @@ class ServoControlGUI:
         self.jaw_send_after_id = None
         self._pending_jaw_angle = None
         self.batch_supported = None
+        self.device_caps = {}
         self.suppress_send = False
         self.jaw_safety_margin = 2
         
@@ -146,35 +199,11 @@ class ServoControlGUI:
         self.jaw_label = ttk.Label(jaw_frame, text=f"{jaw_mid_angle}°", width=4, font=("Arial", 11))
         self.jaw_label.grid(row=1, column=4, padx=5)
         
-        # 最小角度配置
-        ttk.Label(jaw_frame, text="最小角度:", font=("Arial", 11)).grid(row=2, column=0, sticky=tk.W)
+        # 最小角度/最大角度/中间值配置（输入框在打开校准面板时创建）
         jaw_init_var = tk.StringVar(value=str(self.servo_config.get('servo_0_min', self.servo_config.get('servo_0_init', 90))))
-        jaw_init_entry = ttk.Entry(jaw_frame, textvariable=jaw_init_var, width=6, font=("Arial", 11))
-        jaw_init_entry.grid(row=2, column=1, padx=2)
-        
-        jaw_init_btn = ttk.Button(jaw_frame, text="执行", width=5,
-                                command=lambda: self.set_servo_min(0))
-        jaw_init_btn.grid(row=2, column=2, padx=2)
-        
-        # 最大角度配置
-        ttk.Label(jaw_frame, text="最大角度:", font=("Arial", 11)).grid(row=3, column=0, sticky=tk.W)
         jaw_end_var = tk.StringVar(value=str(self.servo_config.get('servo_0_max', self.servo_config.get('servo_0_end', 90))))
-        jaw_end_entry = ttk.Entry(jaw_frame, textvariable=jaw_end_var, width=6, font=("Arial", 11))
-        jaw_end_entry.grid(row=3, column=1, padx=2)
-        
-        jaw_end_btn = ttk.Button(jaw_frame, text="执行", width=5,
-                               command=lambda: self.set_servo_max(0))
-        jaw_end_btn.grid(row=3, column=2, padx=2)
-        
-        # 中间值配置
-        ttk.Label(jaw_frame, text="中间值:", font=("Arial", 11)).grid(row=4, column=0, sticky=tk.W)
         jaw_mid_var = tk.StringVar(value=str(self.servo_config.get('servo_0_mid', 90)))
-        jaw_mid_entry = ttk.Entry(jaw_frame, textvariable=jaw_mid_var, width=6, font=("Arial", 11))
-        jaw_mid_entry.grid(row=4, column=1, padx=2)
-        
-        jaw_mid_btn = ttk.Button(jaw_frame, text="执行", width=5,
-                               command=lambda: self.set_servo_mid(0))
-        jaw_mid_btn.grid(row=4, column=2, padx=2)
+        self._calibration_panels.append((jaw_frame, 0, (jaw_init_var, jaw_end_var, jaw_mid_var), 11, 5))
         
         # 添加下颚舵机控件
         self.servo_controls.append({
@@ -218,35 +247,11 @@ class ServoControlGUI:
             angle_label = ttk.Label(frame, text=f"{mid_angle}°", width=4, font=("Arial", 10))
             angle_label.grid(row=1, column=4, padx=5)
             
-            # 最小角度配置
-            ttk.Label(frame, text="最小角度:", font=("Arial", 10)).grid(row=2, column=0, sticky=tk.W)
+            # 最小角度/最大角度/中间值配置（输入框在打开校准面板时创建）
             min_var = tk.StringVar(value=str(self.servo_config.get(f'servo_{i}_min', self.servo_config.get(f'servo_{i}_init', 90))))
-            min_entry = ttk.Entry(frame, textvariable=min_var, width=6, font=("Arial", 10))
-            min_entry.grid(row=2, column=1, padx=2)
-            
-            init_btn = ttk.Button(frame, text="执行", width=4,
-                                command=lambda idx=i: self.set_servo_min(idx))
-            init_btn.grid(row=2, column=2, padx=2)
-            
-            # 最大角度配置
-            ttk.Label(frame, text="最大角度:", font=("Arial", 10)).grid(row=3, column=0, sticky=tk.W)
             max_var = tk.StringVar(value=str(self.servo_config.get(f'servo_{i}_max', self.servo_config.get(f'servo_{i}_end', 90))))
-            max_entry = ttk.Entry(frame, textvariable=max_var, width=6, font=("Arial", 10))
-            max_entry.grid(row=3, column=1, padx=2)
-            
-            end_btn = ttk.Button(frame, text="执行", width=4,
-                               command=lambda idx=i: self.set_servo_max(idx))
-            end_btn.grid(row=3, column=2, padx=2)
-            
-            # 中间值配置
-            ttk.Label(frame, text="中间值:", font=("Arial", 10)).grid(row=4, column=0, sticky=tk.W)
             mid_var = tk.StringVar(value=str(self.servo_config.get(f'servo_{i}_mid', 90)))
-            mid_entry = ttk.Entry(frame, textvariable=mid_var, width=6, font=("Arial", 10))
-            mid_entry.grid(row=4, column=1, padx=2)
-            
-            mid_btn = ttk.Button(frame, text="执行", width=4,
-                               command=lambda idx=i: self.set_servo_mid(idx))
-            mid_btn.grid(row=4, column=2, padx=2)
+            self._calibration_panels.append((frame, i, (min_var, max_var, mid_var), 10, 4))
             
             self.servo_controls.append({
                 'var': angle_var,
@@ -291,6 +296,9 @@ class ServoControlGUI:
         single_servo_entry.grid(row=0, column=1, padx=5, pady=2)
         ttk.Button(single_config_frame, text="确定", 
                   command=self.configure_single_servo, width=8).grid(row=0, column=2, padx=5, pady=2)
+        self.calibration_btn = ttk.Button(single_config_frame, text="📐 校准面板",
+                                          command=self.toggle_calibration, width=12)
+        self.calibration_btn.grid(row=0, column=3, padx=5, pady=2)
         
 
         
@@ -318,6 +326,9 @@ class ServoControlGUI:
         ttk.Button(left_script_btns, text="运行脚本", command=self.run_script, width=10).pack(side=tk.LEFT, padx=4)
         ttk.Button(left_script_btns, text="停止", command=self.stop_script, width=8).pack(side=tk.LEFT, padx=4)
         ttk.Button(left_script_btns, text="保存脚本", command=self.save_script, width=10).pack(side=tk.LEFT, padx=4)
+        self.record_btn = ttk.Button(left_script_btns, text="录制动作", command=self.toggle_recording, width=10)
+        self.record_btn.pack(side=tk.LEFT, padx=4)
+        ttk.Button(left_script_btns, text="回放录制", command=self.replay_recording, width=10).pack(side=tk.LEFT, padx=4)
         
         # 右侧脚本控制按钮
         right_script_btns = ttk.Frame(script_btn_frame)
@@ -335,7 +346,7 @@ class ServoControlGUI:
         self.script_name_entry.pack(side=tk.LEFT, padx=5)
         
         # 脚本文本框
-        ttk.Label(script_frame, text="脚本内容 (命令格式: '舵机X 角度' 或 '延时 毫秒数'):", font=("Arial", 11)).grid(row=1, column=0, sticky=tk.W)
+        ttk.Label(script_frame, text="脚本内容 (命令格式: '舵机X 角度' 或 '延时 毫秒数/自动'):", font=("Arial", 11)).grid(row=1, column=0, sticky=tk.W)
         
         # 创建带行号的文本框框架
         script_text_frame = ttk.Frame(script_frame)
@@ -356,6 +367,7 @@ class ServoControlGUI:
         
         # 初始更新行号
         self.root.after(100, self.update_line_numbers)
+        self.root.after(500, self.update_metrics_status)
         
         # 日志输出
         log_frame = ttk.LabelFrame(main_frame, text="日志输出", padding="10")
@@ -371,6 +383,10 @@ class ServoControlGUI:
         self.log_text = scrolledtext.ScrolledText(log_frame, height=8, font=("Arial", 11))
         self.log_text.pack(fill=tk.BOTH, expand=True)
         
+        # 状态栏：命令延迟与吞吐量统计
+        self.metrics_label = ttk.Label(main_frame, text="未连接", font=("Arial", 10), anchor=tk.W)
+        self.metrics_label.grid(row=4, column=0, columnspan=2, sticky=(tk.W, tk.E))
+        
         # 加载上次的脚本
         self.load_last_script()
         
@@ -382,7 +398,7 @@ class ServoControlGUI:
         """插入示例脚本"""
         example = """# 示例脚本 - 以#开头的行为注释
 # 命令格式: 舵机X 角度 或 延时 毫秒数
-# 延时单位为毫秒(ms), 1000ms = 1秒
+# 延时单位为毫秒(ms), 1000ms = 1秒；延时 自动 表示等待全部舵机转到位
 
 # 舵机测试序列
 舵机0 0
@@ -586,10 +602,66 @@ class ServoControlGUI:
         
         self.line_numbers.config(state=tk.DISABLED)
         
+    def toggle_calibration(self):
+        """显示/隐藏各舵机的最小角度、最大角度和中间值配置"""
+        self.show_calibration(not self.calibration_visible)
+        
+    def show_calibration(self, visible=True):
+        if visible and self._calibration_widgets is None:
+            self._calibration_widgets = []
+            for frame, servo_id, variables, font_size, btn_width in self._calibration_panels:
+                self._calibration_widgets.extend(
+                    self._build_calibration_panel(frame, servo_id, variables, font_size, btn_width))
+        elif self._calibration_widgets is not None:
+            for widget in self._calibration_widgets:
+                if visible:
+                    widget.grid()
+                else:
+                    widget.grid_remove()
+        self.calibration_visible = visible
+        
+    def _build_calibration_panel(self, frame, servo_id, variables, font_size, btn_width):
+        widgets = []
+        rows = (("最小角度:", self.set_servo_min), ("最大角度:", self.set_servo_max), ("中间值:", self.set_servo_mid))
+        for row, ((text, command), var) in enumerate(zip(rows, variables), 2):
+            label = ttk.Label(frame, text=text, font=("Arial", font_size))
+            label.grid(row=row, column=0, sticky=tk.W)
+            entry = ttk.Entry(frame, textvariable=var, width=6, font=("Arial", font_size))
+            entry.grid(row=row, column=1, padx=2)
+            button = ttk.Button(frame, text="执行", width=btn_width,
+                                command=lambda c=command: c(servo_id))
+            button.grid(row=row, column=2, padx=2)
+            widgets.extend((label, entry, button))
+        return widgets
+        
     def refresh_ports(self):
-        """刷新可用串口列表"""
-        ports = serial.tools.list_ports.comports()
-        port_list = [port.device for port in ports]
+        """在后台线程刷新可用串口列表，完成后由界面线程更新下拉框"""
+        if self._port_scan is not None:
+            return
+        result = {}
+        
+        def scan():
+            try:
+                import serial.tools.list_ports
+                result['ports'] = [port.device for port in serial.tools.list_ports.comports()]
+            except Exception as e:
+                result['error'] = e
+        
+        self._port_scan = threading.Thread(target=scan, daemon=True)
+        self._port_scan.start()
+        self.refresh_btn.config(state=tk.DISABLED)
+        self.root.after(50, self._finish_port_scan, result)
+        
+    def _finish_port_scan(self, result):
+        if self._port_scan.is_alive():
+            self.root.after(50, self._finish_port_scan, result)
+            return
+        self._port_scan = None
+        self.refresh_btn.config(state=tk.NORMAL)
+        if 'error' in result:
+            self.log(f"刷新串口列表失败: {result['error']}", "ERROR")
+            return
+        port_list = result['ports']
         self.port_combo['values'] = port_list
         
         # 尝试加载保存的串口号
@@ -597,7 +669,7 @@ class ServoControlGUI:
         if saved_port and saved_port in port_list:
             self.port_var.set(saved_port)
             self.log(f"已加载保存的串口: {saved_port}")
-        elif port_list:
+        elif port_list and self.port_var.get() not in port_list:
             self.port_combo.current(0)
         
         self.log("刷新串口列表完成")
@@ -614,6 +686,7 @@ class ServoControlGUI:
                 baud = int(self.baud_var.get())
                 
                 # 连接串口
+                import serial
                 self.serial_port = serial.Serial(port, baud, timeout=1)
                 time.sleep(2)  # 等待Arduino重启
                 
@@ -664,6 +737,33 @@ class ServoControlGUI:
                         self.log("警告: 未收到ESP32初始响应")
                         self.log("建议: 检查ESP32电源、I2C连接或固件是否正常")
                     
+                    # 协商设备支持的协议功能（CAPS 应答与缓存一致时直接使用缓存结果）
+                    try:
+                        self.device_caps = servo_caps.negotiate(self.serial_port, refresh=self.refresh_caps)
+                        source = "缓存" if self.device_caps['source'] == 'cache' else "探测"
+                        self.log(f"设备功能（{source}）: {servo_caps.describe(self.device_caps)}")
+                    except Exception as e:
+                        self.device_caps = dict(servo_caps.LEGACY_CAPS)
+                        self.log(f"设备功能探测失败，按旧版固件处理: {e}", "WARNING")
+                    options = servo_caps.protocol_options(self.device_caps)
+                    self.batch_supported = options['use_batch']
+                    
+                    # 握手完成后由传输层接管串口读写，最多 flow_window 条命令未应答
+                    from servo_arbiter import CommandArbiter
+                    from servo_transport import DEFAULT_RECONCILE_INTERVAL, ServoTransport
+                    self.transport = ServoTransport(self.serial_port, self.metrics,
+                                                    window=self.servo_config.get('flow_window', 4),
+                                                    jaw_ack=options['jaw_ack'],
+                                                    on_line=self.on_device_line,
+                                                    on_error=self.on_transport_error,
+                                                    reconcile_interval=self.servo_config.get(
+                                                        'status_interval', DEFAULT_RECONCILE_INTERVAL)
+                                                    if options['status'] else None).start()
+                    self.arbiter = CommandArbiter(self.transport, self.servo_config,
+                                                  on_reject=self.on_arbiter_reject,
+                                                  use_batch=options['use_batch'],
+                                                  use_jaw_sync=options['use_jaw_sync'])
+                    
                     # 检查是否需要在连接后自动发送存储的角度
                     auto_send_angles = self.servo_config.get('auto_send_angles', False)
                     if auto_send_angles:
@@ -687,12 +787,16 @@ class ServoControlGUI:
             except Exception as e:
                 messagebox.showerror("连接错误", str(e))
                 self.log(f"连接失败: {e}", "ERROR")
+                self.close_transport()
                 if self.serial_port:
                     self.serial_port.close()
                 self.serial_port = None
                 self.is_connected = False
         else:
             try:
+                self.close_transport()
+                self.batch_supported = None
+                self.device_caps = {}
                 if self.serial_port:
                     self.serial_port.close()
                 self.is_connected = False
@@ -711,16 +815,12 @@ class ServoControlGUI:
             
         try:
             self.log("测试通信...")
-            # 清空缓冲区
-            if self.serial_port.in_waiting:
-                self.serial_port.read(self.serial_port.in_waiting)
-            
-            # 发送状态查询命令
-            self.serial_port.write(b"STATUS\n")
-            time.sleep(0.5)
+            # 发送状态查询命令，收集应答直到 STATUS/ERROR 行
+            lines = self.transport.query(b"STATUS\n", lambda kind, text: kind in ('STATUS', 'ERROR'),
+                                         timeout=0.5)
             
-            if self.serial_port.in_waiting:
-                response = self.serial_port.readline().decode().strip()
+            if lines:
+                response = lines[-1]
                 self.log(f"测试响应: {response}")
                 messagebox.showinfo("测试成功", "通信正常")
             else:
@@ -747,6 +847,8 @@ class ServoControlGUI:
             
             # 更新内部状态
             self.servo_angles[servo_id] = angle
+            if not self.suppress_send and self.recorder is not None:
+                self.recorder.record(servo_id, angle)
             
             # 更新标签
             if servo_id < len(self.servo_controls) and 'label' in self.servo_controls[servo_id]:
@@ -790,13 +892,30 @@ class ServoControlGUI:
         angle = max(servo_min, min(servo_max, angle))
         
         try:
-            if servo_id == 0 or servo_id == 1:
-                self.send_jaw_servo_commands(angle, wait_response=False, verbose=False)
-            else:
-                self.send_servo_command(servo_id, angle, wait_response=False)
+            # 下颚组以舵机0的角度作为目标，发送时再按反向同步规则展开
+            self.motion.set_target(0 if servo_id == 1 else servo_id, angle)
+            self._start_motion()
         except Exception as e:
             self.log(f"防抖发送舵机{servo_id}命令出错: {e}", "ERROR")
     
+    def _start_motion(self):
+        if self.motion_after_id is None:
+            self._motion_tick()
+    
+    def _motion_tick(self):
+        """推进一个轨迹周期，发送角度有变化的舵机（同一舵机尚未写出的旧命令会被合并）"""
+        self.motion_after_id = None
+        if not self.is_connected or not self.transport:
+            self.motion.reset()
+            return
+        for servo_id, angle in self.motion.step().items():
+            if servo_id == 0:
+                self.send_jaw_servo_commands(angle, wait_response=False, verbose=False)
+            else:
+                self.arbiter.send_frame({servo_id: angle}, ('S', servo_id))
+        if self.motion.moving:
+            self.motion_after_id = self.root.after(self.motion.step_ms, self._motion_tick)
+    
     def on_jaw_servo_change(self, value):
         try:
             angle = int(float(value))
@@ -810,6 +929,8 @@ class ServoControlGUI:
             # 更新内部状态，保持反向同步
             self.servo_angles[0] = angle
             self.servo_angles[1] = 180 - angle
+            if not self.suppress_send and self.recorder is not None:
+                self.recorder.record(0, angle)
             
             if hasattr(self, 'jaw_label'):
                 self.jaw_label.config(text=f"{angle}°")
@@ -843,7 +964,10 @@ class ServoControlGUI:
             if not self.is_connected or not self.serial_port:
                 if verbose:
                     self.log(f"串口未连接，无法发送命令", "WARNING")
-                messagebox.showwarning("警告", "串口未连接，无法发送命令")
+                if self._on_ui_thread():
+                    messagebox.showwarning("警告", "串口未连接，无法发送命令")
+                else:
+                    self.log("串口未连接，无法发送命令", "WARNING")
                 return False
             
             # 获取舵机配置范围
@@ -979,15 +1103,17 @@ class ServoControlGUI:
                 self.log(f"发送JS同步命令: {js_command.strip()}")
             
             try:
-                if self.is_connected and self.serial_port:
-                    # 发送命令
-                    self.serial_port.write(js_command.encode('utf-8'))
+                if self.is_connected and self.transport and not self.device_caps.get('js', True):
+                    # 固件不支持JS命令，改为同时设置舵机0和1
+                    result = self.send_group_commands([(0, servo0_angle), (1, servo1_angle)], wait_response)
+                elif self.is_connected and self.transport:
+                    # 发送命令（新固件应答OK:JS，旧固件写出即完成）
+                    record = self.arbiter.send_frame({0: angle, 1: 180 - angle}, ('JS',), delta=True)
                     result = True
                     if wait_response:
-                        # 如果需要等待响应，读取ESP32的反馈
-                        response = self.serial_port.readline().decode('utf-8', errors='replace').strip()
+                        result = record.wait(self.transport.ack_timeout)
                         if verbose:
-                            self.log(f"收到ESP32响应: {response}")
+                            self.log(f"JS命令状态: {record.status}")
                 else:
                     result = False
             except Exception as e:
@@ -1022,8 +1148,8 @@ class ServoControlGUI:
             return
         if self._pending_jaw_angle is None:
             return
-        angle = int(self._pending_jaw_angle)
-        self.send_jaw_servo_commands(angle, wait_response=False, verbose=False)
+        self.motion.set_target(0, int(self._pending_jaw_angle))
+        self._start_motion()
     
     def send_upper_mouth_corner_commands(self, angle):
         """同时发送命令到上嘴角组舵机（舵机2和3）"""
@@ -1031,31 +1157,10 @@ class ServoControlGUI:
             # 右上唇（舵机2）和左上唇（舵机3）需要反向运动
             servo2_angle = angle
             
-            # 计算舵机3的角度：基于相对中间值的偏移量
-            # 舵机2: min=56, max=98, mid=79
-            # 舵机3: min=38, max=75, mid=55
-            servo2_min = self.servo_config.get('servo_2_min', 56)
-            servo2_max = self.servo_config.get('servo_2_max', 98)
-            servo2_mid = self.servo_config.get('servo_2_mid', 79)
+            # 根据舵机2相对中间值的偏移量计算舵机3的反向角度
+            servo3_angle = servo_pose.mirror_angle(self.servo_config, 2, 3, servo2_angle)
             
-            servo3_min = self.servo_config.get('servo_3_min', 38)
-            servo3_max = self.servo_config.get('servo_3_max', 75)
-            servo3_mid = self.servo_config.get('servo_3_mid', 55)
-            
-            # 计算舵机2相对于中间值的偏移量（百分比）
-            if servo2_max == servo2_min:
-                offset_percent = 0
-            else:
-                offset_percent = (servo2_angle - servo2_mid) / (servo2_max - servo2_min)
-            
-            # 将偏移量应用到舵机3，方向相反
-            servo3_angle = servo3_mid - (offset_percent * (servo3_max - servo3_min))
-            
-            # 确保角度在安全范围内
-            servo3_angle = max(servo3_min, min(servo3_max, servo3_angle))
-            servo3_angle = int(servo3_angle)
-            
-            success = self.send_batch_commands([(2, servo2_angle), (3, servo3_angle)], wait_response=False)  # 不等待响应，提高同步性
+            success = self.send_group_commands([(2, servo2_angle), (3, servo3_angle)], wait_response=False)  # 不等待响应，提高同步性
             if not success:
                 self.log("批量命令不受支持，回退为同时发送单命令", "WARNING")
                 # 同时发送两个命令，不等待中间响应，提高同步性
@@ -1082,31 +1187,10 @@ class ServoControlGUI:
             # 右下唇（舵机4）和左下唇（舵机5）需要反向运动
             servo4_angle = angle
             
-            # 计算舵机5的角度：基于相对中间值的偏移量
-            # 舵机4: min=82, max=137, mid=109
-            # 舵机5: min=35, max=95, mid=62
-            servo4_min = self.servo_config.get('servo_4_min', 82)
-            servo4_max = self.servo_config.get('servo_4_max', 137)
-            servo4_mid = self.servo_config.get('servo_4_mid', 109)
-            
-            servo5_min = self.servo_config.get('servo_5_min', 35)
-            servo5_max = self.servo_config.get('servo_5_max', 95)
-            servo5_mid = self.servo_config.get('servo_5_mid', 62)
+            # 根据舵机4相对中间值的偏移量计算舵机5的反向角度
+            servo5_angle = servo_pose.mirror_angle(self.servo_config, 4, 5, servo4_angle)
             
-            # 计算舵机4相对于中间值的偏移量（百分比）
-            if servo4_max == servo4_min:
-                offset_percent = 0
-            else:
-                offset_percent = (servo4_angle - servo4_mid) / (servo4_max - servo4_min)
-            
-            # 将偏移量应用到舵机5，方向相反
-            servo5_angle = servo5_mid - (offset_percent * (servo5_max - servo5_min))
-            
-            # 确保角度在安全范围内
-            servo5_angle = max(servo5_min, min(servo5_max, servo5_angle))
-            servo5_angle = int(servo5_angle)
-            
-            success = self.send_batch_commands([(4, servo4_angle), (5, servo5_angle)], wait_response=True)
+            success = self.send_group_commands([(4, servo4_angle), (5, servo5_angle)], wait_response=True)
             if not success:
                 self.log("批量命令不受支持，回退为连续单命令", "WARNING")
                 s4 = self.send_servo_command(4, servo4_angle, wait_response=True)
@@ -1130,31 +1214,10 @@ class ServoControlGUI:
             # 右上眼睑（舵机6）和左上眼睑（舵机7）需要反向运动
             servo6_angle = angle
             
-            # 计算舵机7的角度：基于相对中间值的偏移量
-            # 舵机6: min=63, max=123, mid=93
-            # 舵机7: min=25, max=106, mid=66
-            servo6_min = self.servo_config.get('servo_6_min', 63)
-            servo6_max = self.servo_config.get('servo_6_max', 123)
-            servo6_mid = self.servo_config.get('servo_6_mid', 93)
-            
-            servo7_min = self.servo_config.get('servo_7_min', 25)
-            servo7_max = self.servo_config.get('servo_7_max', 106)
-            servo7_mid = self.servo_config.get('servo_7_mid', 66)
+            # 根据舵机6相对中间值的偏移量计算舵机7的反向角度
+            servo7_angle = servo_pose.mirror_angle(self.servo_config, 6, 7, servo6_angle)
             
-            # 计算舵机6相对于中间值的偏移量（百分比）
-            if servo6_max == servo6_min:
-                offset_percent = 0
-            else:
-                offset_percent = (servo6_angle - servo6_mid) / (servo6_max - servo6_min)
-            
-            # 将偏移量应用到舵机7，方向相反
-            servo7_angle = servo7_mid - (offset_percent * (servo7_max - servo7_min))
-            
-            # 确保角度在安全范围内
-            servo7_angle = max(servo7_min, min(servo7_max, servo7_angle))
-            servo7_angle = int(servo7_angle)
-            
-            success = self.send_batch_commands([(6, servo6_angle), (7, servo7_angle)], wait_response=True)
+            success = self.send_group_commands([(6, servo6_angle), (7, servo7_angle)], wait_response=True)
             if not success:
                 self.log("批量命令不受支持，回退为连续单命令", "WARNING")
                 s6 = self.send_servo_command(6, servo6_angle, wait_response=True)
@@ -1178,31 +1241,10 @@ class ServoControlGUI:
             # 右下眼睑（舵机8）和左下眼睑（舵机9）需要反向运动
             servo8_angle = angle
             
-            # 计算舵机9的角度：基于相对中间值的偏移量
-            # 舵机8: min=99, max=163, mid=132
-            # 舵机9: min=61, max=103, mid=79
-            servo8_min = self.servo_config.get('servo_8_min', 99)
-            servo8_max = self.servo_config.get('servo_8_max', 163)
-            servo8_mid = self.servo_config.get('servo_8_mid', 132)
-            
-            servo9_min = self.servo_config.get('servo_9_min', 61)
-            servo9_max = self.servo_config.get('servo_9_max', 103)
-            servo9_mid = self.servo_config.get('servo_9_mid', 79)
+            # 根据舵机8相对中间值的偏移量计算舵机9的反向角度
+            servo9_angle = servo_pose.mirror_angle(self.servo_config, 8, 9, servo8_angle)
             
-            # 计算舵机8相对于中间值的偏移量（百分比）
-            if servo8_max == servo8_min:
-                offset_percent = 0
-            else:
-                offset_percent = (servo8_angle - servo8_mid) / (servo8_max - servo8_min)
-            
-            # 将偏移量应用到舵机9，方向相反
-            servo9_angle = servo9_mid - (offset_percent * (servo9_max - servo9_min))
-            
-            # 确保角度在安全范围内
-            servo9_angle = max(servo9_min, min(servo9_max, servo9_angle))
-            servo9_angle = int(servo9_angle)
-            
-            success = self.send_batch_commands([(8, servo8_angle), (9, servo9_angle)], wait_response=True)
+            success = self.send_group_commands([(8, servo8_angle), (9, servo9_angle)], wait_response=True)
             if not success:
                 self.log("批量命令不受支持，回退为连续单命令", "WARNING")
                 s8 = self.send_servo_command(8, servo8_angle, wait_response=True)
@@ -1228,55 +1270,15 @@ class ServoControlGUI:
                 if servo_id == 12:
                     servo12_angle = angle
                     
-                    # 计算舵机14的角度：基于相对中间值的偏移量
-                    # 舵机12: min=66, max=103, mid=86
-                    # 舵机14: min=68, max=112, mid=87
-                    servo12_min = self.servo_config.get('servo_12_min', 66)
-                    servo12_max = self.servo_config.get('servo_12_max', 103)
-                    servo12_mid = self.servo_config.get('servo_12_mid', 86)
-                    
-                    servo14_min = self.servo_config.get('servo_14_min', 68)
-                    servo14_max = self.servo_config.get('servo_14_max', 112)
-                    servo14_mid = self.servo_config.get('servo_14_mid', 87)
-                    
-                    # 计算舵机12相对于中间值的偏移量（百分比）
-                    if servo12_max == servo12_min:
-                        offset_percent = 0
-                    else:
-                        offset_percent = (servo12_angle - servo12_mid) / (servo12_max - servo12_min)
-                    
-                    # 将偏移量应用到舵机14，方向相反
-                    servo14_angle = servo14_mid - (offset_percent * (servo14_max - servo14_min))
-                    
-                    # 确保角度在安全范围内
-                    servo14_angle = max(servo14_min, min(servo14_max, servo14_angle))
-                    servo14_angle = int(servo14_angle)
+                    # 根据舵机12相对中间值的偏移量计算舵机14的反向角度
+                    servo14_angle = servo_pose.mirror_angle(self.servo_config, 12, 14, servo12_angle)
                 else:
                     servo14_angle = angle
                     
-                    # 计算舵机12的角度：基于相对中间值的偏移量
-                    servo14_min = self.servo_config.get('servo_14_min', 68)
-                    servo14_max = self.servo_config.get('servo_14_max', 112)
-                    servo14_mid = self.servo_config.get('servo_14_mid', 87)
-                    
-                    servo12_min = self.servo_config.get('servo_12_min', 66)
-                    servo12_max = self.servo_config.get('servo_12_max', 103)
-                    servo12_mid = self.servo_config.get('servo_12_mid', 86)
-                    
-                    # 计算舵机14相对于中间值的偏移量（百分比）
-                    if servo14_max == servo14_min:
-                        offset_percent = 0
-                    else:
-                        offset_percent = (servo14_angle - servo14_mid) / (servo14_max - servo14_min)
-                    
-                    # 将偏移量应用到舵机12，方向相反
-                    servo12_angle = servo12_mid - (offset_percent * (servo12_max - servo12_min))
-                    
-                    # 确保角度在安全范围内
-                    servo12_angle = max(servo12_min, min(servo12_max, servo12_angle))
-                    servo12_angle = int(servo12_angle)
+                    # 根据舵机14相对中间值的偏移量计算舵机12的反向角度
+                    servo12_angle = servo_pose.mirror_angle(self.servo_config, 14, 12, servo14_angle)
                 
-                success = self.send_batch_commands([(12, servo12_angle), (14, servo14_angle)], wait_response=False)  # 不等待响应，提高同步性
+                success = self.send_group_commands([(12, servo12_angle), (14, servo14_angle)], wait_response=False)  # 不等待响应，提高同步性
                 if not success:
                     self.log("批量命令不受支持，回退为同时发送单命令", "WARNING")
                     # 同时发送两个命令，不等待中间响应，提高同步性
@@ -1299,55 +1301,15 @@ class ServoControlGUI:
                 if servo_id == 13:
                     servo13_angle = angle
                     
-                    # 计算舵机15的角度：基于相对中间值的偏移量
-                    # 舵机13: min=35, max=89, mid=59
-                    # 舵机15: min=106, max=136, mid=121
-                    servo13_min = self.servo_config.get('servo_13_min', 35)
-                    servo13_max = self.servo_config.get('servo_13_max', 89)
-                    servo13_mid = self.servo_config.get('servo_13_mid', 59)
-                    
-                    servo15_min = self.servo_config.get('servo_15_min', 106)
-                    servo15_max = self.servo_config.get('servo_15_max', 136)
-                    servo15_mid = (servo15_min + servo15_max) / 2  # 计算真实中间值
-                    
-                    # 计算舵机13相对于中间值的偏移量（百分比）
-                    if servo13_max == servo13_min:
-                        offset_percent = 0
-                    else:
-                        offset_percent = (servo13_angle - servo13_mid) / (servo13_max - servo13_min)
-                    
-                    # 将偏移量应用到舵机15，方向相反
-                    servo15_angle = servo15_mid - (offset_percent * (servo15_max - servo15_min))
-                    
-                    # 确保角度在安全范围内
-                    servo15_angle = max(servo15_min, min(servo15_max, servo15_angle))
-                    servo15_angle = int(servo15_angle)
+                    # 根据舵机13相对中间值的偏移量计算舵机15的反向角度
+                    servo15_angle = servo_pose.mirror_angle(self.servo_config, 13, 15, servo13_angle)
                 else:
                     servo15_angle = angle
                     
-                    # 计算舵机13的角度：基于相对中间值的偏移量
-                    servo15_min = self.servo_config.get('servo_15_min', 106)
-                    servo15_max = self.servo_config.get('servo_15_max', 136)
-                    servo15_mid = (servo15_min + servo15_max) / 2  # 计算真实中间值
-                    
-                    servo13_min = self.servo_config.get('servo_13_min', 35)
-                    servo13_max = self.servo_config.get('servo_13_max', 89)
-                    servo13_mid = self.servo_config.get('servo_13_mid', 59)
-                    
-                    # 计算舵机15相对于中间值的偏移量（百分比）
-                    if servo15_max == servo15_min:
-                        offset_percent = 0
-                    else:
-                        offset_percent = (servo15_angle - servo15_mid) / (servo15_max - servo15_min)
-                    
-                    # 将偏移量应用到舵机13，方向相反
-                    servo13_angle = servo13_mid - (offset_percent * (servo13_max - servo13_min))
-                    
-                    # 确保角度在安全范围内
-                    servo13_angle = max(servo13_min, min(servo13_max, servo13_angle))
-                    servo13_angle = int(servo13_angle)
+                    # 根据舵机15相对中间值的偏移量计算舵机13的反向角度
+                    servo13_angle = servo_pose.mirror_angle(self.servo_config, 15, 13, servo15_angle)
                 
-                success = self.send_batch_commands([(13, servo13_angle), (15, servo15_angle)], wait_response=False)  # 不等待响应，提高同步性
+                success = self.send_group_commands([(13, servo13_angle), (15, servo15_angle)], wait_response=False)  # 不等待响应，提高同步性
                 if not success:
                     self.log("批量命令不受支持，回退为同时发送单命令", "WARNING")
                     # 同时发送两个命令，不等待中间响应，提高同步性
@@ -1466,9 +1428,10 @@ class ServoControlGUI:
         Returns:
             命令是否发送成功
         """
-        if not self.serial_port or not self.is_connected:
+        if not self.transport or not self.is_connected:
             self.log(f"错误: 串口未连接，无法发送命令 S{servo_id},{angle}", "ERROR")
             return False
+        import serial
         
         try:
             smin = self.servo_config.get(f'servo_{servo_id}_min', 0)
@@ -1487,73 +1450,56 @@ class ServoControlGUI:
             # 构建命令
             command = f"S{servo_id},{angle}"
             
-            # 发送命令（使用CRLF结束符）
-            full_command = command + '\n'
-            self.serial_port.write(full_command.encode())
+            # 发送命令（同一舵机尚未写出的旧命令会被合并，设备上已是该角度时不发送）
+            record = self.arbiter.send_frame([(servo_id, angle)], ('S', servo_id), delta=True)
             self.log(f"发送命令: {command}")
             
             if wait_response:
-                # 等待响应
-                time.sleep(0.2)
-                
-                # 读取并显示所有响应行，但不进行复杂的响应处理
-                while self.serial_port.in_waiting:
-                    response = self.serial_port.readline().decode().strip()
-                    if response:
-                        self.log(f"ESP32响应: {response}")
-                        # 如果找到ERROR响应，返回False
-                        if response.startswith("ERROR"):
-                            return False
-                
-                # 无论是否找到OK响应，都假设命令发送成功
-                # 因为ESP32的DEBUG信息已经表明命令被正确处理
-                return True
+                # 等待OK/ERROR应答
+                return self.wait_command(record)
             else:
                 # 不等待响应，立即返回成功
                 return True
             
         except serial.SerialException as e:
             self.log(f"串口错误: {e}", "ERROR")
-            self.is_connected = False
-            self.connect_btn.config(text="连接")
-            self.status_label.config(text="未连接", foreground="red")
+            self.show_disconnected()
             return False
         except Exception as e:
             self.log(f"发送命令失败: {e}", "ERROR")
             return False
         
     def send_batch_commands(self, commands, wait_response=True):
-        if not self.serial_port or not self.is_connected:
+        if not self.transport or not self.is_connected:
             return False
         if not commands:
             return True
         try:
-            parts = []
-            for ch, ang in commands:
-                if ang < 0:
-                    ang = 0
-                elif ang > 180:
-                    ang = 180
-                parts.append(f"{int(ch)},{int(ang)}")
-            full_command = "S" + ";".join(parts) + "\n"
-            self.serial_port.write(full_command.encode())
+            key = ('B',) + tuple(int(ch) for ch, _ in commands)
+            # 只发送角度有变化的通道（与设备状态镜像比较）
+            record = self.arbiter.send_frame(commands, key, use_batch=True, use_jaw_sync=False, delta=True)
             if wait_response:
-                self.log(f"发送批量命令: {full_command.strip()}")
+                self.log(f"发送批量命令: {record.payload.decode().strip() or '（角度未变化，未发送）'}")
             if wait_response:
-                time.sleep(0.2)
-                while self.serial_port.in_waiting:
-                    response = self.serial_port.readline().decode().strip()
-                    if response:
-                        self.log(f"ESP32响应: {response}")
-                        if response.startswith("ERROR"):
-                            return False
-                return True
+                return self.wait_command(record)
             else:
                 return True
         except Exception as e:
             self.log(f"发送批量命令失败: {e}", "ERROR")
             return False
                 
+    def send_group_commands(self, commands, wait_response=True):
+        """同时设置一组舵机：设备支持批量命令时发送一条批量命令，否则连续发送单命令"""
+        if self.batch_supported is not False:
+            return self.send_batch_commands(commands, wait_response)
+        records = []
+        for ch, ang in commands:
+            ang = max(0, min(180, int(ang)))
+            records.append(self.arbiter.send_frame([(int(ch), ang)], ('S', int(ch)), delta=True))
+        if not wait_response:
+            return True
+        return all([self.wait_command(record) for record in records])
+    
     def run_script(self):
         """运行脚本"""
         if not self.is_connected:
@@ -1565,24 +1511,28 @@ class ServoControlGUI:
             return
             
         self.running_script = True
-        self.script_thread = threading.Thread(target=self.execute_script_with_reset, daemon=True)
+        script_content = self.script_text.get("1.0", tk.END).strip()
+        self.script_thread = threading.Thread(target=self.execute_script_with_reset, args=(script_content,),
+                                              daemon=True)
         self.script_thread.start()
         
-    def execute_script_with_reset(self):
+    def execute_script_with_reset(self, script_content):
         """执行脚本前先自动归零"""
-        # 脚本运行前自动执行全部归零
-        self.log("脚本运行前自动执行全部归零...")
-        self.reset_all_servos()
-        time.sleep(1)  # 等待归零完成
-        
-        # 然后执行正常脚本
-        self.execute_script()
-        
-    def execute_script(self):
-        """逐行执行脚本"""
+        # 脚本运行期间占用涉及的舵机组，滑条不能插入命令
+        with self.command_session('script'):
+            # 脚本运行前自动执行全部归零
+            self.log("脚本运行前自动执行全部归零...")
+            self.reset_all_servos()
+            time.sleep(1)  # 等待归零完成
+            
+            # 然后执行正常脚本
+            self.execute_script(script_content)
+        
+    def execute_script(self, script_content):
+        """逐行执行脚本（在后台线程中运行，界面更新经 ui_queue 投递）"""
+        # 脚本直接设置舵机角度，滑条轨迹需要从新的角度重新开始
+        self.ui_queue.post(self.motion.reset)
         try:
-            # 获取脚本内容
-            script_content = self.script_text.get("1.0", tk.END).strip()
             if not script_content:
                 self.log("脚本内容为空")
                 self.running_script = False
@@ -1591,6 +1541,14 @@ class ServoControlGUI:
             # 按行分割脚本
             lines = script_content.split('\n')
             
+            # "延时 自动" 按舵机转动时间模型等待全部舵机到位
+            from servo_slew import SlewTracker
+            slew = SlewTracker(self.servo_config, dict(enumerate(self.servo_angles)))
+            script_start = time.monotonic()
+            # 延时按脚本时间累计，命令发送和界面更新的耗时不会使后面的动作整体推迟；
+            # 落后超过100ms（例如等待应答）时从当前时刻重新计时，不把后面的动作挤在一起
+            due = script_start
+            
             # 逐行执行
             for line_num, line in enumerate(lines, 1):
                 if not self.running_script:
@@ -1617,6 +1575,8 @@ class ServoControlGUI:
                             
                             if 0 <= servo_id < 16 and 0 <= angle <= 180:
                                 self.log(f"执行: {line}")
+                                slew.move(servo_pose.group_pose(self.servo_config, servo_id, angle),
+                                          (time.monotonic() - script_start) * 1000.0)
                                 
                                 # 根据舵机分组处理
                                 if servo_id == 0 or servo_id == 1:
@@ -1643,7 +1603,6 @@ class ServoControlGUI:
                                     
                                 # 更新GUI
                                 self.update_servo_gui(servo_id, angle)
-                                time.sleep(0.1)
                             else:
                                 self.log(f"无效命令: {line}", "WARNING")
                         except ValueError:
@@ -1656,13 +1615,18 @@ class ServoControlGUI:
                     parts = line.split()
                     if len(parts) >= 2:
                         try:
-                            delay_ms = int(parts[1])
+                            if parts[1].lower() in AUTO_DELAY_WORDS:
+                                delay_ms = slew.dwell_ms((time.monotonic() - script_start) * 1000.0)
+                            else:
+                                delay_ms = int(parts[1])
                             self.log(f"延时 {delay_ms}ms")
+                            due = max(due, time.monotonic() - 0.1) + delay_ms / 1000.0
                             # 延时期间检查停止标志
-                            for _ in range(delay_ms // 100):
-                                if not self.running_script:
+                            while self.running_script:
+                                remaining = due - time.monotonic()
+                                if remaining <= 0:
                                     break
-                                time.sleep(0.1)
+                                time.sleep(min(0.1, remaining))
                         except ValueError:
                             self.log(f"延时格式错误: {line}", "WARNING")
                     else:
@@ -1688,8 +1652,14 @@ class ServoControlGUI:
             self.running_script = False
             self.clear_highlight()
         
+    def _on_ui_thread(self):
+        return threading.current_thread() is threading.main_thread()
+        
     def highlight_line(self, line_num):
         """高亮显示当前执行行"""
+        if not self._on_ui_thread():
+            self.ui_queue.set('highlight', self.highlight_line, line_num)
+            return
         # 清除之前的高亮
         self.clear_highlight()
         
@@ -1704,21 +1674,106 @@ class ServoControlGUI:
         
     def clear_highlight(self):
         """清除所有高亮"""
+        if not self._on_ui_thread():
+            # 与 highlight_line 使用同一个 key，只有最后一次生效
+            self.ui_queue.set('highlight', self.clear_highlight)
+            return
         self.script_text.tag_remove("current_line", "1.0", tk.END)
         
     def update_servo_gui(self, servo_id, angle):
         """更新舵机GUI显示"""
         if 0 <= servo_id < 16 and servo_id < len(self.servo_controls):
             if self.servo_controls[servo_id]:
+                self.servo_angles[servo_id] = angle
+                if not self._on_ui_thread():
+                    self.ui_queue.set(('servo', servo_id), self.update_servo_gui, servo_id, angle)
+                    return
                 self.servo_controls[servo_id]['var'].set(angle)
                 self.servo_controls[servo_id]['label'].config(text=f"{angle}°")
-                self.servo_angles[servo_id] = angle
         
     def stop_script(self):
         """停止脚本执行"""
         self.running_script = False
+        self.replay_stop.set()
         self.log("正在停止脚本...")
         
+    def toggle_recording(self):
+        """开始/停止录制滑条动作，停止时保存录制文件"""
+        if self.recorder is None:
+            from motion_recorder import MotionRecorder
+            self.recorder = MotionRecorder()
+        if not self.recorder.active:
+            self.recorder.start()
+            self.record_btn.config(text="停止录制")
+            self.log("开始录制滑条动作")
+            return
+        recording = self.recorder.stop()
+        self.record_btn.config(text="录制动作")
+        self.log(f"录制结束，共 {len(recording)} 个事件，时长 {recording.duration:.2f}秒")
+        if not len(recording):
+            return
+        filetypes = [("动作录制", "*.srec"), ("所有文件", "*.*")]
+        try:
+            import numpy  # noqa: F401
+            filetypes.insert(1, ("NumPy压缩", "*.npz"))
+        except ImportError:
+            pass
+        file_path = filedialog.asksaveasfilename(title="保存动作录制", defaultextension=".srec",
+                                                 initialdir=os.path.dirname(os.path.abspath(__file__)),
+                                                 filetypes=filetypes)
+        if not file_path:
+            return
+        try:
+            recording.save(file_path)
+            self.log(f"动作录制已保存: {file_path}")
+        except Exception as e:
+            self.log(f"保存动作录制失败: {e}", "ERROR")
+        
+    def replay_recording(self):
+        """按原始时间间隔回放动作录制文件"""
+        if not self.is_connected:
+            messagebox.showwarning("警告", "请先连接串口")
+            return
+        if self.running_script:
+            messagebox.showinfo("提示", "脚本正在运行中")
+            return
+        file_path = filedialog.askopenfilename(title="选择动作录制",
+                                               initialdir=os.path.dirname(os.path.abspath(__file__)),
+                                               filetypes=[("动作录制", "*.srec *.npz"), ("所有文件", "*.*")])
+        if not file_path:
+            return
+        try:
+            from motion_recorder import Recording
+            recording = Recording.load(file_path)
+        except Exception as e:
+            self.log(f"读取动作录制失败: {e}", "ERROR")
+            return
+        self.running_script = True
+        self.replay_stop.clear()
+        self.script_thread = threading.Thread(target=self.execute_replay, args=(recording,), daemon=True)
+        self.script_thread.start()
+        
+    def execute_replay(self, recording):
+        """回放线程：与滑条一样每个事件只发送录制的通道，同一通道尚未写出的旧目标被新目标替换"""
+        from motion_recorder import event_targets, replay
+        options = servo_caps.protocol_options(self.device_caps or servo_caps.LEGACY_CAPS)
+        
+        def send(servo_id, angle):
+            targets = event_targets(self.servo_config, servo_id, angle)
+            self.arbiter.send_frame(targets, ('G',) + tuple(ch for ch, _ in targets),
+                                    options['use_batch'], options['use_jaw_sync'], delta=True)
+        
+        self.ui_queue.post(self.motion.reset)
+        self.log(f"开始回放 {len(recording)} 个事件，时长 {recording.duration:.2f}秒")
+        try:
+            with self.command_session('script'):
+                worst = replay(recording, send, stop_event=self.replay_stop)
+            self.log(f"回放结束，最大调度延迟 {worst * 1000:.1f}ms")
+        except Exception as e:
+            self.log(f"回放出错: {e}", "ERROR")
+        finally:
+            self.running_script = False
+        
     def save_script(self):
         """保存脚本"""
         script_name = self.script_name_var.get().strip()
@@ -1810,6 +1865,8 @@ class ServoControlGUI:
                 self.script_name_var.set(script_name)
                 self.script_text.delete("1.0", tk.END)
                 self.script_text.insert("1.0", content)
+                self.loaded_script_path = os.path.abspath(file_path)
+                self._loaded_script_text = self.script_text.get("1.0", tk.END)
                 
                 # 保存最后使用的脚本名称
                 self.servo_config['last_script'] = script_name
@@ -1838,15 +1895,19 @@ class ServoControlGUI:
         
     def load_config(self):
         """加载舵机配置文件"""
-        config = {}
+        data = {}
         if os.path.exists(self.config_file):
             try:
                 with open(self.config_file, 'r', encoding='utf-8') as f:
                     data = json.load(f)
-                    config.update(data)
             except Exception as e:
                 self.log(f"加载配置文件失败: {str(e)}", "ERROR")
-        
+        return self.normalize_config(data)
+    
+    @staticmethod
+    def normalize_config(data):
+        """补全每个舵机的默认配置，不访问界面和实例状态（监视线程中也可调用）"""
+        config = dict(data)
         # 确保每个舵机都有默认配置
         for i in range(16):
             # 兼容旧配置，优先使用新键名，不存在则使用旧键名
@@ -1859,8 +1920,67 @@ class ServoControlGUI:
                 
         return config
     
+    def start_file_watcher(self):
+        from servo_watch import FileWatcher
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        self.watcher = FileWatcher([self.config_file, os.path.join(base_dir, "表情脚本")],
+                                   self.on_files_changed).start()
+    
+    def on_files_changed(self, changed):
+        """配置文件或脚本文件被外部修改（在监视线程中调用）：后台读取，界面线程中一次性替换
+
+        这里只读文件和构造新的配置，比较和替换 servo_config 都在界面线程中进行。
+        """
+        if self.config_file in changed:
+            try:
+                with open(self.config_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                # 文件不完整（正在写入）或格式错误时保留当前配置
+                self.log(f"配置文件已被修改但无法读取，继续使用当前配置: {e}", "WARNING")
+                return
+            self.ui_queue.post(self.apply_config, self.normalize_config(data))
+        path = self.loaded_script_path
+        if path in changed and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+            except OSError as e:
+                self.log(f"重新读取脚本失败: {e}", "ERROR")
+                return
+            self.ui_queue.post(self.apply_script_file, path, content)
+    
+    def apply_config(self, config):
+        """替换校准配置并刷新滑条范围和校准输入框（界面线程）"""
+        # 本程序自己保存配置也会触发，内容相同时忽略
+        if config == self.servo_config:
+            return
+        self.servo_config = config
+        self.motion.set_config(config)
+        if self.arbiter:
+            self.arbiter.set_config(config)
+        for _, servo_id, variables, _, _ in self._calibration_panels:
+            for var, key in zip(variables, ('min', 'max', 'mid')):
+                var.set(str(config.get(f'servo_{servo_id}_{key}', 90)))
+        self.update_servo_scales()
+        self.log("配置文件已被修改，已重新加载校准参数")
+    
+    def apply_script_file(self, path, content):
+        """已加载的脚本文件被修改：编辑区没有改动时替换为新内容"""
+        if path != self.loaded_script_path:
+            return
+        if self.script_text.get("1.0", tk.END) != self._loaded_script_text:
+            self.log(f"脚本文件 {os.path.basename(path)} 已被修改，但编辑区有未保存的改动，未重新加载", "WARNING")
+            return
+        self.script_text.delete("1.0", tk.END)
+        self.script_text.insert("1.0", content)
+        self._loaded_script_text = self.script_text.get("1.0", tk.END)
+        self.log(f"脚本文件 {os.path.basename(path)} 已被修改，已重新加载")
+    
     def on_closing(self):
         """窗口关闭事件处理"""
+        if self.watcher is not None:
+            self.watcher.stop()
         try:
             # 保存当前配置
             if self.save_config():
@@ -1871,6 +1991,7 @@ class ServoControlGUI:
             self.log(f"关闭时保存配置失败: {e}", "ERROR")
         finally:
             # 关闭串口连接
+            self.close_transport()
             if hasattr(self, 'serial_port') and self.serial_port and hasattr(self.serial_port, 'is_open') and self.serial_port.is_open:
                 try:
                     self.serial_port.close()
@@ -1879,6 +2000,78 @@ class ServoControlGUI:
             # 销毁窗口
             self.root.destroy()
 
+    def wait_command(self, record):
+        """等待命令应答并记录结果，收到全部OK时返回True"""
+        ok = record.wait(self.transport.ack_timeout)
+        for response in record.replies:
+            self.log(f"ESP32响应: {response}")
+        if not ok:
+            self.log(f"命令 {record.payload.decode().strip()} 未成功: {record.status}", "WARNING")
+        return ok
+    
+    def on_device_line(self, kind, text):
+        """传输层收到的非应答行（在读线程中调用）"""
+        if kind != 'DEBUG':
+            self.log(f"ESP32响应: {text}", "WARNING" if kind == 'ERROR' else "INFO")
+    
+    def on_transport_error(self, exc):
+        """串口读写出错（在读/写线程中调用）"""
+        self.log(f"串口错误: {exc}", "ERROR")
+        self.show_disconnected()
+    
+    def show_disconnected(self):
+        """连接断开后更新连接按钮和状态（可在任意线程中调用）"""
+        self.is_connected = False
+        if not self._on_ui_thread():
+            self.ui_queue.set('connection', self.show_disconnected)
+            return
+        self.connect_btn.config(text="连接")
+        self.status_label.config(text="未连接", foreground="red")
+    
+    def close_transport(self):
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+            self.arbiter = None
+    
+    def command_session(self, source):
+        """在当前线程中以 source（script/reset/...）身份发送命令，未连接时不需要仲裁"""
+        arbiter = self.arbiter
+        return arbiter.session(source) if arbiter else contextlib.nullcontext()
+    
+    def on_arbiter_reject(self, source, owner, groups):
+        """命令因舵机组被更高优先级的来源占用而未发送（同一对来源只提示一次）"""
+        from servo_arbiter import SOURCE_NAMES
+        names = '、'.join(servo_pose.GROUP_NAMES.get(group, f"舵机{group[0]}") for group in groups)
+        self.log(f"{SOURCE_NAMES.get(owner, owner)}正在控制{names}，"
+                 f"{SOURCE_NAMES.get(source, source)}命令未发送", "WARNING")
+    
+    def update_metrics_status(self):
+        """定时刷新状态栏统计，并导出Prometheus文本文件"""
+        try:
+            if self.transport:
+                text = self.metrics.status_text()
+                if self.arbiter:
+                    text += " | " + self.arbiter.status_text()
+                self.metrics_label.config(text=text)
+                if self.metrics_file:
+                    self.export_metrics()
+            else:
+                self.metrics_label.config(text="未连接")
+        except Exception as e:
+            self.log(f"刷新统计信息失败: {e}", "ERROR")
+        self.root.after(500, self.update_metrics_status)
+    
+    def export_metrics(self):
+        """写出Prometheus文本文件（同一错误只提示一次）"""
+        try:
+            self.metrics.write_prometheus(self.metrics_file, {'port': self.serial_port.port})
+            self._metrics_error = None
+        except OSError as e:
+            if str(e) != self._metrics_error:
+                self._metrics_error = str(e)
+                self.log(f"导出统计文件失败: {e}", "ERROR")
+    
     def toggle_auto_send_angles(self):
         """切换连接后是否自动发送角度的配置"""
         self.servo_config['auto_send_angles'] = self.auto_send_var.get()
@@ -1897,9 +2090,10 @@ class ServoControlGUI:
             self.log("开始初始化所有舵机到中间位置...")
             
             # 发送RESET命令到ESP32，让硬件统一处理所有舵机的初始化
-            self.serial_port.write(b"RESET\n")
-            self.log("已发送RESET命令到硬件，等待所有舵机移动到中间位置...")
-            time.sleep(1.5)  # 等待所有舵机移动完成
+            with self.command_session('reset'):
+                self.arbiter.send(b"RESET\n")
+                self.log("已发送RESET命令到硬件，等待所有舵机移动到中间位置...")
+                time.sleep(1.5)  # 等待所有舵机移动完成
             
             self.log("所有舵机已初始化到中间位置")
         except Exception as e:
@@ -2228,6 +2422,7 @@ class ServoControlGUI:
                 self.servo_controls[servo_id]['max_var'].set('180')
             
             # 提示用户可以开始配置指定舵机
+            self.show_calibration(True)
             messagebox.showinfo("提示", f"舵机{servo_id}的滑条范围已重置为0-180°\n" +
                                "现在可以配置该舵机的'最小角度'、'最大角度'和'中间值'\n" +
                                "修改完成后，点击'保存所有配置'按钮保存所有配置")
@@ -2320,15 +2515,17 @@ class ServoControlGUI:
             self.log("开始将所有舵机移动到中间值...")
             
             if self.is_connected:
-                # 发送RESET命令到ESP32，让硬件统一处理所有舵机的初始化
-                self.serial_port.write(b"RESET\n")
-                self.log("已发送RESET命令到硬件，等待所有舵机移动到中间位置...")
-                time.sleep(1.5)  # 等待所有舵机移动完成
-            
-            # 更新GUI显示所有舵机的中间值
+                # 发送RESET命令到ESP32，让硬件统一处理所有舵机的初始化（归零期间其他来源不能发送）
+                with self.command_session('reset'):
+                    self.arbiter.send(b"RESET\n")
+                    self.ui_queue.post(self.motion.reset)
+                    self.log("已发送RESET命令到硬件，等待所有舵机移动到中间位置...")
+                    time.sleep(1.5)  # 等待所有舵机移动完成
+            
+            # 更新GUI显示所有舵机的中间值（可能在脚本线程中调用，中间值从配置读取）
             for i in range(0, 16):
                 if i < len(self.servo_controls) and self.servo_controls[i]:
-                    mid_angle = int(self.servo_controls[i]['mid_var'].get())
+                    mid_angle = int(self.servo_config.get(f'servo_{i}_mid', 90))
                     min_angle = self.servo_config.get(f'servo_{i}_min', 0)
                     max_angle = self.servo_config.get(f'servo_{i}_max', 180)
                     if mid_angle < min_angle:
@@ -2337,17 +2534,10 @@ class ServoControlGUI:
                         mid_angle = max_angle
                     if 0 <= mid_angle <= 180:
                         # 更新GUI滑块位置
-                        if i < 2:
-                            # 下颚舵机使用统一的滑块
-                            self.jaw_angle_var.set(mid_angle)
-                            self.servo_controls[0]['label'].config(text=f"{mid_angle}°")
-                            self.servo_angles[0] = mid_angle
+                        # 下颚舵机使用统一的滑块（servo_controls[0]）
+                        self.update_servo_gui(i, mid_angle)
+                        if i == 0:
                             self.servo_angles[1] = mid_angle
-                        else:
-                            # 其他舵机使用各自的滑块
-                            self.servo_controls[i]['var'].set(mid_angle)
-                            self.servo_controls[i]['label'].config(text=f"{mid_angle}°")
-                            self.servo_angles[i] = mid_angle
                     else:
                         self.log(f"舵机{i}中间值超出范围: {mid_angle}°", "WARNING")
             
@@ -2367,6 +2557,12 @@ class ServoControlGUI:
         # 输出到控制台
         print(log_message)
         
+        if not self._on_ui_thread():
+            self.ui_queue.post(self._append_log, timestamp, message, level)
+            return
+        self._append_log(timestamp, message, level)
+        
+    def _append_log(self, timestamp, message, level):
         # 根据级别设置颜色
         self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
         
@@ -2381,7 +2577,13 @@ class ServoControlGUI:
         
     
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="仿生人头控制系统")
+    parser.add_argument('--metrics-file', help="定时导出Prometheus文本文件的路径（默认不导出）")
+    parser.add_argument('--refresh', action='store_true', help="重新探测设备功能（固件升级后使用）")
+    args = parser.parse_args(argv)
+    
+    imported = time.perf_counter()
     root = tk.Tk()
     root.title("仿生人头控制系统 - 增强版")
     root.geometry("1200x1100")
@@ -2391,8 +2593,14 @@ def main():
     root.update_idletasks()
     root.after(100, lambda: root.update_idletasks())
     
-    app = ServoControlGUI(root)
+    metrics_file = os.path.abspath(args.metrics_file) if args.metrics_file else None
+    app = ServoControlGUI(root, metrics_file=metrics_file, refresh_caps=args.refresh)
     root.protocol("WM_DELETE_WINDOW", app.on_closing)
+    built = time.perf_counter()
+    # 启动计时：界面构建完成、窗口第一次空闲（可以响应操作）
+    root.after_idle(lambda: app.log(f"启动用时 {(time.perf_counter() - STARTUP_TIME) * 1000:.0f}ms"
+                                    f"（导入 {(imported - STARTUP_TIME) * 1000:.0f}ms，"
+                                    f"界面构建 {(built - imported) * 1000:.0f}ms）"))
     root.mainloop()
 
 if __name__ == "__main__":
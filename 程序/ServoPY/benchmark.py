@@ -0,0 +1,348 @@
+# filename: benchmark.py
+# 用途：上位机性能基准测试
+#
+# 测试项目：
+#   parse      表情脚本解析
+#   compile    表情脚本编译（分组联动展开 + 合帧）
+#   pose       分组舵机姿态计算（servo_pose.group_pose）
+#   transport  本地模拟串口设备上的命令吞吐量（命令/秒）和每帧字节数
+#   latency    端到端姿态延迟（计算姿态 -> 编码 -> 写串口 -> 收到全部OK应答）
+#   flow       小接收缓冲区模拟设备上不同发送窗口的持续命令速率与丢失数
+#
+# 用法：
+#   python benchmark.py                       # 全部测试，结果写入 benchmark_results.json
+#   python benchmark.py --quick -o out.json   # 减少迭代次数
+#   python benchmark.py --only parse compile  # 只运行部分测试
+#
+# 结果文件包含运行环境信息，可在不同版本、不同树莓派硬件之间对比。
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import statistics
+import subprocess
+from datetime import datetime
+
+import servo_pose
+from servo_protocol import encode_frame, expected_oks, parse_reply
+from servo_script import parse_script, compile_script, load_script_file
+from servo_transport import ServoTransport, ACKED
+from virtual_servo import VirtualServoDevice
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = ('parse', 'compile', 'pose', 'transport', 'latency', 'flow')
+FLOW_WINDOWS = (None, 1, 2, 4, 8)
+
+
+def percentile(values, pct):
+    """线性插值百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * pct / 100.0
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def summarize(samples_us):
+    """微秒样本的统计摘要"""
+    return {
+        'count': len(samples_us),
+        'mean_us': statistics.mean(samples_us),
+        'p50_us': percentile(samples_us, 50),
+        'p90_us': percentile(samples_us, 90),
+        'p99_us': percentile(samples_us, 99),
+        'min_us': min(samples_us),
+        'max_us': max(samples_us),
+    }
+
+
+def time_repeated(func, repeat, number):
+    """执行 repeat 轮、每轮 number 次，返回每次调用耗时（微秒）的各轮结果"""
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        rounds.append((time.perf_counter() - start) * 1e6 / number)
+    return rounds
+
+
+def load_inputs(scripts_dir, config_file):
+    with open(config_file, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    scripts = {}
+    for name in sorted(os.listdir(scripts_dir)):
+        if name.endswith('.txt'):
+            scripts[name] = load_script_file(os.path.join(scripts_dir, name))
+    return config, scripts
+
+
+def bench_parse(config, scripts, quick):
+    number = 20 if quick else 200
+    total_lines = sum(text.count('\n') + 1 for text in scripts.values())
+    texts = list(scripts.values())
+
+    def run():
+        for text in texts:
+            parse_script(text)
+
+    rounds = time_repeated(run, 5, number)
+    best = min(rounds)
+    return {
+        'scripts': len(texts),
+        'lines': total_lines,
+        'us_per_library': best,
+        'lines_per_sec': total_lines / best * 1e6,
+        'rounds_us': rounds,
+    }
+
+
+def bench_compile(config, scripts, quick):
+    number = 20 if quick else 200
+    parsed = [parse_script(text) for text in scripts.values()]
+    frames = sum(len(compile_script(cmds, config)) for cmds in parsed)
+
+    def run():
+        for cmds in parsed:
+            compile_script(cmds, config)
+
+    def run_with_encode():
+        for cmds in parsed:
+            compile_script(cmds, config).encoded_frames()
+
+    rounds = time_repeated(run, 5, number)
+    encode_rounds = time_repeated(run_with_encode, 5, number)
+    return {
+        'scripts': len(parsed),
+        'frames': frames,
+        'us_per_library': min(rounds),
+        'us_per_library_with_encode': min(encode_rounds),
+        'frames_per_sec': frames / min(rounds) * 1e6,
+        'rounds_us': rounds,
+    }
+
+
+def bench_pose(config, scripts, quick):
+    number = 200 if quick else 2000
+    rng = random.Random(1234)
+    groups = {name: group for group, name in servo_pose.GROUP_NAMES.items()}
+    results = {}
+    for name, group in sorted(groups.items()):
+        lead = group[0]
+        angles = [rng.randint(0, 180) for _ in range(number)]
+
+        def run(lead=lead, angles=angles):
+            for angle in angles:
+                servo_pose.group_pose(config, lead, angle)
+
+        rounds = time_repeated(run, 5, 1)
+        best = min(rounds) / number
+        results[name] = {'us_per_pose': best, 'poses_per_sec': 1e6 / best}
+    return results
+
+
+def read_acks(device, count, deadline):
+    """读取应答直到收到 count 个 OK/ERROR 行，返回 (OK数, ERROR数)"""
+    ok = errors = 0
+    while ok + errors < count and time.perf_counter() < deadline:
+        line = device.readline()
+        if not line:
+            continue
+        kind, _ = parse_reply(line)
+        if kind == 'OK':
+            ok += 1
+        elif kind == 'ERROR':
+            errors += 1
+    return ok, errors
+
+
+def bench_transport(config, scripts, quick, baudrate, debug):
+    neutral = [(i, config.get(f'servo_{i}_mid', 90)) for i in range(16)]
+    neutral_jaw = dict(neutral)
+    neutral_jaw.update(servo_pose.jaw_pose(config.get('servo_0_mid', 90)))
+    frame_bytes = {
+        'single_commands': len(encode_frame(neutral, use_batch=False, use_jaw_sync=False)),
+        'batch': len(encode_frame(neutral, use_batch=True, use_jaw_sync=False)),
+        'batch_with_jaw_sync': len(encode_frame(neutral_jaw)),
+    }
+
+    count = 30 if quick else 200
+    results = {'baudrate': baudrate, 'debug': debug, 'bytes_per_16ch_frame': frame_bytes}
+    device = VirtualServoDevice(baudrate=baudrate, debug=debug, timeout=0.5)
+    try:
+        # 停等方式：每条单舵机命令等待OK后再发下一条
+        rng = random.Random(42)
+        start = time.perf_counter()
+        acked = 0
+        for _ in range(count):
+            ch = rng.randint(2, 15)
+            device.write(f"S{ch},{rng.randint(40, 140)}\n".encode())
+            ok, _ = read_acks(device, 1, time.perf_counter() + 2)
+            acked += ok
+        elapsed = time.perf_counter() - start
+        results['single_stop_and_wait'] = {
+            'commands': count, 'acked': acked, 'commands_per_sec': acked / elapsed,
+        }
+
+        # 批量帧：每帧16个通道
+        frames = max(5, count // 10)
+        payload = encode_frame(neutral, use_batch=True, use_jaw_sync=False)
+        start = time.perf_counter()
+        acked = 0
+        for _ in range(frames):
+            device.write(payload)
+            ok, _ = read_acks(device, 16, time.perf_counter() + 5)
+            acked += ok
+        elapsed = time.perf_counter() - start
+        results['batch_stop_and_wait'] = {
+            'frames': frames, 'acked_channels': acked,
+            'commands_per_sec': acked / elapsed, 'frames_per_sec': frames / elapsed,
+        }
+        results['device_bytes_dropped'] = device.bytes_dropped
+    finally:
+        device.close()
+    return results
+
+
+def bench_latency(config, scripts, quick, baudrate, debug):
+    """端到端姿态延迟：对每个表情脚本中的舵机命令，计时从姿态计算到收到全部OK"""
+    poses = []
+    for name, text in scripts.items():
+        commands = [(c.servo_id, c.value) for c in parse_script(text) if c.kind == 'servo']
+        if commands:
+            poses.append(commands)
+    if not poses:
+        return {}
+
+    samples = []
+    rounds = 2 if quick else 5
+    device = VirtualServoDevice(baudrate=baudrate, debug=debug, timeout=0.5)
+    try:
+        for _ in range(rounds):
+            for commands in poses:
+                start = time.perf_counter()
+                targets = {}
+                for servo_id, angle in commands:
+                    for ch, a in servo_pose.group_pose(config, servo_id, angle):
+                        targets[ch] = a
+                payload = encode_frame(targets, use_batch=True, use_jaw_sync=False)
+                device.write(payload)
+                read_acks(device, len(expected_oks(payload)), time.perf_counter() + 5)
+                samples.append((time.perf_counter() - start) * 1e6)
+    finally:
+        device.close()
+    result = summarize(samples)
+    result.update({'baudrate': baudrate, 'debug': debug, 'poses': len(poses)})
+    return result
+
+
+def bench_flow(config, scripts, quick, baudrate, debug, rx_buffer_size=64):
+    """发送窗口对比：主机尽快产生单舵机命令，统计收到应答的命令速率和丢失的命令"""
+    count = 40 if quick else 200
+    rng = random.Random(7)
+    payloads = [f"S{rng.randint(2, 15)},{rng.randint(40, 140)}\n".encode() for _ in range(count)]
+    results = {'baudrate': baudrate, 'debug': debug, 'rx_buffer_size': rx_buffer_size,
+               'commands': count, 'windows': {}}
+    for window in FLOW_WINDOWS:
+        device = VirtualServoDevice(baudrate=baudrate, debug=debug, rx_buffer_size=rx_buffer_size,
+                                    timeout=0.05)
+        max_bytes = None if window is None else rx_buffer_size * 3 // 4
+        transport = ServoTransport(device, ack_timeout=1.0, window=window,
+                                   max_bytes_in_flight=max_bytes).start()
+        try:
+            start = time.perf_counter()
+            records = [transport.send(payload) for payload in payloads]
+            transport.wait_idle(timeout=count * 0.1 + 5)
+            elapsed = time.perf_counter() - start
+        finally:
+            transport.close()
+            device.close()
+        acked = sum(1 for r in records if r.status == ACKED)
+        snap = transport.metrics.snapshot()
+        results['windows']['unlimited' if window is None else str(window)] = {
+            'acked': acked,
+            'lost': count - acked,
+            'commands_per_sec': acked / elapsed,
+            'latency_p50_ms': snap['latency_p50_ms'],
+            'latency_p99_ms': snap['latency_p99_ms'],
+            'stalls': snap['stalls_total'],
+            'device_bytes_dropped': device.bytes_dropped,
+        }
+    return results
+
+
+def environment_info():
+    info = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+    try:
+        info['git_commit'] = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        info['git_commit'] = None
+    return info
+
+
+def run_benchmarks(names, scripts_dir, config_file, quick=False, baudrate=115200, debug=True):
+    config, scripts = load_inputs(scripts_dir, config_file)
+    results = {}
+    for name in names:
+        print(f"运行基准测试: {name} ...")
+        if name == 'parse':
+            results[name] = bench_parse(config, scripts, quick)
+        elif name == 'compile':
+            results[name] = bench_compile(config, scripts, quick)
+        elif name == 'pose':
+            results[name] = bench_pose(config, scripts, quick)
+        elif name == 'transport':
+            results[name] = bench_transport(config, scripts, quick, baudrate, debug)
+        elif name == 'latency':
+            results[name] = bench_latency(config, scripts, quick, baudrate, debug)
+        elif name == 'flow':
+            results[name] = bench_flow(config, scripts, quick, baudrate, debug)
+    return {
+        'environment': environment_info(),
+        'parameters': {'quick': quick, 'baudrate': baudrate, 'debug': debug,
+                       'scripts_dir': os.path.relpath(scripts_dir, BASE_DIR),
+                       'config': os.path.relpath(config_file, BASE_DIR)},
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="仿生人头上位机基准测试")
+    parser.add_argument('-o', '--output', default=os.path.join(BASE_DIR, 'benchmark_results.json'),
+                        help="结果JSON文件路径")
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help="只运行指定的测试")
+    parser.add_argument('--quick', action='store_true', help="减少迭代次数，快速运行")
+    parser.add_argument('--baud', type=int, default=115200, help="模拟串口波特率")
+    parser.add_argument('--no-debug', action='store_true', help="模拟设备关闭DEBUG输出")
+    parser.add_argument('--scripts-dir', default=os.path.join(BASE_DIR, '表情脚本'))
+    parser.add_argument('--config', default=os.path.join(BASE_DIR, 'servo_config.json'))
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.only or BENCHMARKS, args.scripts_dir, args.config,
+                            quick=args.quick, baudrate=args.baud, debug=not args.no_debug)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    json.dump(report['results'], sys.stdout, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存到: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+# filename: conftest.py
+# 用途：pytest 配置
+#
+# test_config.py / test_servo_limits.py 是手动运行的检查脚本（导入时就会读配置、生成测试脚本），
+# 不作为 pytest 用例收集。
+
+collect_ignore = ["test_config.py", "test_servo_limits.py"]
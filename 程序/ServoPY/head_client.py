@@ -0,0 +1,124 @@
+# filename: head_client.py
+# 用途：head_daemon 的客户端
+#
+# 用法：
+#   python head_client.py pose 10=90 11=95       # 发送一帧姿态（通道=角度）
+#   python head_client.py script 表情脚本/02_微笑表情.txt
+#   python head_client.py expression 微笑          # 触发预编码的命名表情
+#   python head_client.py query owners           # caps / metrics / angles / clients / owners / reload ...
+#   python head_client.py stop
+#
+# 在程序中使用：
+#   with HeadClient() as head:
+#       head.pose({10: 90, 11: 95})
+
+import sys
+import json
+import socket
+import argparse
+
+from head_daemon import (FrameBuffer, pack_frame, pack_pose, parse_address, default_address,
+                         MSG_POSE, MSG_SCRIPT, MSG_QUERY, MSG_STOP, MSG_EXPRESSION, MSG_ERROR)
+
+
+class HeadError(Exception):
+    """服务端返回的错误"""
+
+
+class HeadClient:
+    """连接 head_daemon，每个请求同步等待应答"""
+
+    def __init__(self, address=None, timeout=5.0):
+        self.address = address or default_address()
+        family, addr = parse_address(self.address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(addr)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buffer = FrameBuffer()
+        self._frames = []
+        self._req_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, msg_type, payload=b''):
+        self._req_id = (self._req_id + 1) & 0xFF
+        self.sock.sendall(pack_frame(msg_type, self._req_id, payload))
+        while True:
+            while self._frames:
+                reply_type, req_id, body = self._frames.pop(0)
+                if req_id != self._req_id:
+                    continue
+                if reply_type == MSG_ERROR:
+                    raise HeadError(body.decode('utf-8', errors='replace'))
+                return json.loads(body.decode('utf-8'))
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("服务端已断开")
+            self._frames.extend(self._buffer.feed(chunk))
+
+    def pose(self, targets):
+        """发送一帧姿态 {通道: 角度}"""
+        return self.request(MSG_POSE, pack_pose(targets))
+
+    def script(self, text):
+        """在服务端播放脚本，立即返回编译结果"""
+        return self.request(MSG_SCRIPT, text.encode('utf-8'))
+
+    def expression(self, name):
+        """触发命名表情（服务端使用预编码的命令帧）"""
+        return self.request(MSG_EXPRESSION, name.encode('utf-8'))
+
+    def query(self, name):
+        return self.request(MSG_QUERY, name.encode('utf-8'))
+
+    def stop(self):
+        return self.request(MSG_STOP)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="仿生人头常驻服务客户端")
+    parser.add_argument('--socket', default=default_address(), help="服务地址")
+    sub = parser.add_subparsers(dest='command', required=True)
+    pose_parser = sub.add_parser('pose', help="发送姿态")
+    pose_parser.add_argument('targets', nargs='+', help="通道=角度")
+    script_parser = sub.add_parser('script', help="播放脚本文件")
+    script_parser.add_argument('file')
+    expression_parser = sub.add_parser('expression', help="触发命名表情")
+    expression_parser.add_argument('name')
+    query_parser = sub.add_parser('query', help="查询服务状态")
+    query_parser.add_argument('name', choices=('caps', 'metrics', 'angles', 'clients', 'deadband', 'expressions', 'owners',
+                                               'reload'))
+    sub.add_parser('stop', help="停止脚本")
+    args = parser.parse_args(argv)
+
+    with HeadClient(args.socket) as head:
+        if args.command == 'pose':
+            targets = {}
+            for item in args.targets:
+                ch, _, ang = item.partition('=')
+                targets[int(ch)] = int(ang)
+            result = head.pose(targets)
+        elif args.command == 'script':
+            with open(args.file, 'r', encoding='utf-8') as f:
+                result = head.script(f.read())
+        elif args.command == 'expression':
+            result = head.expression(args.name)
+        elif args.command == 'query':
+            result = head.query(args.name)
+        else:
+            result = head.stop()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,497 @@
+# filename: head_daemon.py
+# 用途：独占串口的常驻服务，GUI、命令行脚本和感知程序通过本地套接字共享同一个头
+#
+# 串口只打开一次（打开串口会让ESP32重启，需要2秒以上），各客户端通过
+# Unix 域套接字发送姿态、脚本和查询请求。不支持 AF_UNIX 的系统使用
+# 127.0.0.1 上的 TCP 端口（地址写作 "tcp:127.0.0.1:8765"）。
+#
+# 帧格式（小端）：
+#   长度(uint16) 类型(uint8) 请求号(uint8) 内容(长度字节)
+#   POSE   内容为若干 (通道uint8, 角度uint8)
+#   SCRIPT 内容为 UTF-8 脚本文本，服务端编译后在后台播放
+#   QUERY  内容为查询名：caps / metrics / angles / clients / deadband / expressions / owners / reload
+#   STOP   停止正在播放的脚本
+#   EXPRESSION 内容为表情名（中性/微笑/...），使用 pose_cache 中预编码的一帧
+# 每个请求都有一个同请求号的 REPLY（内容为 JSON）或 ERROR（内容为错误文本）。
+#
+# 仲裁：每个客户端只保留最新的一帧待发送姿态，仲裁线程按轮转顺序
+# 每次从一个客户端取一帧交给传输层，发送队列空出后才取下一帧，
+# 因此高频发送的客户端不会挤占其他客户端。脚本播放也作为一个客户端参与轮转。
+# 客户端姿态先经过死区滤波（servo_deadband），感知输入的 ±1° 抖动不会写到串口；
+# 脚本帧不经过滤波。
+# 轮转取出的姿态再经过优先级仲裁（servo_arbiter）：脚本播放期间客户端姿态（automation）
+# 不能写入脚本占用的舵机组，脚本结束或停止后释放。
+# 热加载：监视 servo_config.json 和表情脚本目录（servo_watch），修改后在后台重新编译
+# 受影响的表情和校准相关的表，完成后一次性替换，不断开串口。加载失败时继续使用原配置，
+# 结果通过 on_log 回调报告，客户端可用 QUERY reload 查询最近一次的结果。
+#
+# 用法：
+#   python head_daemon.py --port COM3
+#   python head_daemon.py --port virtual --socket /tmp/servo_head.sock
+
+import os
+import sys
+import json
+import time
+import struct
+import socket
+import argparse
+import selectors
+import tempfile
+import threading
+from collections import deque
+
+import servo_caps
+import servo_pose
+import servo_power
+import servo_trajectory
+from pose_cache import PoseCache
+from servo_arbiter import CommandArbiter
+from servo_deadband import DeadbandFilter
+from servo_watch import FileWatcher
+from servo_script import compile_script
+from servo_transport import DEFAULT_RECONCILE_INTERVAL, REJECTED, ServoTransport, open_serial_port
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+HEADER = struct.Struct('<HBB')
+MAX_PAYLOAD = 0xFFFF
+
+MSG_POSE = 0x01
+MSG_SCRIPT = 0x02
+MSG_QUERY = 0x03
+MSG_STOP = 0x04
+MSG_EXPRESSION = 0x05
+MSG_REPLY = 0x80
+MSG_ERROR = 0x81
+
+SCRIPT_CLIENT = 0  # 脚本播放在仲裁中使用的客户端号
+
+
+def default_address():
+    if hasattr(socket, 'AF_UNIX'):
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+        return os.path.join(runtime_dir, 'servo_head.sock')
+    return 'tcp:127.0.0.1:8765'
+
+
+def parse_address(address):
+    """返回 (地址族, 套接字地址)"""
+    if address.startswith('tcp:'):
+        host, _, port = address[4:].rpartition(':')
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, address
+
+
+def pack_frame(msg_type, req_id, payload=b''):
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"帧内容过长: {len(payload)} 字节")
+    return HEADER.pack(len(payload), msg_type, req_id & 0xFF) + payload
+
+
+def pack_pose(targets):
+    """{通道: 角度} 或 [(通道, 角度), ...] 编码为 POSE 内容"""
+    items = targets.items() if isinstance(targets, dict) else targets
+    return b''.join(struct.pack('BB', int(ch), max(0, min(180, int(ang)))) for ch, ang in items)
+
+
+def unpack_pose(payload):
+    return {payload[i]: payload[i + 1] for i in range(0, len(payload) - 1, 2)}
+
+
+class FrameBuffer:
+    """累积收到的字节，切分出完整的帧"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def feed(self, chunk):
+        self.data += chunk
+        frames = []
+        while len(self.data) >= HEADER.size:
+            length, msg_type, req_id = HEADER.unpack_from(self.data)
+            end = HEADER.size + length
+            if len(self.data) < end:
+                break
+            frames.append((msg_type, req_id, bytes(self.data[HEADER.size:end])))
+            del self.data[:end]
+        return frames
+
+
+class _Client:
+    def __init__(self, client_id, sock):
+        self.id = client_id
+        self.sock = sock
+        self.inbuf = FrameBuffer()
+        self.outbuf = bytearray()
+
+
+class HeadDaemon:
+    """独占串口、为多个本地客户端服务"""
+
+    def __init__(self, transport, config, caps=None, address=None, on_log=None):
+        """
+        Args:
+            transport: 已启动的 ServoTransport
+            config: 舵机配置（用于限位和脚本编译）
+            caps: servo_caps.negotiate 的结果
+            address: 监听地址（Unix 套接字路径或 "tcp:host:port"）
+            on_log: 运行消息的回调 on_log(消息, 级别)，级别为 "INFO" / "ERROR"，在产生消息的线程中调用
+        """
+        self.transport = transport
+        self.config = config
+        self.caps = caps or dict(servo_caps.LEGACY_CAPS)
+        self.options = servo_caps.protocol_options(self.caps)
+        self.address = address or default_address()
+        self.on_log = on_log
+        self.reload_status = None
+        self.angles = {}
+        self.power = servo_power.PowerScheduler(config)
+        self.deadband = DeadbandFilter(config)
+        self.poses = PoseCache(config)
+        self.commands = CommandArbiter(transport, config, default_source='automation',
+                                       use_batch=self.options['use_batch'],
+                                       use_jaw_sync=self.options['use_jaw_sync'])
+
+        self._selector = selectors.DefaultSelector()
+        self._server = None
+        self._clients = {}
+        self._next_client_id = SCRIPT_CLIENT + 1
+        self._running = False
+
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._encoded = {}  # 客户端号 -> 待发送姿态的预编码字节（表情）
+        self._ready = deque()
+        self._arbiter = None
+        self._script_stop = threading.Event()
+        self._script_thread = None
+        self._config_path = None
+        self._watcher = None
+
+    def log(self, message, level="INFO"):
+        if self.on_log is not None:
+            self.on_log(message, level)
+
+    # ---------------- 仲裁 ----------------
+
+    def submit(self, client_id, targets, encoded=None):
+        """提交客户端的一帧姿态（同一客户端未发送的旧姿态被替换）
+
+        Args:
+            encoded: targets 预编码的命令字节；与未发送的旧姿态合并后失效
+        """
+        with self._cond:
+            self._encoded.pop(client_id, None)
+            if client_id in self._pending:
+                self._pending[client_id].update(targets)
+                self.transport.metrics.record_coalesced()
+            else:
+                self._pending[client_id] = dict(targets)
+                self._ready.append(client_id)
+                if encoded is not None:
+                    self._encoded[client_id] = encoded
+            self._cond.notify_all()
+
+    def _arbiter_loop(self):
+        while True:
+            with self._cond:
+                while self._running and not self._ready:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                client_id = self._ready.popleft()
+                targets = self._pending.pop(client_id)
+                encoded = self._encoded.pop(client_id, None)
+                self._cond.notify_all()
+            source = 'script' if client_id == SCRIPT_CLIENT else 'automation'
+            if not self.transport.wait_queue_below(1):
+                return
+            # 大幅度动作按供电预算错开到几个PWM周期，期间到达的新姿态在 _pending 中合并
+            start = time.monotonic()
+            parts = self.power.stagger(targets, start * 1000.0)
+            for offset_ms, part in parts:
+                wait = start + offset_ms / 1000.0 - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                if (encoded is not None and len(parts) == 1
+                        and all(self.angles.get(ch) != angle for ch, angle in part.items())):
+                    # 不需要错开、且每个通道都有变化的表情直接写出预编码的一帧，否则只发送变化的通道
+                    record = self.commands.send(encoded, source=source)
+                else:
+                    record = self.commands.send_frame(part, delta=True, source=source)
+                if record.status == REJECTED:
+                    continue
+                # 部分舵机组被脚本占用时只记录实际发出的通道
+                part = {ch: angle for ch, angle in part.items() if self.commands.owner(ch) == source}
+                # angles 只在仲裁线程中修改，其他线程在 _cond 内读取
+                with self._cond:
+                    self.angles.update(part)
+                    self.deadband.update(part)
+
+    # ---------------- 脚本播放 ----------------
+
+    def play_script(self, text):
+        self.stop_script()
+        timeline = compile_script(text, self.config)
+        with self._cond:
+            initial = dict(self.angles)
+        timeline = servo_trajectory.limit_timeline(timeline, self.config, initial=initial)
+        self._script_stop.clear()
+        self._script_thread = threading.Thread(target=self._play, args=(timeline,), daemon=True)
+        self._script_thread.start()
+        return timeline
+
+    def _play(self, timeline):
+        start = time.monotonic()
+        for frame in timeline:
+            wait = start + frame.time_ms / 1000.0 - time.monotonic()
+            if wait > 0 and self._script_stop.wait(wait):
+                return
+            if self._script_stop.is_set():
+                return
+            self.submit(SCRIPT_CLIENT, frame.targets)
+        # 最后一帧交给传输层后才释放脚本占用的舵机组
+        with self._cond:
+            while self._running and SCRIPT_CLIENT in self._pending and not self._script_stop.is_set():
+                self._cond.wait(0.1)
+        self.commands.release('script')
+
+    def stop_script(self):
+        self._script_stop.set()
+        thread = self._script_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=1)
+        self._script_thread = None
+        with self._cond:
+            if self._pending.pop(SCRIPT_CLIENT, None) is not None:
+                self._ready.remove(SCRIPT_CLIENT)
+        self.commands.release('script')
+
+    # ---------------- 热加载 ----------------
+
+    def watch(self, config_path):
+        """监视配置文件和表情脚本目录，变化后自动 reload()"""
+        self._config_path = os.path.abspath(config_path)
+        self._watcher = FileWatcher([self._config_path, self.poses.script_dir], self.reload).start()
+        return self._watcher
+
+    def reload(self, changed=()):
+        """重新读取配置并重新编译受影响的表情，全部完成后一次性替换（在监视线程中调用）"""
+        start = time.perf_counter()
+        config = self.config
+        if self._config_path in changed:
+            try:
+                with open(self._config_path, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+            except (OSError, ValueError) as e:
+                self.reload_status = {'ok': False, 'error': str(e), 'time': time.time()}
+                self.log(f"重新加载配置失败，继续使用原配置: {e}", "ERROR")
+                return
+        compiled = self.poses.reload(config, self.options['use_batch'], self.options['use_jaw_sync'])
+        if config is not self.config:
+            power = servo_power.PowerScheduler(config)
+            deadband = DeadbandFilter(config)
+            with self._cond:
+                power.reset(self.power.positions)
+                deadband.update(self.deadband.output)
+                self.config, self.power, self.deadband = config, power, deadband
+            self.commands.set_config(config)
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        self.reload_status = {'ok': True, 'compiled': len(compiled), 'elapsed_ms': round(elapsed_ms, 1),
+                              'time': time.time()}
+        what = "配置和表情" if self._config_path in changed else "表情"
+        self.log(f"已重新加载{what}（重新编译 {len(compiled)} 个），用时 {elapsed_ms:.1f}ms")
+
+    # ---------------- 请求处理 ----------------
+
+    def handle_request(self, client_id, msg_type, payload):
+        """处理一个请求，返回 (应答类型, 应答内容)"""
+        try:
+            if msg_type == MSG_POSE:
+                targets = {ch: int(servo_pose.clamp_servo_angle(self.config, ch, ang))
+                           for ch, ang in unpack_pose(payload).items() if 0 <= ch < 16}
+                with self._cond:
+                    targets = self.deadband.filter(targets)
+                if targets:
+                    self.submit(client_id, targets)
+                result = {'queued': len(targets)}
+            elif msg_type == MSG_SCRIPT:
+                timeline = self.play_script(payload.decode('utf-8'))
+                result = {'frames': len(timeline), 'duration_ms': timeline.duration_ms,
+                          'warnings': timeline.warnings}
+            elif msg_type == MSG_QUERY:
+                result = self.query(payload.decode('utf-8').strip())
+            elif msg_type == MSG_EXPRESSION:
+                pose = self.poses.get(payload.decode('utf-8').strip(),
+                                      self.options['use_batch'], self.options['use_jaw_sync'])
+                self.submit(client_id, pose.targets, pose.frame)
+                result = {'queued': len(pose.targets), 'bytes': len(pose.frame)}
+            elif msg_type == MSG_STOP:
+                self.stop_script()
+                result = {'stopped': True}
+            else:
+                return MSG_ERROR, f"未知请求类型: {msg_type}".encode('utf-8')
+        except Exception as e:
+            return MSG_ERROR, str(e).encode('utf-8')
+        return MSG_REPLY, json.dumps(result, ensure_ascii=False).encode('utf-8')
+
+    def query(self, name):
+        if name == 'caps':
+            return self.caps
+        if name == 'metrics':
+            return self.transport.metrics.snapshot()
+        if name == 'angles':
+            with self._cond:
+                return {str(ch): ang for ch, ang in sorted(self.angles.items())}
+        if name == 'expressions':
+            return {'names': self.poses.names(), **self.poses.stats()}
+        if name == 'owners':
+            return {'owners': self.commands.ownership(), 'preempted': self.commands.preempted,
+                    'rejected': self.commands.rejected}
+        if name == 'deadband':
+            with self._cond:
+                return self.deadband.stats()
+        if name == 'clients':
+            return {'clients': len(self._clients)}
+        if name == 'reload':
+            return {'watching': self._watcher is not None, 'last': self.reload_status}
+        raise ValueError(f"未知查询: {name}")
+
+    # ---------------- 套接字 ----------------
+
+    def start(self):
+        family, addr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)  # 上次异常退出留下的套接字文件
+        self._server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(addr)
+        self._server.listen(16)
+        self._server.setblocking(False)
+        self._selector.register(self._server, selectors.EVENT_READ)
+        self._running = True
+        self._arbiter = threading.Thread(target=self._arbiter_loop, name="head-arbiter", daemon=True)
+        self._arbiter.start()
+        return self
+
+    def serve_forever(self):
+        while self._running:
+            for key, events in self._selector.select(timeout=0.5):
+                if key.fileobj is self._server:
+                    self._accept()
+                else:
+                    client = key.data
+                    if events & selectors.EVENT_READ:
+                        self._read(client)
+                    if events & selectors.EVENT_WRITE and client.id in self._clients:
+                        self._flush(client)
+
+    def stop(self):
+        self._running = False
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+        self.stop_script()
+        with self._cond:
+            self._cond.notify_all()
+        for client in list(self._clients.values()):
+            self._drop(client)
+        if self._server is not None:
+            self._selector.unregister(self._server)
+            self._server.close()
+            self._server = None
+            family, addr = parse_address(self.address)
+            if family == socket.AF_UNIX and os.path.exists(addr):
+                os.unlink(addr)
+
+    def _accept(self):
+        sock, _ = self._server.accept()
+        sock.setblocking(False)
+        client = _Client(self._next_client_id, sock)
+        self._next_client_id += 1
+        self._clients[client.id] = client
+        self._selector.register(sock, selectors.EVENT_READ, client)
+
+    def _read(self, client):
+        try:
+            chunk = client.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            chunk = b''
+        if not chunk:
+            self._drop(client)
+            return
+        for msg_type, req_id, payload in client.inbuf.feed(chunk):
+            reply_type, reply = self.handle_request(client.id, msg_type, payload)
+            client.outbuf += pack_frame(reply_type, req_id, reply)
+        self._flush(client)
+
+    def _flush(self, client):
+        try:
+            sent = client.sock.send(client.outbuf) if client.outbuf else 0
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._drop(client)
+            return
+        del client.outbuf[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbuf else 0)
+        self._selector.modify(client.sock, events, client)
+
+    def _drop(self, client):
+        # 已提交但尚未发送的姿态仍然发送（客户端可能发完即断开）
+        self._clients.pop(client.id, None)
+        try:
+            self._selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+
+
+def print_log(message, level="INFO"):
+    print(message, file=sys.stderr if level == "ERROR" else sys.stdout, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="仿生人头串口常驻服务")
+    parser.add_argument('--port', required=True, help="串口名，或 virtual 使用本地模拟设备")
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--socket', default=default_address(), help="监听地址（套接字路径或 tcp:host:port）")
+    parser.add_argument('--config', default=os.path.join(BASE_DIR, 'servo_config.json'))
+    parser.add_argument('--window', type=int, default=4, help="最多未应答的命令数")
+    parser.add_argument('--no-watch', action='store_true', help="不监视配置和表情脚本的修改")
+    parser.add_argument('--refresh', action='store_true', help="重新探测设备功能（固件升级后使用）")
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    serial_port = open_serial_port(args.port, args.baud, timeout=0.2)
+    if not args.port.startswith('virtual'):
+        time.sleep(2)  # 等待ESP32重启
+    caps = servo_caps.negotiate(serial_port, refresh=args.refresh)
+    print(f"设备功能: {servo_caps.describe(caps)}")
+    options = servo_caps.protocol_options(caps)
+    transport = ServoTransport(serial_port, window=args.window, jaw_ack=options['jaw_ack'],
+                               reconcile_interval=DEFAULT_RECONCILE_INTERVAL if options['status'] else None).start()
+    daemon = HeadDaemon(transport, config, caps, args.socket, on_log=print_log).start()
+    if not args.no_watch:
+        watcher = daemon.watch(args.config)
+        print(f"监视配置和表情脚本（{watcher.backend}）")
+    print(f"正在监听: {args.socket}")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop()
+        transport.close()
+        serial_port.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
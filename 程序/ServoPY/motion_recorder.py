@@ -0,0 +1,237 @@
+# filename: motion_recorder.py
+# 用途：录制手动拖动滑条产生的舵机动作，保存为紧凑的二进制文件并按原始时间回放
+#
+# 录制的是滑条发出的单个通道目标（舵机号, 角度）：滑条不做分组联动，只移动自己的舵机，
+# 下颚滑条（记录为舵机0）按 JS 命令同时移动舵机0/1。回放时按同样的方式发送
+# （event_targets），并按校准的最小/最大值限制，不经过 group_pose 展开，
+# 拖动联动组中的单个舵机不会在回放时带动另一个。
+# 录制缓冲区使用 array（每个事件 8+1+2 字节），record() 只做三次追加，
+# 在界面线程中调用的开销约1微秒。
+#
+# 文件格式：
+#   .srec  magic "SREC"(4) 版本(uint16) 保留(uint16) 事件数(uint32) 录制开始时间(double, Unix时间)
+#          时间偏移 float64[事件数]（秒） 舵机号 uint8[事件数] 角度 uint16[事件数]（均为小端）
+#   .npz   安装了 numpy 时可用，数组名 t / servo / angle / start_wall
+#
+# 用法：
+#   python motion_recorder.py info 录制.srec
+#   python motion_recorder.py replay 录制.srec --port virtual [--speed 1.0]
+
+import os
+import sys
+import time
+import array
+import struct
+import argparse
+
+import servo_pose
+from servo_script import Frame, Timeline
+
+MAGIC = b"SREC"
+VERSION = 1
+HEADER = struct.Struct('<4sHHId')
+
+
+def event_targets(config, servo_id, angle):
+    """一个录制事件在设备上产生的通道目标，与滑条发送的相同
+
+    Returns:
+        [(通道, 角度), ...]
+    """
+    if servo_id == 0 or servo_id == 1:
+        return servo_pose.jaw_pose(servo_pose.clamp_servo_angle(config, 0, angle))
+    return [(servo_id, servo_pose.clamp_servo_angle(config, servo_id, angle))]
+
+
+class Recording:
+    """一段录制：按时间顺序排列的 (时间偏移秒, 舵机号, 角度) 事件"""
+
+    def __init__(self, times=None, servos=None, angles=None, start_wall=0.0):
+        self.times = times if times is not None else array.array('d')
+        self.servos = servos if servos is not None else array.array('B')
+        self.angles = angles if angles is not None else array.array('H')
+        self.start_wall = start_wall
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def duration(self):
+        return self.times[-1] if self.times else 0.0
+
+    def events(self):
+        return zip(self.times, self.servos, self.angles)
+
+    def save(self, file_path):
+        if file_path.lower().endswith('.npz'):
+            self._save_npz(file_path)
+            return
+        times, servos, angles = array.array('d', self.times), self.servos, array.array('H', self.angles)
+        if sys.byteorder == 'big':
+            times.byteswap()
+            angles.byteswap()
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, 0, len(self), self.start_wall))
+            f.write(times.tobytes())
+            f.write(servos.tobytes())
+            f.write(angles.tobytes())
+        os.replace(tmp_path, file_path)
+
+    def _save_npz(self, file_path):
+        import numpy as np
+        np.savez_compressed(file_path,
+                            t=np.frombuffer(self.times, dtype=np.float64),
+                            servo=np.frombuffer(self.servos, dtype=np.uint8),
+                            angle=np.frombuffer(self.angles, dtype=np.uint16),
+                            start_wall=np.float64(self.start_wall))
+
+    @classmethod
+    def load(cls, file_path):
+        if file_path.lower().endswith('.npz'):
+            import numpy as np
+            with np.load(file_path) as data:
+                return cls(array.array('d', data['t'].astype('<f8').tobytes()),
+                           array.array('B', data['servo'].astype(np.uint8).tobytes()),
+                           array.array('H', data['angle'].astype('<u2').tobytes()),
+                           float(data['start_wall']))
+        with open(file_path, 'rb') as f:
+            magic, version, _, count, start_wall = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"不是动作录制文件: {file_path}")
+            times = array.array('d')
+            times.frombytes(f.read(8 * count))
+            servos = array.array('B')
+            servos.frombytes(f.read(count))
+            angles = array.array('H')
+            angles.frombytes(f.read(2 * count))
+        if len(times) != count or len(servos) != count or len(angles) != count:
+            raise ValueError(f"录制文件不完整: {file_path}")
+        if sys.byteorder == 'big':
+            times.byteswap()
+            angles.byteswap()
+        return cls(times, servos, angles, start_wall)
+
+    def to_timeline(self, config):
+        """转换为 Timeline（每个事件一帧），可交给 servo_fleet / head_daemon 等调度器播放"""
+        frames = [Frame(t * 1000.0, tuple(event_targets(config, servo_id, angle)), ())
+                  for t, servo_id, angle in self.events()]
+        return Timeline(frames, self.duration * 1000.0)
+
+
+class MotionRecorder:
+    """滑条动作录制器"""
+
+    def __init__(self):
+        self.active = False
+        self._start = 0.0
+        self._recording = Recording()
+
+    def start(self):
+        self._recording = Recording(start_wall=time.time())
+        self._start = time.perf_counter()
+        self.active = True
+
+    def record(self, servo_id, angle):
+        """记录一次输入变化（未在录制时直接返回）"""
+        if self.active:
+            rec = self._recording
+            rec.times.append(time.perf_counter() - self._start)
+            rec.servos.append(servo_id)
+            rec.angles.append(angle)
+
+    def stop(self):
+        self.active = False
+        return self._recording
+
+    def __len__(self):
+        return len(self._recording)
+
+
+def sleep_until(deadline, spin=0.002):
+    """睡眠到 perf_counter 时刻 deadline；最后 spin 秒忙等，避免系统定时器精度（Windows约15ms）带来的误差"""
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return
+        if remaining > spin:
+            time.sleep(remaining - spin)
+
+
+def replay(recording, send, speed=1.0, stop_event=None):
+    """按录制时的时间间隔回放
+
+    Args:
+        recording: Recording
+        send: send(舵机号, 角度) 回调
+        speed: 播放速度倍数
+        stop_event: threading.Event，置位时停止回放
+
+    Returns:
+        实际发出时刻相对计划时刻的最大延迟（秒）
+    """
+    start = time.perf_counter()
+    worst = 0.0
+    for t, servo_id, angle in recording.events():
+        due = start + t / speed
+        sleep_until(due)
+        if stop_event is not None and stop_event.is_set():
+            break
+        send(servo_id, angle)
+        worst = max(worst, time.perf_counter() - due)
+    return worst
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="滑条动作录制文件工具")
+    sub = parser.add_subparsers(dest='command', required=True)
+    info = sub.add_parser('info', help="显示录制文件信息")
+    info.add_argument('file')
+    play = sub.add_parser('replay', help="回放录制文件")
+    play.add_argument('file')
+    play.add_argument('--port', required=True, help="串口名，或 virtual")
+    play.add_argument('--refresh', action='store_true', help="重新探测设备功能（固件升级后使用）")
+    play.add_argument('--baud', type=int, default=115200)
+    play.add_argument('--speed', type=float, default=1.0)
+    play.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      'servo_config.json'))
+    args = parser.parse_args(argv)
+
+    recording = Recording.load(args.file)
+    if args.command == 'info':
+        channels = sorted(set(recording.servos))
+        print(f"事件数: {len(recording)}  时长: {recording.duration:.3f}秒  舵机: {channels}")
+        return 0
+
+    import json
+    import servo_caps
+    from servo_transport import ServoTransport, open_serial_port
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    serial_port = open_serial_port(args.port, args.baud, timeout=0.2)
+    if not args.port.startswith('virtual'):
+        time.sleep(2)  # 等待ESP32重启
+    caps = servo_caps.negotiate(serial_port, refresh=args.refresh)
+    options = servo_caps.protocol_options(caps)
+    transport = ServoTransport(serial_port, jaw_ack=options['jaw_ack']).start()
+
+    def send(servo_id, angle):
+        # 同一通道尚未写出的旧目标被新目标替换，串口跟不上时不会越来越滞后
+        targets = event_targets(config, servo_id, angle)
+        transport.send_frame(targets, ('G',) + tuple(ch for ch, _ in targets),
+                             options['use_batch'], options['use_jaw_sync'], delta=True)
+
+    try:
+        worst = replay(recording, send, args.speed)
+        transport.wait_idle(timeout=5)
+        print(f"回放完成，{len(recording)} 个事件，最大调度延迟 {worst * 1000:.2f}ms")
+        print(transport.metrics.status_text())
+    finally:
+        transport.close()
+        serial_port.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,310 @@
+# filename: pose_bus.py
+# 用途：共享内存姿态总线，多个进程（感知、对话等）直接写入舵机目标，控制循环每个周期采样一次
+#
+# 共享内存布局（小端）：
+#   总线头   magic "PBUS"(4) 版本(uint32) 槽位数(uint32) 保留(uint32)
+#   每个槽位 序号(uint32) 进程号(uint32) 通道掩码(uint32) 保留(uint32) 写入时间(double)
+#            16个目标角度(uint16) 16个通道写入时间(double)
+#
+# 每个槽位只允许一个写入者（按槽位号分配给各个生产者），用序号实现顺序锁（seqlock）：
+# 写入前序号+1（奇数表示正在写），写完再+1；读取者在序号为偶数且读取前后一致时
+# 才采用读到的数据，否则重读。写入和读取都不需要加锁，也不需要序列化/复制Python对象。
+# 控制循环把所有槽位按通道取最新写入的值合并，按校准配置（servo_config.json）的
+# 最小/最大值限制，经死区滤波（servo_deadband）去掉 ±1° 抖动后，有变化时发出一帧批量命令。
+#
+# 用法：
+#   python pose_bus.py serve --port virtual          # 创建总线并运行控制循环
+#   python pose_bus.py serve --port COM3 --config configs/hall2.json
+#   python pose_bus.py write --slot 1 10=90 11=95    # 向槽位1写入目标
+#   python pose_bus.py dump                          # 查看各槽位内容
+
+import os
+import sys
+import json
+import time
+import struct
+import signal
+import argparse
+from multiprocessing import shared_memory
+
+import servo_pose
+from servo_deadband import DEFAULT_DEADBAND_DEG, DEFAULT_HOLD_MS, DeadbandFilter
+from servo_protocol import SERVO_COUNT
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_NAME = "servo_pose_bus"
+DEFAULT_SLOTS = 8
+MAGIC = b"PBUS"
+VERSION = 1
+
+BUS_HEADER = struct.Struct('<4sIII')
+SLOT_HEADER = struct.Struct('<IIIId')
+ANGLES = struct.Struct(f'<{SERVO_COUNT}H')
+STAMPS = struct.Struct(f'<{SERVO_COUNT}d')
+SLOT_SIZE = SLOT_HEADER.size + ANGLES.size + STAMPS.size
+SEQ = struct.Struct('<I')
+
+
+def bus_size(slots):
+    return BUS_HEADER.size + slots * SLOT_SIZE
+
+
+def _attach_untracked(name):
+    """打开已有共享内存，且不让本进程退出时把它删除（Python 3.13 之前 resource_tracker 会删除）"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+        return shm
+
+
+class PoseBus:
+    """共享内存姿态缓冲区"""
+
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.buf = shm.buf
+        self.owner = owner
+        magic, version, slots, _ = BUS_HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"共享内存 {shm.name} 不是姿态总线")
+        self.slots = slots
+
+    @classmethod
+    def create(cls, name=DEFAULT_NAME, slots=DEFAULT_SLOTS):
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=bus_size(slots))
+        except FileExistsError:
+            # 上次异常退出遗留的总线
+            old = _attach_untracked(name)
+            old.close()
+            old.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=bus_size(slots))
+        shm.buf[:bus_size(slots)] = bytes(bus_size(slots))
+        BUS_HEADER.pack_into(shm.buf, 0, MAGIC, VERSION, slots, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name=DEFAULT_NAME):
+        return cls(_attach_untracked(name))
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def _offset(self, slot):
+        if not 0 <= slot < self.slots:
+            raise IndexError(f"槽位号超出范围: {slot}")
+        return BUS_HEADER.size + slot * SLOT_SIZE
+
+    def write(self, slot, targets, now=None):
+        """写入部分或全部通道的目标角度（每个槽位只能有一个写入者）
+
+        Args:
+            slot: 槽位号
+            targets: {通道: 角度}
+        """
+        now = time.time() if now is None else now
+        base = self._offset(slot)
+        buf = self.buf
+        seq, _, mask, _, _ = SLOT_HEADER.unpack_from(buf, base)
+        SEQ.pack_into(buf, base, (seq + 1) & 0xFFFFFFFF)  # 奇数：正在写入
+        angles_at = base + SLOT_HEADER.size
+        stamps_at = angles_at + ANGLES.size
+        for ch, angle in targets.items():
+            if 0 <= ch < SERVO_COUNT:
+                struct.pack_into('<H', buf, angles_at + 2 * ch, max(0, min(180, int(angle))))
+                struct.pack_into('<d', buf, stamps_at + 8 * ch, now)
+                mask |= 1 << ch
+        SLOT_HEADER.pack_into(buf, base, (seq + 1) & 0xFFFFFFFF, os.getpid(), mask, 0, now)
+        SEQ.pack_into(buf, base, (seq + 2) & 0xFFFFFFFF)
+
+    def read_slot(self, slot, retries=100):
+        """读取一个槽位的一致快照
+
+        Returns:
+            (序号, 写入时间, 通道掩码, 角度元组, 通道写入时间元组)，
+            写入者持续占用导致读不到一致数据时返回 None
+        """
+        base = self._offset(slot)
+        buf = self.buf
+        for _ in range(retries):
+            seq, _, mask, _, stamp = SLOT_HEADER.unpack_from(buf, base)
+            if seq & 1:
+                continue
+            angles = ANGLES.unpack_from(buf, base + SLOT_HEADER.size)
+            stamps = STAMPS.unpack_from(buf, base + SLOT_HEADER.size + ANGLES.size)
+            if SEQ.unpack_from(buf, base)[0] == seq:
+                return seq, stamp, mask, angles, stamps
+        return None
+
+    def sample(self, max_age=None, now=None):
+        """合并所有槽位：每个通道取最近一次写入的值
+
+        Args:
+            max_age: 忽略超过该时间（秒）未更新的通道，None 表示不限
+
+        Returns:
+            {通道: 角度}
+        """
+        now = time.time() if now is None else now
+        best = {}
+        for slot in range(self.slots):
+            snap = self.read_slot(slot)
+            if snap is None or not snap[2]:
+                continue
+            _, _, mask, angles, stamps = snap
+            for ch in range(SERVO_COUNT):
+                if not mask & (1 << ch):
+                    continue
+                if max_age is not None and now - stamps[ch] > max_age:
+                    continue
+                if ch not in best or stamps[ch] > best[ch][0]:
+                    best[ch] = (stamps[ch], angles[ch])
+        return {ch: angle for ch, (_, angle) in best.items()}
+
+
+class PoseBusLoop:
+    """控制循环：按固定频率采样总线，目标有变化时发送一帧"""
+
+    def __init__(self, bus, transport, rate_hz=50, max_age=None, use_batch=True, use_jaw_sync=True,
+                 deadband=None, config=None):
+        """
+        Args:
+            deadband: DeadbandFilter，None 表示不过滤
+            config: 舵机配置，采样到的目标按其中的最小/最大值限制
+        """
+        self.bus = bus
+        self.transport = transport
+        self.config = config or {}
+        self.period = 1.0 / rate_hz
+        self.max_age = max_age
+        self.use_batch = use_batch
+        self.use_jaw_sync = use_jaw_sync
+        self.deadband = deadband
+        self.last_sent = {}
+        self.frames_sent = 0
+        self._running = False
+
+    def tick(self):
+        # 上一帧还没写出时跳过本周期，变化会累积到下一帧，不会在队列里堆积旧姿态
+        if self.transport.queue_depth:
+            return None
+        targets = {ch: servo_pose.clamp_servo_angle(self.config, ch, angle)
+                   for ch, angle in self.bus.sample(self.max_age).items()}
+        if self.deadband is not None:
+            targets = self.deadband.filter(targets)
+        changed = {ch: a for ch, a in targets.items() if self.last_sent.get(ch) != a}
+        if not changed:
+            return None
+        self.last_sent.update(changed)
+        self.frames_sent += 1
+        return self.transport.send_frame(changed, None, self.use_batch, self.use_jaw_sync)
+
+    def run(self):
+        self._running = True
+        next_tick = time.monotonic()
+        while self._running:
+            self.tick()
+            next_tick += self.period
+            wait = next_tick - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                next_tick = time.monotonic()
+
+    def stop(self):
+        self._running = False
+
+
+def _parse_targets(items):
+    targets = {}
+    for item in items:
+        ch, _, ang = item.partition('=')
+        targets[int(ch)] = int(ang)
+    return targets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="共享内存姿态总线")
+    parser.add_argument('--name', default=DEFAULT_NAME, help="共享内存名称")
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve = sub.add_parser('serve', help="创建总线并运行控制循环")
+    serve.add_argument('--port', required=True, help="串口名，或 virtual")
+    serve.add_argument('--refresh', action='store_true', help="重新探测设备功能（固件升级后使用）")
+    serve.add_argument('--baud', type=int, default=115200)
+    serve.add_argument('--config', default=os.path.join(BASE_DIR, 'servo_config.json'),
+                       help="舵机校准配置（限制各舵机的最小/最大角度）")
+    serve.add_argument('--rate', type=float, default=50, help="采样频率（Hz）")
+    serve.add_argument('--slots', type=int, default=DEFAULT_SLOTS)
+    serve.add_argument('--max-age', type=float, default=None, help="忽略超过该秒数未更新的通道")
+    serve.add_argument('--deadband', type=float, default=DEFAULT_DEADBAND_DEG, help="死区（度），0表示不过滤")
+    serve.add_argument('--hold', type=float, default=DEFAULT_HOLD_MS, help="小幅变化保持多久后输出（毫秒）")
+    write = sub.add_parser('write', help="写入目标角度")
+    write.add_argument('--slot', type=int, default=1)
+    write.add_argument('targets', nargs='+', help="通道=角度")
+    sub.add_parser('dump', help="显示各槽位内容")
+    args = parser.parse_args(argv)
+
+    if args.command == 'write':
+        bus = PoseBus.attach(args.name)
+        bus.write(args.slot, _parse_targets(args.targets))
+        bus.close()
+        return 0
+
+    if args.command == 'dump':
+        bus = PoseBus.attach(args.name)
+        for slot in range(bus.slots):
+            snap = bus.read_slot(slot)
+            if snap and snap[2]:
+                _, stamp, mask, angles, _ = snap
+                channels = {ch: angles[ch] for ch in range(SERVO_COUNT) if mask & (1 << ch)}
+                print(f"槽位{slot} 序号{snap[0]} 更新于{time.time() - stamp:.2f}秒前: "
+                      f"{json.dumps(channels)}")
+        print(f"合并结果: {json.dumps(bus.sample())}")
+        bus.close()
+        return 0
+
+    import servo_caps
+    from servo_transport import ServoTransport, open_serial_port
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    serial_port = open_serial_port(args.port, args.baud, timeout=0.2)
+    if not args.port.startswith('virtual'):
+        time.sleep(2)  # 等待ESP32重启
+    caps = servo_caps.negotiate(serial_port, refresh=args.refresh)
+    options = servo_caps.protocol_options(caps)
+    transport = ServoTransport(serial_port, jaw_ack=options['jaw_ack']).start()
+    bus = PoseBus.create(args.name, args.slots)
+    deadband = DeadbandFilter(config, args.deadband, args.hold) if args.deadband else None
+    loop = PoseBusLoop(bus, transport, args.rate, args.max_age,
+                       options['use_batch'], options['use_jaw_sync'], deadband, config)
+    print(f"姿态总线 {args.name} 已创建（{args.slots} 个槽位），采样频率 {args.rate}Hz")
+    # 作为后台服务被终止时同样删除共享内存
+    signal.signal(signal.SIGTERM, lambda *_: loop.stop())
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if deadband is not None:
+            stats = deadband.stats()
+            print(f"死区滤波: 发出 {stats['passed']} 次，省去 {stats['suppressed']} 次"
+                  f"（{stats['saved_ratio'] * 100:.1f}%）")
+        bus.close()
+        transport.close()
+        serial_port.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
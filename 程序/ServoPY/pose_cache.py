@@ -0,0 +1,183 @@
+# filename: pose_cache.py
+# 用途：命名表情姿态的预编码缓存，触发表情时直接写出已编码好的串口字节
+#
+# 表情脚本目录中 "NN_<名称>表情.txt" 形式的脚本作为命名姿态（中性、微笑、惊讶、悲伤、愤怒……），
+# 姿态取脚本结束时的各通道角度。第一次使用时解析、按校准限位和联动关系编译并编码成一帧
+# 命令字节，之后同一姿态直接返回缓存的字节，不再解析脚本、计算镜像角度和格式化字符串。
+# 缓存按 (姿态名, 脚本修改时间, 校准哈希, 编码方式) 查找，修改校准或脚本后自动重新编译，
+# 超过容量时淘汰最久未使用的条目。reload() 在后台只重新编译受影响的姿态，完成后一次性
+# 替换整个缓存，用于配置/脚本热加载（servo_watch）。
+#
+# 用法：
+#   python pose_cache.py                          # 列出命名姿态及编码结果
+#   python pose_cache.py 微笑 --port virtual       # 发送一个表情
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from collections import OrderedDict, namedtuple
+
+from servo_protocol import encode_frame
+from servo_script import compile_script, load_script_file
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SCRIPT_DIR = os.path.join(BASE_DIR, "表情脚本")
+DEFAULT_MAXSIZE = 32
+POSE_SUFFIX = "表情.txt"
+
+# targets: ((通道, 角度), ...)；frame: 写入串口的字节
+CachedPose = namedtuple('CachedPose', 'name targets frame')
+
+
+def calibration_hash(config):
+    """舵机配置的哈希，配置任何一项变化都会使缓存失效"""
+    data = json.dumps(config, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+def pose_scripts(script_dir=DEFAULT_SCRIPT_DIR):
+    """命名姿态 -> 脚本路径，例如 {'微笑': '.../02_微笑表情.txt'}"""
+    poses = {}
+    if not os.path.isdir(script_dir):
+        return poses
+    for file_name in sorted(os.listdir(script_dir)):
+        if not file_name.endswith(POSE_SUFFIX):
+            continue
+        name = file_name[:-len(POSE_SUFFIX)]
+        prefix, sep, rest = name.partition('_')
+        if sep and prefix.isdigit():
+            name = rest
+        if name:
+            poses[name] = os.path.join(script_dir, file_name)
+    return poses
+
+
+class PoseCache:
+    """命名姿态的 LRU 缓存"""
+
+    def __init__(self, config, script_dir=DEFAULT_SCRIPT_DIR, maxsize=DEFAULT_MAXSIZE):
+        self.script_dir = script_dir
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._paths = pose_scripts(script_dir)
+        self.hits = 0
+        self.misses = 0
+        self.set_config(config)
+
+    def set_config(self, config):
+        """更新校准配置；旧校准的条目不再命中，逐渐被淘汰"""
+        self.config = config
+        self.calibration = calibration_hash(config)
+
+    def names(self):
+        self._paths = pose_scripts(self.script_dir)
+        return list(self._paths)
+
+    def get(self, name, use_batch=True, use_jaw_sync=True):
+        """返回 CachedPose，姿态不存在时抛出 ValueError"""
+        path = self._paths.get(name)
+        if path is None:
+            # 可能是新加的脚本，重新扫描目录
+            self._paths = pose_scripts(self.script_dir)
+            path = self._paths.get(name)
+            if path is None:
+                raise ValueError(f"没有名为 {name} 的表情")
+        key = (name, os.path.getmtime(path), self.calibration, bool(use_batch), bool(use_jaw_sync))
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = self._compile(name, path, self.config, use_batch, use_jaw_sync)
+        self._entries[key] = entry
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    def _compile(self, name, path, config, use_batch, use_jaw_sync):
+        timeline = compile_script(load_script_file(path), config)
+        targets = tuple((ch, angle) for ch, angle in enumerate(timeline.final_pose()) if angle is not None)
+        return CachedPose(name, targets, encode_frame(targets, use_batch, use_jaw_sync))
+
+    def reload(self, config=None, use_batch=True, use_jaw_sync=True):
+        """按新配置和脚本重建缓存：未变化的姿态沿用原条目，其余重新编译，最后一次性替换
+
+        Returns:
+            重新编译的姿态名列表
+        """
+        config = self.config if config is None else config
+        calibration = calibration_hash(config)
+        paths = pose_scripts(self.script_dir)
+        entries = OrderedDict()
+        compiled = []
+        for name, path in list(paths.items())[:self.maxsize]:
+            try:
+                key = (name, os.path.getmtime(path), calibration, bool(use_batch), bool(use_jaw_sync))
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._compile(name, path, config, use_batch, use_jaw_sync)
+                    compiled.append(name)
+            except (OSError, ValueError) as e:
+                print(f"编译表情 {name} 失败: {e}")
+                continue
+            entries[key] = entry
+        self._paths, self._entries = paths, entries
+        self.config, self.calibration = config, calibration
+        return compiled
+
+    def warm(self, use_batch=True, use_jaw_sync=True):
+        """预先编译全部命名姿态"""
+        for name in self.names():
+            self.get(name, use_batch, use_jaw_sync)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="命名表情姿态的预编码缓存")
+    parser.add_argument('name', nargs='?', help="要发送的表情名，不指定时列出全部姿态")
+    parser.add_argument('--port', help="串口名，或 virtual")
+    parser.add_argument('--refresh', action='store_true', help="重新探测设备功能（固件升级后使用）")
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--config', default=os.path.join(BASE_DIR, 'servo_config.json'))
+    parser.add_argument('--script-dir', default=DEFAULT_SCRIPT_DIR)
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    cache = PoseCache(config, args.script_dir)
+
+    if not args.name:
+        for name in cache.names():
+            entry = cache.get(name)
+            start = time.perf_counter()
+            cache.get(name)
+            hit_us = (time.perf_counter() - start) * 1e6
+            print(f"{name}: {len(entry.frame)} 字节  命中耗时 {hit_us:.1f}µs  {entry.frame.decode().strip()}")
+        return 0
+    if not args.port:
+        parser.error("发送表情需要指定 --port")
+
+    import servo_caps
+    from servo_transport import open_serial_port
+
+    serial_port = open_serial_port(args.port, args.baud, timeout=0.5)
+    try:
+        if not args.port.startswith('virtual'):
+            time.sleep(2)  # 等待ESP32重启
+        options = servo_caps.protocol_options(servo_caps.negotiate(serial_port, refresh=args.refresh))
+        entry = cache.get(args.name, options['use_batch'], options['use_jaw_sync'])
+        serial_port.write(entry.frame)
+        print(f"已发送 {args.name}: {entry.frame.decode().strip()}")
+    finally:
+        serial_port.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+# filename: rebase_expression_scripts.py
+# 用途：舵机重新标定（最小/中间/最大值变化）后，把已有表情脚本中的角度
+#       从旧标定映射到新标定，保持每个角度相对最小值/中间值/最大值的位置，
+#       而不是像 update_expression_scripts.py 那样全部覆盖成中间值。
+#
+# 用法：
+#   python rebase_expression_scripts.py 旧配置.json 新配置.json [--dir 表情脚本] [--dry-run] [--jobs N]
+#
+# 例如先用 recalculate_mid_values.py 生成 servo_config_updated.json，然后：
+#   python rebase_expression_scripts.py servo_config.json servo_config_updated.json --dry-run
+
+import os
+import re
+import sys
+import json
+import difflib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+# 匹配舵机命令行，保留行首空白、行尾注释和换行符
+SERVO_LINE_RE = re.compile(r'^(\s*舵机(\d+)\s+)(-?\d+)(.*)$', re.DOTALL)
+
+
+def load_calibration(config_file_path):
+    """读取配置文件，返回 {舵机ID: (最小值, 中间值, 最大值)}
+
+    键名兼容规则与 ZS_BOX.load_config 一致：优先使用 min/max，
+    不存在时回退到旧的 init/end 键名。
+    """
+    with open(config_file_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    calibration = {}
+    for i in range(16):
+        smin = config.get(f'servo_{i}_min', config.get(f'servo_{i}_init', 90))
+        smax = config.get(f'servo_{i}_max', config.get(f'servo_{i}_end', 90))
+        smid = config.get(f'servo_{i}_mid', 90)
+        if smin > smax:
+            smin, smax = smax, smin
+        calibration[i] = (smin, smid, smax)
+    return calibration
+
+
+def rebase_angle(angle, old_cal, new_cal):
+    """把一个角度从旧标定映射到新标定
+
+    以中间值为分界，分别在 [最小值, 中间值] 和 [中间值, 最大值] 两段内做线性映射，
+    这样中间值始终对应中间值，极限值始终对应极限值。
+    """
+    old_min, old_mid, old_max = old_cal
+    new_min, new_mid, new_max = new_cal
+
+    if angle <= old_mid:
+        span = old_mid - old_min
+        if span <= 0:
+            # 旧标定下半段退化，只平移中间值
+            new_angle = new_mid + (angle - old_mid)
+        else:
+            new_angle = new_mid + (angle - old_mid) * (new_mid - new_min) / span
+    else:
+        span = old_max - old_mid
+        if span <= 0:
+            new_angle = new_mid + (angle - old_mid)
+        else:
+            new_angle = new_mid + (angle - old_mid) * (new_max - new_mid) / span
+
+    # 确保结果在新标定的安全范围内
+    new_angle = max(new_min, min(new_max, new_angle))
+    new_angle = max(0, min(180, new_angle))
+    return int(round(new_angle))
+
+
+def rebase_lines(lines, old_calibration, new_calibration):
+    """逐行映射脚本内容（生成器），非舵机行原样输出"""
+    for line in lines:
+        match = SERVO_LINE_RE.match(line)
+        if match:
+            servo_id = int(match.group(2))
+            if servo_id in old_calibration and servo_id in new_calibration:
+                angle = int(match.group(3))
+                new_angle = rebase_angle(angle, old_calibration[servo_id], new_calibration[servo_id])
+                if new_angle != angle:
+                    line = f"{match.group(1)}{new_angle}{match.group(4)}"
+        yield line
+
+
+def rebase_script_file(file_path, old_calibration, new_calibration, dry_run=False):
+    """映射单个脚本文件
+
+    Returns:
+        (文件路径, 变化行数, unified diff 文本)
+    """
+    # newline='' 保留原始换行符（表情脚本使用CRLF）
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        old_lines = f.readlines()
+
+    new_lines = list(rebase_lines(old_lines, old_calibration, new_calibration))
+    changed = sum(1 for a, b in zip(old_lines, new_lines) if a != b)
+
+    diff = ''
+    if changed:
+        name = os.path.basename(file_path)
+        diff = ''.join(difflib.unified_diff(
+            [l.rstrip('\r\n') + '\n' for l in old_lines],
+            [l.rstrip('\r\n') + '\n' for l in new_lines],
+            fromfile=f"a/{name}", tofile=f"b/{name}"))
+
+        if not dry_run:
+            # 先写临时文件再替换，避免中途出错留下半个脚本
+            tmp_path = file_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                f.writelines(new_lines)
+            os.replace(tmp_path, file_path)
+
+    return file_path, changed, diff
+
+
+def _rebase_worker(args):
+    return rebase_script_file(*args)
+
+
+def rebase_all_scripts(scripts_dir, old_config, new_config, dry_run=False, jobs=None):
+    """并行映射目录下所有 .txt 表情脚本
+
+    Returns:
+        [(文件路径, 变化行数, diff文本), ...]，按文件名排序
+    """
+    old_calibration = load_calibration(old_config)
+    new_calibration = load_calibration(new_config)
+
+    script_files = sorted(
+        os.path.join(scripts_dir, f) for f in os.listdir(scripts_dir) if f.endswith('.txt'))
+    tasks = [(path, old_calibration, new_calibration, dry_run) for path in script_files]
+
+    if jobs == 1 or len(tasks) <= 1:
+        return [_rebase_worker(task) for task in tasks]
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_rebase_worker, tasks))
+
+
+def main(argv=None):
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="将表情脚本从旧舵机标定映射到新标定")
+    parser.add_argument('old_config', help="旧的舵机配置文件")
+    parser.add_argument('new_config', help="新的舵机配置文件")
+    parser.add_argument('--dir', default=os.path.join(base_dir, '表情脚本'), help="表情脚本目录")
+    parser.add_argument('--dry-run', action='store_true', help="只显示差异，不写入文件")
+    parser.add_argument('--jobs', type=int, default=None, help="并行进程数（默认CPU核数）")
+    args = parser.parse_args(argv)
+
+    results = rebase_all_scripts(args.dir, args.old_config, args.new_config,
+                                 dry_run=args.dry_run, jobs=args.jobs)
+
+    total_changed = 0
+    changed_files = 0
+    for file_path, changed, diff in results:
+        if changed:
+            changed_files += 1
+            total_changed += changed
+            if args.dry_run:
+                sys.stdout.write(diff)
+            else:
+                print(f"已更新: {os.path.basename(file_path)} ({changed} 行)")
+
+    action = "将修改" if args.dry_run else "已修改"
+    print(f"\n共 {len(results)} 个脚本，{action} {changed_files} 个文件、{total_changed} 行")
+
+
+if __name__ == "__main__":
+    main()
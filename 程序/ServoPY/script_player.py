@@ -0,0 +1,211 @@
+# filename: script_player.py
+# 用途：不依赖 Tk 的命令行脚本播放器，可在 cron / systemd 中播放表情脚本或测量播放时间
+#
+# 与 ZS_BOX 的"运行脚本"一致：播放前发送 RESET 并等待舵机归位，播放结束后再次归位
+# （--no-reset 跳过）。脚本按编译后的时间轴播放，并与 head_daemon / servo_fleet 一样
+# 经过供电预算错开和速度/加速度限制。固件支持分段插值时可用 --segments 改为每帧
+# 发送一条 M 命令，由设备按PWM周期插值（servo_trajectory.segment_timeline）。
+#
+# 用法（在 ServoPY 目录下）：
+#   python -m script_player 表情脚本/02_微笑表情.txt --port COM3
+#   python -m script_player 表情脚本/0*.txt --port virtual --speed 2 --loop 3
+#   python -m script_player 表情脚本/*.txt --dry-run          # 只输出时长和总线占用，不连接设备
+#   python -m script_player 表情脚本/06_眨眼动画.txt --port /dev/ttyUSB0 --loop --no-reset
+#   python -m script_player 表情脚本/07_完整表情演示.txt --port virtual --start 12.5   # 从第12.5秒开始
+#   python -m script_player 表情脚本/0*.txt --port virtual --tighten 300   # 延时缩短到舵机到位后再保持300ms
+#   python -m script_player 表情脚本/*.txt --port virtual --segments     # 由设备插值，串口只发分段命令
+
+import os
+import sys
+import json
+import glob
+import time
+import signal
+import argparse
+import threading
+
+import servo_caps
+import servo_power
+import servo_trajectory
+from motion_recorder import sleep_until
+from servo_script import compile_script, load_script_file, parse_script
+from servo_slew import tighten_commands
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 与 ZS_BOX.execute_script_with_reset 一致：RESET 完成后再等待舵机到位
+RESET_SETTLE_S = 1.0
+RESET_ANGLE = 90
+
+
+def prepare_timeline(text, config, initial=None, start_ms=0, tighten=None, segments=False, speed=1.0):
+    """编译脚本并做供电预算错开和速度/加速度限制
+
+    Args:
+        start_ms: 从该时刻开始播放（先转到该时刻的姿态），按脚本时间计
+        tighten: 不为 None 时把延时缩短到舵机到位后再保持 tighten 毫秒（servo_slew）
+        segments: 生成分段插值命令（由设备插值，不做主机端的轨迹采样和错开）
+        speed: 播放速度倍数；在限制和错开之前缩放关键帧时间，加快播放时舵机仍不超过限制
+    """
+    commands = parse_script(text)
+    if tighten is not None:
+        commands = tighten_commands(commands, config, initial, tighten)
+    timeline = compile_script(commands, config, initial=initial)
+    if start_ms:
+        timeline = timeline.slice_from(start_ms)
+    timeline = timeline.scaled(speed)
+    if segments:
+        return servo_trajectory.segment_timeline(timeline, config, initial=initial)
+    # 先按关键帧错开（每个动作按一次完整的转动估算电流），再生成限速轨迹
+    timeline = servo_power.stagger_timeline(timeline, config, initial=initial)
+    return servo_trajectory.limit_timeline(timeline, config, initial=initial)
+
+
+def play_timeline(transport, timeline, options, stop_event=None):
+    """按时间轴发送各帧（播放速度已在 prepare_timeline 中计入）
+
+    Returns:
+        (发出的帧数, 实际发出时刻相对计划时刻的最大延迟（秒）)
+    """
+    start = time.perf_counter()
+    worst = 0.0
+    sent = 0
+    for time_ms, payload in timeline.encoded_frames(options['use_batch'], options['use_jaw_sync']):
+        due = start + time_ms / 1000.0
+        sleep_until(due)
+        if stop_event is not None and stop_event.is_set():
+            break
+        transport.send(payload)
+        sent += 1
+        worst = max(worst, time.perf_counter() - due)
+    # 等待时间轴末尾的延时
+    end = start + timeline.duration_ms / 1000.0
+    while stop_event is None or not stop_event.is_set():
+        remaining = end - time.perf_counter()
+        if remaining <= 0:
+            break
+        if stop_event is None:
+            time.sleep(remaining)
+        else:
+            stop_event.wait(remaining)
+    return sent, worst
+
+
+def reset_servos(transport, stop_event=None):
+    """发送 RESET 并等待舵机归位"""
+    transport.send(b"RESET\n").wait(transport.ack_timeout + 1.0)
+    if stop_event is None:
+        time.sleep(RESET_SETTLE_S)
+    else:
+        stop_event.wait(RESET_SETTLE_S)
+
+
+def expand_paths(patterns):
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+
+def dry_run(paths, config, speed, reset, start_ms=0, tighten=None, segments=False):
+    import servo_sim
+
+    initial = {ch: RESET_ANGLE for ch in range(16)} if reset else None
+    total = 0.0
+    for path in paths:
+        timeline = prepare_timeline(load_script_file(path), config, initial, start_ms, tighten, segments, speed)
+        result = servo_sim.simulate(timeline, config)
+        seconds = result.duration_ms / 1000.0
+        if reset:
+            seconds += 2 * RESET_SETTLE_S
+        total += seconds
+        print(f"{os.path.basename(path)}: 时长 {seconds:.2f}秒  帧数 {result.frames}  字节 {result.bytes_total}  "
+              f"峰值总线占用 {result.peak_load * 100:.1f}%")
+        for warning in result.warnings:
+            print(f"  警告: {warning}")
+    print(f"合计 {total:.2f}秒（速度 x{speed:g}，RESET 按 {RESET_SETTLE_S:g}秒估算）")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m script_player", description="命令行播放表情脚本")
+    parser.add_argument('scripts', nargs='+', help="表情脚本文件，可用通配符")
+    parser.add_argument('--port', help="串口名，或 virtual（本地模拟设备）")
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--config', default=os.path.join(BASE_DIR, 'servo_config.json'))
+    parser.add_argument('--speed', type=float, default=1.0, help="播放速度倍数")
+    parser.add_argument('--loop', type=int, nargs='?', const=0, default=1,
+                        help="重复播放次数，不带数字表示一直循环")
+    parser.add_argument('--start', type=float, default=0.0, help="从第几秒开始播放")
+    parser.add_argument('--no-reset', action='store_true', help="播放前后不发送 RESET")
+    parser.add_argument('--tighten', type=int, nargs='?', const=0, metavar='HOLD_MS',
+                        help="把延时缩短到舵机到位所需的最短时间，可指定到位后保持的毫秒数")
+    parser.add_argument('--segments', action='store_true',
+                        help="发送分段插值命令由设备插值（需要固件支持 segment）")
+    parser.add_argument('--dry-run', action='store_true', help="不连接设备，只输出各脚本的播放时长")
+    parser.add_argument('--refresh', action='store_true', help="重新探测设备功能（固件升级后使用）")
+    args = parser.parse_args(argv)
+    if args.speed <= 0:
+        parser.error("--speed 必须大于0")
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    paths = expand_paths(args.scripts)
+    scripts = [(path, load_script_file(path)) for path in paths]
+    reset = not args.no_reset
+
+    if args.dry_run:
+        return dry_run(paths, config, args.speed, reset, args.start * 1000.0, args.tighten,
+                       args.segments)
+    if not args.port:
+        parser.error("需要指定 --port（或使用 --dry-run）")
+
+    from servo_transport import ServoTransport, open_serial_port
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+
+    serial_port = open_serial_port(args.port, args.baud, timeout=0.2)
+    transport = None
+    try:
+        if not args.port.startswith('virtual'):
+            time.sleep(2)  # 等待ESP32重启
+        caps = servo_caps.negotiate(serial_port, refresh=args.refresh)
+        options = servo_caps.protocol_options(caps)
+        transport = ServoTransport(serial_port, jaw_ack=options['jaw_ack']).start()
+        print(servo_caps.describe(caps))
+        segments = args.segments and options['segment']
+        if args.segments and not segments:
+            print("设备不支持分段插值，改为主机端生成轨迹")
+
+        initial = {ch: RESET_ANGLE for ch in range(16)} if reset else None
+        timelines = [(path, prepare_timeline(text, config, initial, args.start * 1000.0, args.tighten,
+                                                segments, args.speed))
+                     for path, text in scripts]
+        iteration = 0
+        while not stop_event.is_set() and (args.loop == 0 or iteration < args.loop):
+            iteration += 1
+            for path, timeline in timelines:
+                if stop_event.is_set():
+                    break
+                if reset:
+                    reset_servos(transport, stop_event)
+                start = time.perf_counter()
+                frames, worst = play_timeline(transport, timeline, options, stop_event)
+                transport.wait_idle(timeout=5)
+                print(f"[{iteration}] {os.path.basename(path)}: {frames} 帧，用时 "
+                      f"{time.perf_counter() - start:.2f}秒（计划 {timeline.duration_ms / 1000.0:.2f}秒），"
+                      f"最大调度延迟 {worst * 1000:.2f}ms")
+        if reset and not stop_event.is_set():
+            reset_servos(transport)
+        print(transport.metrics.status_text())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if transport is not None:
+            transport.close()
+        serial_port.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
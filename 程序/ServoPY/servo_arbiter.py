@@ -0,0 +1,301 @@
+# filename: servo_arbiter.py
+# 用途：多个命令来源（归零、脚本、滑条、自动化）之间按优先级和舵机组所有权仲裁
+#
+# 每个舵机组（servo_pose.group_of）同一时刻只属于一个来源：
+#   - 来源发送命令时认领涉及的舵机组；组空闲、已属于自己或属于更低优先级的来源时认领成功，
+#     否则该组的目标被拒绝（不写出），不会与占用者的命令交错
+#   - 脚本、归零在会话结束时释放；滑条、自动化没有显式结束，超过租期未发送即释放
+#   - 抢占后被抢占来源的后续命令全部被拒绝，已进入发送队列的命令按顺序先写出；抢占者
+#     发往该组的第一个目标按速度/加速度限制（servo_trajectory）从最近发出的角度平滑过渡，
+#     过渡期间同组的新目标只更新过渡终点
+# RESET 等全局命令需要认领全部舵机组。
+#
+# 来源按线程区分：在 session(来源) 内调用的发送使用该来源，其余使用 default_source。
+#
+# 锁：认领和直接发送在同一把锁内完成，保证抢占前后的命令按认领顺序进入发送队列；
+# 过渡帧在锁内计算、释放锁后再交给传输层，on_reject 回调也在释放锁后调用，
+# 回调中可以再调用仲裁器。过渡中的通道在最后一帧交给传输层之后才退出过渡，
+# 其间同组的新目标仍走过渡，不会排到过渡帧前面。
+#
+# 配置项（servo_config.json）：
+#   arbiter_priority_<来源>   来源优先级，数值越大越优先
+#   arbiter_lease_<来源>      没有会话的来源的租期（秒）
+
+import time
+import threading
+from contextlib import contextmanager
+
+import servo_pose
+from servo_protocol import SERVO_COUNT, payload_targets
+from servo_trajectory import MotionLimiter
+from servo_transport import CommandRecord, REJECTED, SKIPPED
+
+DEFAULT_PRIORITIES = {
+    'reset': 40,
+    'script': 30,
+    'slider': 20,
+    'automation': 10,
+}
+# None 表示只在会话结束时释放
+DEFAULT_LEASES = {
+    'reset': None,
+    'script': None,
+    'slider': 1.0,
+    'automation': 0.5,
+}
+SOURCE_NAMES = {
+    'reset': "归零",
+    'script': "脚本",
+    'slider': "滑条",
+    'automation': "自动化",
+}
+ALL_GROUPS = tuple(sorted({servo_pose.group_of(ch) for ch in range(SERVO_COUNT)}))
+
+
+class _Owner:
+    def __init__(self, source, priority, expires):
+        self.source = source
+        self.priority = priority
+        self.expires = expires
+
+
+class CommandArbiter:
+    """按舵机组所有权仲裁后交给传输层发送"""
+
+    def __init__(self, transport, config, default_source='slider', on_reject=None,
+                 use_batch=True, use_jaw_sync=True):
+        """
+        Args:
+            transport: ServoTransport
+            config: 舵机配置（优先级、租期、平滑过渡的速度限制）
+            default_source: 不在任何会话中的线程使用的来源
+            on_reject: 目标被拒绝时的回调 on_reject(来源, 占用来源, 舵机组列表)，
+                同一来源被同一占用者拒绝只回调一次，直到所有权变化
+        """
+        self.transport = transport
+        self.config = config
+        self.default_source = default_source
+        self.on_reject = on_reject
+        self.use_batch = use_batch
+        self.use_jaw_sync = use_jaw_sync
+        self._lock = threading.RLock()
+        # 过渡帧的计算和发送期间持有，原始命令（RESET）不会被之后写出的过渡帧覆盖
+        self._ramp_send_lock = threading.Lock()
+        self._local = threading.local()
+        self._owners = {}
+        self._angles = {}
+        self._reported = set()
+        self.rejected = 0
+        self.preempted = 0
+
+        self._motion = MotionLimiter(config)
+        self._ramping = {}  # 通道 -> 过渡所属来源
+        self._ramp_thread = None
+
+    def set_config(self, config):
+        """替换配置（优先级、租期、过渡速度限制），已有的占用不变"""
+        with self._lock:
+            self.config = config
+            self._motion.set_config(config)
+
+    # ---------------- 来源与会话 ----------------
+
+    def priority(self, source):
+        return self.config.get(f'arbiter_priority_{source}', DEFAULT_PRIORITIES.get(source, 0))
+
+    def lease(self, source):
+        return self.config.get(f'arbiter_lease_{source}', DEFAULT_LEASES.get(source))
+
+    @property
+    def current_source(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else self.default_source
+
+    @contextmanager
+    def session(self, source):
+        """在当前线程中以 source 身份发送，结束时释放该来源的全部舵机组"""
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(source)
+        try:
+            yield self
+        finally:
+            stack.pop()
+            if source not in stack:
+                self.release(source)
+
+    def release(self, source):
+        with self._lock:
+            for group in [g for g, owner in self._owners.items() if owner.source == source]:
+                del self._owners[group]
+            self._reported = {item for item in self._reported if source not in item}
+
+    # ---------------- 发送 ----------------
+
+    def send_frame(self, targets, key=None, use_batch=None, use_jaw_sync=None, delta=True, source=None):
+        """按所有权过滤一帧舵机目标后发送
+
+        Returns:
+            CommandRecord；全部目标被拒绝时返回状态为 REJECTED 的记录
+        """
+        source = source or self.current_source
+        use_batch = self.use_batch if use_batch is None else use_batch
+        use_jaw_sync = self.use_jaw_sync if use_jaw_sync is None else use_jaw_sync
+        targets = {int(ch): angle for ch, angle in dict(targets).items()}
+        with self._lock:
+            granted, handover, notices = self._claim(source, {servo_pose.group_of(ch) for ch in targets})
+            direct = {}
+            for ch, angle in targets.items():
+                group = servo_pose.group_of(ch)
+                if group not in granted:
+                    continue
+                if (group in handover or ch in self._ramping) and self._start_ramp(ch, angle, source):
+                    continue
+                direct[ch] = angle
+            if direct:
+                self._angles.update(direct)
+                record = self.transport.send_frame(direct, key, use_batch, use_jaw_sync, delta)
+        self._notify(source, notices)
+        if not direct:
+            return self._rejected(key, REJECTED if not granted else SKIPPED)
+        return record
+
+    def send(self, payload, key=None, source=None):
+        """发送原始命令（例如 RESET），需要认领命令涉及的全部舵机组"""
+        source = source or self.current_source
+        if isinstance(payload, str):
+            payload = payload.encode()
+        changes = payload_targets(payload)
+        groups = {servo_pose.group_of(ch) for ch, _ in changes}
+        with self._ramp_send_lock, self._lock:
+            granted, _, notices = self._claim(source, groups)
+            if granted == groups:
+                for ch, angle in changes:
+                    self._ramping.pop(ch, None)
+                    self._angles[ch] = angle
+                record = self.transport.send(payload, key)
+        self._notify(source, notices)
+        if granted != groups:
+            return self._rejected(key, REJECTED)
+        return record
+
+    def _rejected(self, key, status):
+        record = CommandRecord(b"", key)
+        record.finish(status)
+        return record
+
+    def _notify(self, source, notices):
+        """在锁外调用 on_reject"""
+        for owner_source, owner_groups in notices:
+            self.on_reject(source, owner_source, owner_groups)
+
+    def _claim(self, source, groups):
+        """认领舵机组（需持有锁）
+
+        Returns:
+            (认领成功的组, 其中从其他来源抢占的组, 需要在锁外调用 on_reject 的 [(占用来源, 舵机组列表)])
+        """
+        now = time.monotonic()
+        priority = self.priority(source)
+        lease = self.lease(source)
+        expires = None if lease is None else now + lease
+        granted, handover, blocked = set(), set(), {}
+        for group in groups:
+            owner = self._owners.get(group)
+            if owner is not None and owner.expires is not None and owner.expires <= now:
+                owner = None
+            if owner is None or owner.source == source:
+                self._owners[group] = _Owner(source, priority, expires)
+                granted.add(group)
+            elif owner.priority < priority:
+                self._owners[group] = _Owner(source, priority, expires)
+                granted.add(group)
+                handover.add(group)
+                self.preempted += 1
+            else:
+                blocked.setdefault(owner.source, []).append(group)
+        notices = []
+        for owner_source, owner_groups in blocked.items():
+            self.rejected += len(owner_groups)
+            if self.on_reject is not None and (source, owner_source) not in self._reported:
+                self._reported.add((source, owner_source))
+                notices.append((owner_source, owner_groups))
+        return granted, handover, notices
+
+    # ---------------- 平滑过渡 ----------------
+
+    def _start_ramp(self, ch, angle, source):
+        """从最近发出的角度过渡到 angle（需持有锁），位置未知无法过渡时返回 False"""
+        if ch not in self._ramping:
+            if ch not in self._angles:
+                return False
+            self._motion.place(ch, self._angles[ch])
+        self._ramping[ch] = source
+        self._motion.set_target(ch, angle)
+        if self._ramp_thread is None:
+            self._ramp_thread = threading.Thread(target=self._ramp_loop, name="arbiter-handover", daemon=True)
+            self._ramp_thread.start()
+        return True
+
+    def _ramp_loop(self):
+        period = self._motion.step_ms / 1000.0
+        next_tick = time.monotonic()
+        while True:
+            with self._ramp_send_lock:
+                with self._lock:
+                    if not self._ramping or not self.transport.running:
+                        self._ramping.clear()
+                        self._ramp_thread = None
+                        return
+                    changed = {ch: a for ch, a in self._motion.step().items() if ch in self._ramping}
+                    finished = {ch: self._ramping[ch] for ch in self._ramping
+                                if self._motion.positions[ch] == self._motion.targets[ch]}
+                    self._angles.update(changed)
+                if changed:
+                    self.transport.send_frame(changed, ('H',) + tuple(sorted(changed)),
+                                              self.use_batch, self.use_jaw_sync, True)
+                with self._lock:
+                    # 最后一帧已进入发送队列；期间收到新目标的通道继续过渡
+                    for ch, source in finished.items():
+                        if (self._ramping.get(ch) == source
+                                and self._motion.positions[ch] == self._motion.targets[ch]):
+                            del self._ramping[ch]
+            next_tick += period
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+
+    # ---------------- 监控 ----------------
+
+    def owner(self, ch):
+        """通道所在舵机组当前的占用来源，没有占用时返回 None"""
+        with self._lock:
+            owner = self._owners.get(servo_pose.group_of(ch))
+            if owner is None or (owner.expires is not None and owner.expires <= time.monotonic()):
+                return None
+            return owner.source
+
+    def ownership(self):
+        """各舵机组当前的占用来源 {组名: {'source', 'priority', 'lease_s'}}"""
+        now = time.monotonic()
+        with self._lock:
+            result = {}
+            for group in ALL_GROUPS:
+                owner = self._owners.get(group)
+                if owner is None or (owner.expires is not None and owner.expires <= now):
+                    continue
+                name = servo_pose.GROUP_NAMES.get(group, f"舵机{group[0]}")
+                result[name] = {
+                    'source': owner.source,
+                    'priority': owner.priority,
+                    'lease_s': None if owner.expires is None else round(owner.expires - now, 2),
+                }
+            return result
+
+    def status_text(self):
+        """状态栏显示的一行摘要"""
+        owners = {}
+        for info in self.ownership().values():
+            owners[info['source']] = owners.get(info['source'], 0) + 1
+        held = '、'.join(f"{SOURCE_NAMES.get(source, source)}×{count}"
+                       for source, count in sorted(owners.items())) or "空闲"
+        return f"占用 {held} | 抢占 {self.preempted} 拒绝 {self.rejected}"
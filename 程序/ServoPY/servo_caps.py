@@ -0,0 +1,226 @@
+# filename: servo_caps.py
+# 用途：连接时协商设备支持的协议功能，并按设备序列号缓存协商结果
+#
+# 新版固件支持 CAPS 命令，直接应答支持的功能：
+#   CAPS:version=1,batch=1,js=1,js_ack=1,binary=0,status=1,segment=1,schedule=1,debug=1,baud=115200
+# status=1 表示 STATUS 命令可用（更早的固件把 STATUS 当作舵机命令应答 ERROR）；
+# segment=1 表示支持 M 分段插值命令（servo_protocol.format_segment）；
+# schedule=1 表示支持 T 对时和 @ 定时执行命令（servo_clock）。
+# 旧版固件应答 "ERROR:Unknown command: CAPS"，此时用不会移动舵机的探测命令判断：
+#   S99,0;99,0   支持批量命令时每个通道各一条 ERROR，不支持时只有一条
+#   JS999        支持 JS 命令时应答 "ERROR:Invalid jaw angle"，否则 "ERROR:Unknown command"
+#
+# 协商结果保存在 device_caps.json，按设备序列号记录 CAPS 应答的摘要（旧版固件为 legacy）。
+# 每次连接只发送一条 CAPS 校验：摘要与缓存一致且缓存未过期时直接使用缓存，
+# 不再重复旧版固件的探测，也不再每次先尝试批量命令失败后回退；
+# 固件升级或降级后 CAPS 应答改变，自动重新探测。各入口程序的 --refresh 强制重新探测。
+
+import os
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime, timedelta
+
+from servo_protocol import parse_reply
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_FILE = os.path.join(BASE_DIR, "device_caps.json")
+
+# 多个头并行连接时保护缓存文件的读-改-写
+_cache_lock = threading.Lock()
+
+# 缓存条目的有效期（天），过期后重新探测
+CACHE_MAX_AGE_DAYS = 30
+
+# 旧版固件的保守假设
+LEGACY_CAPS = {
+    'version': 0,
+    'batch': False,
+    'js': False,
+    'js_ack': False,
+    'binary': False,
+    'status': False,
+    'segment': False,
+    'schedule': False,
+    'debug': True,
+    'bauds': [115200],
+}
+
+
+def parse_caps(payload):
+    """解析 CAPS 应答内容 "version=1,batch=1,..."，返回功能字典"""
+    caps = dict(LEGACY_CAPS)
+    for item in payload.split(','):
+        key, sep, value = item.strip().partition('=')
+        if not sep:
+            continue
+        if key == 'baud':
+            caps['bauds'] = [int(b) for b in value.split('/') if b.isdigit()] or [115200]
+        elif key == 'version':
+            caps['version'] = int(value) if value.isdigit() else 0
+        else:
+            caps[key] = value.strip() == '1'
+    return caps
+
+
+def read_lines(serial_port, done, timeout):
+    """直接从串口读取行，直到 done(kind, content, lines) 返回 True 或超时"""
+    lines = []
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        raw = serial_port.readline()
+        if not raw:
+            continue
+        text = raw.decode('utf-8', errors='replace').strip()
+        if not text:
+            continue
+        kind, content = parse_reply(text)
+        lines.append((kind, content))
+        if done(kind, content, lines):
+            break
+    return lines
+
+
+def _count(lines, kind):
+    return sum(1 for k, _ in lines if k == kind)
+
+
+def read_caps_reply(serial_port, timeout=1.0):
+    """发送 CAPS 命令，返回应答内容；旧版固件（应答 ERROR 或没有应答）返回 None"""
+    serial_port.reset_input_buffer()
+    serial_port.write(b"CAPS\n")
+    lines = read_lines(serial_port, lambda k, c, _: k in ('CAPS', 'ERROR'), timeout)
+    for kind, content in lines:
+        if kind == 'CAPS':
+            return content
+    return None
+
+
+def caps_digest(reply):
+    """CAPS 应答的摘要，用于校验缓存是否仍对应设备上的固件"""
+    if reply is None:
+        return 'legacy'
+    return hashlib.sha1(reply.strip().encode('utf-8')).hexdigest()[:16]
+
+
+def probe_caps(serial_port, timeout=1.0):
+    """向设备发送探测命令，返回功能字典（应在传输层启动前调用）"""
+    reply = read_caps_reply(serial_port, timeout)
+    if reply is not None:
+        return parse_caps(reply)
+    return probe_legacy(serial_port, timeout)
+
+
+def probe_legacy(serial_port, timeout=1.0):
+    """旧版固件：用不会移动舵机的无效命令探测"""
+    caps = dict(LEGACY_CAPS)
+    serial_port.write(b"S99,0;99,0\n")
+    lines = read_lines(serial_port, lambda k, c, ls: _count(ls, 'ERROR') >= 2, timeout)
+    caps['batch'] = _count(lines, 'ERROR') >= 2
+    caps['debug'] = any(k == 'DEBUG' and c.startswith('Received') for k, c in lines)
+
+    serial_port.write(b"JS999\n")
+    lines = read_lines(serial_port, lambda k, c, _: k == 'ERROR', timeout)
+    caps['js'] = any(k == 'ERROR' and c.startswith('Invalid jaw angle') for k, c in lines)
+    return caps
+
+
+def device_id(serial_port):
+    """设备的唯一标识：USB序列号，取不到时使用串口名"""
+    serial_number = getattr(serial_port, 'serial_number', None)
+    if not serial_number:
+        try:
+            import serial.tools.list_ports
+            for info in serial.tools.list_ports.comports():
+                if info.device == serial_port.port:
+                    serial_number = info.serial_number
+                    break
+        except Exception:
+            serial_number = None
+    return serial_number or f"port:{serial_port.port}"
+
+
+def load_cache(cache_file=DEFAULT_CACHE_FILE):
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache, cache_file=DEFAULT_CACHE_FILE):
+    tmp_path = cache_file + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, cache_file)
+
+
+def cache_valid(entry, digest, now=None):
+    """缓存条目是否与设备当前的 CAPS 应答一致且未过期"""
+    if not entry or entry.get('caps_digest') != digest:
+        return False
+    try:
+        probed_at = datetime.fromisoformat(entry['probed_at'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return (now or datetime.now()) - probed_at < timedelta(days=CACHE_MAX_AGE_DAYS)
+
+
+def negotiate(serial_port, cache_file=DEFAULT_CACHE_FILE, refresh=False, timeout=1.0):
+    """返回设备功能字典，缓存与设备的 CAPS 应答一致时使用缓存
+
+    Args:
+        serial_port: 已打开的串口（传输层尚未启动）
+        cache_file: 缓存文件路径，None 表示不使用缓存
+        refresh: 忽略缓存重新探测
+
+    Returns:
+        功能字典，额外包含 'device_id' 和 'source'（'cache' 或 'probe'）
+    """
+    dev_id = device_id(serial_port)
+    reply = read_caps_reply(serial_port, timeout)
+    digest = caps_digest(reply)
+    cache = load_cache(cache_file) if cache_file else {}
+    if not refresh and cache_valid(cache.get(dev_id), digest):
+        caps = dict(LEGACY_CAPS)
+        caps.update(cache[dev_id])
+        caps.update({'device_id': dev_id, 'source': 'cache'})
+        return caps
+
+    caps = parse_caps(reply) if reply is not None else probe_legacy(serial_port, timeout)
+    if cache_file:
+        entry = dict(caps)
+        entry['caps_digest'] = digest
+        entry['probed_at'] = datetime.now().isoformat(timespec='seconds')
+        with _cache_lock:
+            cache = load_cache(cache_file)
+            cache[dev_id] = entry
+            try:
+                save_cache(cache, cache_file)
+            except OSError:
+                pass
+    caps.update({'device_id': dev_id, 'source': 'probe'})
+    return caps
+
+
+def protocol_options(caps):
+    """根据设备功能选择编码方式，返回 encode_frame / ServoTransport 使用的参数"""
+    return {
+        'use_batch': bool(caps.get('batch')),
+        'use_jaw_sync': bool(caps.get('js')),
+        'jaw_ack': bool(caps.get('js_ack')),
+        'status': bool(caps.get('status')),
+        'segment': bool(caps.get('segment')),
+        'schedule': bool(caps.get('schedule')),
+    }
+
+
+def describe(caps):
+    """功能字典的一行说明"""
+    names = [('batch', "批量命令"), ('js', "JS下颚同步"), ('js_ack', "JS应答"), ('binary', "二进制帧"), ('status', "STATUS查询"),
+             ('segment', "分段插值"), ('schedule', "定时执行")]
+    supported = [label for key, label in names if caps.get(key)]
+    return (f"固件v{caps.get('version', 0)} 支持: {'、'.join(supported) or '仅单舵机命令'}，"
+            f"波特率 {'/'.join(str(b) for b in caps.get('bauds', []))}，"
+            f"DEBUG {'开' if caps.get('debug') else '关'}")
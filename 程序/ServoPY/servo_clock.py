@@ -0,0 +1,215 @@
+# filename: servo_clock.py
+# 用途：主机与设备对时，并按设备时钟发送定时执行的命令
+#
+# 命令到达设备就执行时，分几次写出的通道、不同串口上的多个头不会同时开始。固件支持
+# schedule（CAPS 中 schedule=1）时：
+#   1. 对时：主机发送 T<seq>，设备应答 TIME:<seq>,<收到时刻>,<应答时刻>（设备 millis()）。
+#      与 NTP 相同，设主机发出/收到时刻为 t0/t1、设备收到/应答时刻为 T2/T3：
+#        偏差 = ((T2 - t0) + (T3 - t1)) / 2       往返 = (t1 - t0) - (T3 - T2)
+#      每次对时发送多次，取往返最短的一次（排队、DEBUG 输出等造成的延迟最小），
+#      误差不超过 往返/2 加上 millis() 的1ms分辨率。
+#   2. 定时执行：@<device_ms>:<命令>。主机提前 lead 秒写出，设备在 millis() 到达
+#      device_ms 时执行，多个头按同一主机时刻换算成各自的设备时刻即可同时开始。
+# 多次对时的偏差按最小二乘拟合出设备晶振相对主机的漂移，对时之间按漂移外推。
+#
+# 在程序中使用：
+#   clock = ClockSync(transport)
+#   clock.sync()
+#   clock.send_frame_at({2: 74, 3: 112}, time.perf_counter() + 0.1)
+#
+# 命令行（测量对时精度和漂移）：
+#   python servo_clock.py --port COM3
+#   python servo_clock.py --port virtual --watch 60 --interval 5
+
+import sys
+import time
+import argparse
+import itertools
+from collections import deque
+
+from servo_protocol import (DEVICE_CLOCK_WRAP, encode_frame, format_scheduled, format_time_request,
+                            parse_time)
+
+DEFAULT_SAMPLES = 8
+DEFAULT_PING_TIMEOUT = 0.5
+# 定时命令默认提前写出的时间（秒）；提前量内的帧数不要超过设备队列长度 SCHEDULE_SIZE
+DEFAULT_LEAD_S = 0.1
+# 至少跨越这么长时间的对时结果才用于估计漂移（秒）
+DRIFT_MIN_SPAN_S = 10.0
+HISTORY_SIZE = 16
+
+
+def _signed(delta):
+    """32位回绕的设备时刻差转换成有符号数"""
+    half = DEVICE_CLOCK_WRAP // 2
+    return (int(delta) + half) % DEVICE_CLOCK_WRAP - half
+
+
+class ClockSync:
+    """通过 ServoTransport 与设备对时，换算主机时刻（time.perf_counter）和设备 millis()"""
+
+    def __init__(self, transport, samples=DEFAULT_SAMPLES, timeout=DEFAULT_PING_TIMEOUT):
+        self.transport = transport
+        self.samples = samples
+        self.timeout = timeout
+        self.offset_ms = None    # 最近一次对时的 设备时刻 - 主机时刻（毫秒）
+        self.rtt_ms = None       # 最近一次对时的往返时间（毫秒）
+        self.synced_at = None    # 最近一次对时的主机时刻
+        self.drift_ppm = 0.0
+        self.history = deque(maxlen=HISTORY_SIZE)  # [(主机时刻, 偏差)]
+        self._seq = itertools.count(1)
+
+    @property
+    def synced(self):
+        return self.offset_ms is not None
+
+    @property
+    def uncertainty_ms(self):
+        """偏差估计的误差上限（毫秒）"""
+        return None if self.rtt_ms is None else self.rtt_ms / 2.0 + 1.0
+
+    # ---------------- 对时 ----------------
+
+    def ping(self):
+        """发送一次 T 命令
+
+        Returns:
+            (主机时刻, 偏差毫秒, 往返毫秒)，没有应答时返回 None
+        """
+        seq = next(self._seq)
+        received = []
+
+        def match(kind, content):
+            if kind != 'TIME':
+                return False
+            reply = parse_time(content)
+            if reply is None or reply[0] != seq:
+                return False
+            # 在读线程中记录收到时刻，不包括唤醒等待线程的延迟
+            received.append((time.perf_counter(), reply))
+            return True
+
+        t0 = time.perf_counter()
+        self.transport.query(format_time_request(seq), match, self.timeout)
+        if not received:
+            return None
+        t1, (_, device_received, device_sent) = received[0]
+        host_mid = (t0 + t1) / 2.0
+        if self.synced:
+            # 按当前估计展开32位回绕
+            predicted = host_mid * 1000.0 + self.offset_at(host_mid)
+            device_received = predicted + _signed(device_received - predicted)
+        device_sent = device_received + _signed(device_sent - device_received)
+        offset = ((device_received - t0 * 1000.0) + (device_sent - t1 * 1000.0)) / 2.0
+        rtt = (t1 - t0) * 1000.0 - (device_sent - device_received)
+        return host_mid, offset, max(0.0, rtt)
+
+    def sync(self, samples=None):
+        """对时，返回是否成功"""
+        results = []
+        for _ in range(samples or self.samples):
+            result = self.ping()
+            if result is not None:
+                results.append(result)
+        if not results:
+            return False
+        host_time, offset, rtt = min(results, key=lambda item: item[2])
+        self.offset_ms = offset
+        self.rtt_ms = rtt
+        self.synced_at = host_time
+        self.history.append((host_time, offset))
+        self._fit_drift()
+        return True
+
+    def _fit_drift(self):
+        """按对时历史的最小二乘斜率估计漂移"""
+        if len(self.history) < 2 or self.history[-1][0] - self.history[0][0] < DRIFT_MIN_SPAN_S:
+            self.drift_ppm = 0.0
+            return
+        n = len(self.history)
+        mean_t = sum(t for t, _ in self.history) / n
+        mean_o = sum(o for _, o in self.history) / n
+        var = sum((t - mean_t) ** 2 for t, _ in self.history)
+        cov = sum((t - mean_t) * (o - mean_o) for t, o in self.history)
+        # 偏差单位为毫秒、时间单位为秒：ms/s × 1000 = ppm
+        self.drift_ppm = cov / var * 1000.0
+
+    # ---------------- 时刻换算 ----------------
+
+    def offset_at(self, host_time):
+        """host_time 时刻的偏差估计（毫秒），按漂移从最近一次对时外推"""
+        if not self.synced:
+            raise RuntimeError("尚未与设备对时")
+        return self.offset_ms + self.drift_ppm * 1e-3 * (host_time - self.synced_at)
+
+    def device_ms(self, host_time=None):
+        """主机时刻对应的设备 millis()（已按32位回绕）"""
+        host_time = time.perf_counter() if host_time is None else host_time
+        return int(round(host_time * 1000.0 + self.offset_at(host_time))) % DEVICE_CLOCK_WRAP
+
+    def host_time(self, device_ms):
+        """设备时刻对应的主机时刻（取离现在最近的一次回绕）"""
+        now = time.perf_counter()
+        return now + _signed(device_ms - self.device_ms(now)) / 1000.0
+
+    # ---------------- 定时发送 ----------------
+
+    def send_at(self, payload, host_time, key=None):
+        """发送在 host_time（perf_counter）执行的命令，返回 CommandRecord"""
+        return self.transport.send(format_scheduled(payload, self.device_ms(host_time)), key, due=host_time)
+
+    def send_frame_at(self, targets, host_time, key=None, use_batch=True, use_jaw_sync=True):
+        """编码一帧舵机目标，在 host_time 执行"""
+        return self.send_at(encode_frame(targets, use_batch, use_jaw_sync), host_time, key)
+
+    def status_text(self):
+        if not self.synced:
+            return "未对时"
+        return (f"偏差 {self.offset_ms:.1f}ms ±{self.uncertainty_ms:.1f}ms  往返 {self.rtt_ms:.2f}ms  "
+                f"漂移 {self.drift_ppm:+.1f}ppm")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="测量主机与舵机控制器的时钟偏差和漂移")
+    parser.add_argument('--port', required=True, help="串口名，或 virtual（本地模拟设备）")
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES, help="每次对时的 T 命令次数")
+    parser.add_argument('--watch', type=float, default=0.0, help="持续对时的秒数（用于估计漂移）")
+    parser.add_argument('--interval', type=float, default=5.0, help="持续对时的间隔（秒）")
+    parser.add_argument('--refresh', action='store_true', help="重新探测设备功能（固件升级后使用）")
+    args = parser.parse_args(argv)
+
+    import servo_caps
+    from servo_transport import ServoTransport, open_serial_port
+
+    serial_port = open_serial_port(args.port, args.baud, timeout=0.2)
+    transport = None
+    try:
+        if not args.port.startswith('virtual'):
+            time.sleep(2)  # 等待ESP32重启
+        caps = servo_caps.negotiate(serial_port, refresh=args.refresh)
+        if not caps.get('schedule'):
+            print("设备不支持对时（CAPS 中没有 schedule=1），固件升级后可加 --refresh 重试")
+            return 1
+        transport = ServoTransport(serial_port).start()
+        clock = ClockSync(transport, args.samples)
+        end = time.perf_counter() + args.watch
+        while True:
+            if clock.sync():
+                print(clock.status_text())
+            else:
+                print("设备没有应答 TIME")
+            if time.perf_counter() + args.interval > end:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if transport is not None:
+            transport.close()
+        serial_port.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+# filename: servo_deadband.py
+# 用途：连续输入（感知、插值轨迹）的死区/滞回滤波，去掉不会产生可见动作的 ±1° 抖动
+#
+# 固件只接受整数角度，输入的小数抖动取整后变成 90/91/90/91... 的写入流，舵机来回
+# 微动发热，还占用串口带宽。滤波按舵机组（联动舵机一起判断，保证 JS/镜像关系不被拆开）：
+#   - 与上次输出相差超过死区（默认1°）时立即输出
+#   - 变化不超过死区时先不输出；同一个取整后的新角度持续 hold_ms（默认250ms）不变，
+#     说明是缓慢的真实移动而不是抖动，再输出，使最终姿态与输入一致
+# 其他途径（脚本、滑条）发出的角度用 update() 告知，滤波以实际发出的角度为基准。
+#
+# 配置项（servo_config.json）：
+#   deadband_deg       死区（度），0表示不过滤，默认1.0
+#   deadband_hold_ms   小幅变化保持多久后输出（毫秒），默认250
+#   servo_X_deadband   舵机X单独的死区
+
+import time
+
+import servo_pose
+
+DEFAULT_DEADBAND_DEG = 1.0
+DEFAULT_HOLD_MS = 250
+
+
+class DeadbandFilter:
+    """按舵机组的死区滤波，filter() 返回需要发送的 {通道: 整数角度}"""
+
+    def __init__(self, config, deadband=None, hold_ms=None):
+        self.config = config
+        self.deadband = config.get('deadband_deg', DEFAULT_DEADBAND_DEG) if deadband is None else deadband
+        self.hold_ms = config.get('deadband_hold_ms', DEFAULT_HOLD_MS) if hold_ms is None else hold_ms
+        self.output = {}
+        self._pending = {}  # 舵机组 -> (候选角度, 开始时间)
+        self.passed = 0
+        self.suppressed = 0
+
+    def threshold(self, ch):
+        return float(self.config.get(f'servo_{ch}_deadband', self.deadband))
+
+    def update(self, targets):
+        """记录其他途径已发出的角度"""
+        for ch, angle in dict(targets).items():
+            self.output[ch] = int(round(angle))
+
+    def reset(self):
+        self.output.clear()
+        self._pending.clear()
+
+    def filter(self, targets, now=None):
+        """
+        Args:
+            targets: {通道: 角度} 或 [(通道, 角度), ...]，角度可以是小数
+            now: 当前时间（秒），默认 time.monotonic()
+
+        Returns:
+            {通道: 角度}，只包含需要发送的舵机组
+        """
+        targets = dict(targets)
+        now = time.monotonic() if now is None else now
+        result = {}
+        done = set()
+        for ch in targets:
+            group = tuple(c for c in servo_pose.group_of(ch) if c in targets)
+            if group in done:
+                continue
+            done.add(group)
+            values = {c: int(round(targets[c])) for c in group}
+            changed = [c for c in group if self.output.get(c) != values[c]]
+            if not changed:
+                self._pending.pop(group, None)
+                continue
+            passed = any(c not in self.output or abs(targets[c] - self.output[c]) > self.threshold(c)
+                         for c in group)
+            if not passed:
+                candidate = tuple(values[c] for c in group)
+                pending = self._pending.get(group)
+                if pending is None or pending[0] != candidate:
+                    self._pending[group] = (candidate, now)
+                passed = now - self._pending[group][1] >= self.hold_ms / 1000.0
+            if passed:
+                self._pending.pop(group, None)
+                self.output.update(values)
+                result.update(values)
+                self.passed += len(changed)
+            else:
+                self.suppressed += len(changed)
+        return result
+
+    def stats(self):
+        """统计：发出的和被滤掉的通道写入次数"""
+        total = self.passed + self.suppressed
+        return {
+            'passed': self.passed,
+            'suppressed': self.suppressed,
+            'saved_ratio': self.suppressed / total if total else 0.0,
+        }
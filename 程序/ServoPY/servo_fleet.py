@@ -0,0 +1,300 @@
+# filename: servo_fleet.py
+# 用途：多头控制器，同时驱动展厅中的多个仿生人头
+#
+# 每个头有自己的串口和校准文件。所有头的帧由一个调度线程按时间顺序投递到
+# 各自的 ServoTransport 发送队列（非阻塞），串口读写由传输层完成，
+# 因此线程数只与串口数有关，与命令数无关。
+#
+# 配置文件示例（fleet.json）：
+#   {
+#     "heads": [
+#       {"name": "hall-1", "port": "COM3", "config": "servo_config.json"},
+#       {"name": "hall-2", "port": "COM4", "config": "configs/hall2.json", "baud": 115200}
+#     ]
+#   }
+# config 为相对路径时相对于 fleet.json 所在目录；port 可以是 "virtual"（本地模拟设备）。
+#
+# 固件支持定时执行（CAPS 中 schedule=1）时，播放前与每个头对时（servo_clock），
+# 每帧提前 lead 秒写出并带上按各头设备时钟换算的执行时刻，各头在同一时刻开始，
+# 不受各串口排队和写出先后的影响；不支持的头仍在到时刻时发送。
+#
+# 用法：
+#   python servo_fleet.py fleet.json 表情脚本/02_微笑表情.txt
+#   python servo_fleet.py --virtual 12 表情脚本/07_完整表情演示.txt   # 12个模拟头
+#   python servo_fleet.py fleet.json 表情脚本/06_眨眼动画.txt --lead 0   # 不使用定时执行
+
+import os
+import sys
+import json
+import time
+import heapq
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import servo_caps
+import servo_power
+import servo_trajectory
+from servo_clock import DEFAULT_LEAD_S, ClockSync
+from servo_metrics import percentile
+from servo_script import compile_script, load_script_file
+from servo_transport import DEFAULT_RECONCILE_INTERVAL, ServoTransport, open_serial_port, ACKED, SENT
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Head:
+    """一个仿生人头：串口、校准数据和传输层"""
+
+    def __init__(self, name, port, config_file=None, baudrate=115200, window=4, settle_time=2.0):
+        """
+        Args:
+            name: 头的名称（用于报告）
+            port: 串口名，或 "virtual"
+            config_file: 校准文件（servo_config.json 格式），None 时使用默认校准
+            settle_time: 打开串口后等待ESP32重启的时间（秒），模拟设备不等待
+        """
+        self.name = name
+        self.port = port
+        self.config_file = config_file
+        self.baudrate = baudrate
+        self.window = window
+        self.settle_time = settle_time
+        self.config = {}
+        self.caps = dict(servo_caps.LEGACY_CAPS)
+        self.serial_port = None
+        self.transport = None
+        self.clock = None
+        self.error = None
+
+    @property
+    def connected(self):
+        return self.transport is not None and self.transport.running
+
+    def open(self, caps_cache=servo_caps.DEFAULT_CACHE_FILE, refresh=False):
+        if self.config_file:
+            with open(self.config_file, 'r', encoding='utf-8') as f:
+                self.config = json.load(f)
+        self.serial_port = open_serial_port(self.port, self.baudrate, timeout=0.2)
+        if not self.port.startswith('virtual'):
+            time.sleep(self.settle_time)  # 等待ESP32重启
+        self.caps = servo_caps.negotiate(self.serial_port, caps_cache, refresh)
+        options = servo_caps.protocol_options(self.caps)
+        self.transport = ServoTransport(self.serial_port, window=self.window,
+                                        jaw_ack=options['jaw_ack'],
+                                        on_error=self._on_error,
+                                        reconcile_interval=DEFAULT_RECONCILE_INTERVAL if options['status'] else None
+                                        ).start()
+        return self
+
+    def sync_clock(self):
+        """与设备对时，设备不支持定时执行或对时失败时返回 False"""
+        if not self.caps.get('schedule'):
+            return False
+        if self.clock is None:
+            self.clock = ClockSync(self.transport)
+        return self.clock.sync()
+
+    def _on_error(self, exc):
+        self.error = exc
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+        self.clock = None
+        if self.serial_port:
+            try:
+                self.serial_port.close()
+            except Exception:
+                pass
+            self.serial_port = None
+
+    def encode(self, timeline):
+        options = servo_caps.protocol_options(self.caps)
+        timeline = servo_power.stagger_timeline(timeline, self.config)
+        timeline = servo_trajectory.limit_timeline(timeline, self.config)
+        return timeline.encoded_frames(options['use_batch'], options['use_jaw_sync'])
+
+
+class Fleet:
+    """同时控制多个头"""
+
+    def __init__(self, heads, max_workers=16):
+        self.heads = list(heads)
+        self.max_workers = max_workers
+
+    @classmethod
+    def from_file(cls, fleet_file, **head_options):
+        with open(fleet_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        base = os.path.dirname(os.path.abspath(fleet_file))
+        heads = []
+        for i, item in enumerate(data.get('heads', [])):
+            config_file = item.get('config')
+            if config_file and not os.path.isabs(config_file):
+                config_file = os.path.join(base, config_file)
+            heads.append(Head(item.get('name', f"head-{i + 1}"), item['port'], config_file,
+                              item.get('baud', 115200), **head_options))
+        return cls(heads)
+
+    def open_all(self, refresh=False):
+        """并行打开所有串口（每个真实串口需要等待约2秒重启），返回打开失败的头
+
+        Args:
+            refresh: 忽略能力缓存，重新探测每个设备的功能
+        """
+        failed = []
+
+        def open_head(head):
+            try:
+                head.open(refresh=refresh)
+            except Exception as e:
+                head.error = e
+                head.close()
+                failed.append(head)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(self.heads)))) as pool:
+            list(pool.map(open_head, self.heads))
+        return failed
+
+    def close_all(self):
+        for head in self.heads:
+            head.close()
+
+    def send_pose(self, targets):
+        """立即向所有已连接的头发送同一姿态 {通道: 角度}"""
+        return {head.name: head.transport.send_frame(targets, ('pose',), delta=True,
+                                                     **_frame_options(head))
+                for head in self.heads if head.connected}
+
+    def play(self, script, start_delay=0.5, speed=1.0, ack_timeout=5.0, lead=DEFAULT_LEAD_S):
+        """在所有头上同步播放同一脚本
+
+        每个头按自己的校准文件编译脚本，所有帧以同一个开始时刻为基准，
+        由单个调度线程按时间顺序投递。
+
+        Args:
+            script: 脚本文本或命令列表
+            start_delay: 开始时刻距现在的时间（秒），留给编译、对时和排队
+            speed: 播放速度倍数
+            lead: 支持定时执行的头提前多少秒写出每一帧，0 或 None 表示不使用定时执行
+
+        Returns:
+            {头名称: 报告字典}
+        """
+        heads = [head for head in self.heads if head.connected]
+        lead = lead or 0.0
+        clocks = [None] * len(heads)
+        if lead:
+            # 各头并行对时
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(heads)))) as pool:
+                synced = list(pool.map(lambda head: head.sync_clock(), heads))
+            clocks = [head.clock if ok else None for head, ok in zip(heads, synced)]
+        start_at = time.perf_counter() + start_delay
+        schedule = []
+        for idx, head in enumerate(heads):
+            # 先按速度缩放关键帧，再做错开和限速，加快播放时舵机仍不超过限制
+            timeline = compile_script(script, head.config).scaled(speed)
+            # 定时执行的头提前 lead 秒写出
+            early = lead if clocks[idx] is not None else 0.0
+            for seq, (time_ms, payload) in enumerate(head.encode(timeline)):
+                schedule.append((time_ms / 1000.0 - early, idx, seq, payload))
+        heapq.heapify(schedule)
+
+        records = [[] for _ in heads]
+        lateness = [[] for _ in heads]
+        while schedule:
+            offset, idx, _, payload = heapq.heappop(schedule)
+            send_at = start_at + offset
+            wait = send_at - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            clock = clocks[idx]
+            if clock is not None:
+                records[idx].append(clock.send_at(payload, send_at + lead))
+            else:
+                records[idx].append(heads[idx].transport.send(payload))
+            lateness[idx].append(max(0.0, time.perf_counter() - send_at))
+
+        deadline = time.monotonic() + ack_timeout + lead
+        for head_records in records:
+            for record in head_records:
+                record.wait(max(0.0, deadline - time.monotonic()))
+
+        report = {}
+        for head, head_records, head_late, clock in zip(heads, records, lateness, clocks):
+            latency = sorted((r.t_ack - r.t_write) * 1000.0 for r in head_records
+                             if r.t_ack is not None and r.t_write is not None)
+            late = sorted(x * 1000.0 for x in head_late)
+            report[head.name] = {
+                'frames': len(head_records),
+                'acked': sum(1 for r in head_records if r.status == ACKED),
+                'failed': sum(1 for r in head_records if r.status not in (ACKED, SENT)),
+                'latency_p50_ms': percentile(latency, 50),
+                'latency_p99_ms': percentile(latency, 99),
+                'schedule_late_max_ms': late[-1] if late else None,
+                'clock_uncertainty_ms': clock.uncertainty_ms if clock is not None else None,
+            }
+        for head in self.heads:
+            if not head.connected:
+                report[head.name] = {'error': str(head.error) if head.error else "未连接"}
+        return report
+
+
+def _frame_options(head):
+    options = servo_caps.protocol_options(head.caps)
+    return {'use_batch': options['use_batch'], 'use_jaw_sync': options['use_jaw_sync']}
+
+
+def format_report(report):
+    lines = [f"{'头':<12}{'帧数':>6}{'应答':>6}{'失败':>6}{'p50延迟':>10}{'p99延迟':>10}{'最大调度延迟':>14}"
+             f"{'对时误差':>10}"]
+
+    def ms(value):
+        return '-' if value is None else f"{value:.1f}ms"
+
+    for name, item in report.items():
+        if 'error' in item:
+            lines.append(f"{name:<12}打开失败: {item['error']}")
+            continue
+        lines.append(f"{name:<12}{item['frames']:>6}{item['acked']:>6}{item['failed']:>6}"
+                     f"{ms(item['latency_p50_ms']):>10}{ms(item['latency_p99_ms']):>10}"
+                     f"{ms(item['schedule_late_max_ms']):>14}{ms(item['clock_uncertainty_ms']):>10}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="多头同步播放表情脚本")
+    parser.add_argument('fleet', nargs='?', help="多头配置文件（JSON）")
+    parser.add_argument('script', help="表情脚本文件")
+    parser.add_argument('--virtual', type=int, default=0, help="使用N个本地模拟设备代替配置文件")
+    parser.add_argument('--start-delay', type=float, default=0.5, help="同步开始前的准备时间（秒）")
+    parser.add_argument('--speed', type=float, default=1.0, help="播放速度倍数")
+    parser.add_argument('--window', type=int, default=4, help="每个头最多未应答的命令数")
+    parser.add_argument('--lead', type=float, default=DEFAULT_LEAD_S,
+                        help="支持定时执行的头提前写出的时间（秒），0 表示到时刻才发送")
+    parser.add_argument('--refresh', action='store_true', help="重新探测设备功能（固件升级后使用）")
+    args = parser.parse_args(argv)
+
+    if args.virtual:
+        config_file = os.path.join(BASE_DIR, 'servo_config.json')
+        fleet = Fleet([Head(f"virtual-{i + 1}", f"virtual:{i + 1}", config_file, window=args.window)
+                       for i in range(args.virtual)])
+    elif args.fleet:
+        fleet = Fleet.from_file(args.fleet, window=args.window)
+    else:
+        parser.error("需要多头配置文件或 --virtual N")
+
+    start = time.monotonic()
+    failed = fleet.open_all(refresh=args.refresh)
+    print(f"打开 {len(fleet.heads) - len(failed)}/{len(fleet.heads)} 个头，用时 {time.monotonic() - start:.2f}秒")
+    try:
+        report = fleet.play(load_script_file(args.script), args.start_delay, args.speed, lead=args.lead)
+        print(format_report(report))
+    finally:
+        fleet.close_all()
+    return 0 if not failed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
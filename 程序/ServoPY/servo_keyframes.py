@@ -0,0 +1,229 @@
+# filename: servo_keyframes.py
+# 用途：关键帧精简，把密集的动作轨迹（滑条录制、感知、口型同步）压缩成少量关键帧
+#
+# 按舵机分组分别精简：每组的轨迹看作 (时间, 各通道角度) 折线，用 Ramer–Douglas–Peucker
+# 算法只保留关键帧，使去掉的每个采样点与相邻关键帧之间线性插值的角度误差都不超过
+# tolerance（取组内各通道误差的最大值，联动舵机的关键帧时刻保持一致）。
+# 舵机收到目标后会全速转过去，因此两个关键帧之间角度变化超过 max_step 时
+# 再按线性插值补入中间帧，使缓慢的动作不会变成一次跳变。
+# 各组的关键帧按 resolution_ms 对齐后合并成帧，可以输出 Timeline 或表情脚本文本。
+#
+# 用法：
+#   python servo_keyframes.py 录制.srec -o 表情脚本/新表情.txt [--tolerance 1 --max-step 2]
+#   python servo_keyframes.py 表情脚本/07_完整表情演示.txt --stats
+
+import os
+import sys
+import math
+import json
+import argparse
+
+import servo_pose
+from servo_script import Frame, Timeline, compile_script, load_script_file
+
+DEFAULT_TOLERANCE = 1.0
+DEFAULT_MAX_STEP = 2
+DEFAULT_RESOLUTION_MS = 10
+
+
+def _deviation(points, first, last):
+    """first 与 last 之间的采样点到两端连线的最大角度误差，返回 (误差, 下标)"""
+    t0, v0 = points[first]
+    t1, v1 = points[last]
+    span = t1 - t0
+    worst, worst_idx = 0.0, first
+    for k in range(first + 1, last):
+        t, values = points[k]
+        ratio = (t - t0) / span if span > 0 else 0.0
+        for a0, a1, a in zip(v0, v1, values):
+            err = abs(a0 + (a1 - a0) * ratio - a)
+            if err > worst:
+                worst, worst_idx = err, k
+    return worst, worst_idx
+
+
+def simplify(points, tolerance=DEFAULT_TOLERANCE):
+    """Ramer–Douglas–Peucker 精简（迭代实现，长轨迹不会超出递归深度）
+
+    Args:
+        points: [(time_ms, (角度, ...)), ...]，按时间排列
+        tolerance: 允许的最大角度误差（度）
+
+    Returns:
+        保留的采样点下标（升序）
+    """
+    if len(points) <= 2:
+        return list(range(len(points)))
+    keep = {0, len(points) - 1}
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        worst, idx = _deviation(points, first, last)
+        if worst > tolerance:
+            keep.add(idx)
+            stack.append((first, idx))
+            stack.append((idx, last))
+    return sorted(keep)
+
+
+def limit_steps(keyframes, max_step=DEFAULT_MAX_STEP):
+    """相邻关键帧的角度变化超过 max_step 时按线性插值补入中间帧"""
+    if not max_step or len(keyframes) < 2:
+        return list(keyframes)
+    result = [keyframes[0]]
+    for (t0, v0), (t1, v1) in zip(keyframes, keyframes[1:]):
+        jump = max(abs(b - a) for a, b in zip(v0, v1))
+        # 同一时刻的跳变在原轨迹中也是跳变，不需要补帧
+        steps = int(math.ceil(jump / max_step)) if t1 > t0 else 1
+        for i in range(1, steps):
+            ratio = i / steps
+            result.append((t0 + (t1 - t0) * ratio,
+                           tuple(int(round(a + (b - a) * ratio)) for a, b in zip(v0, v1))))
+        result.append((t1, v1))
+    return result
+
+
+def group_tracks(timeline):
+    """把 Timeline 拆成每个舵机组的轨迹
+
+    舵机收到目标后保持该角度直到下一个目标，因此每次变化前补一个同一时刻的
+    保持点 (t, 旧角度)，使折线与实际的阶梯形状一致。
+
+    Returns:
+        {通道元组: [(time_ms, (各通道角度, ...)), ...]}，只包含角度有变化的采样点及其保持点。
+        通道元组是分组中在 Timeline 里出现过的通道；某通道首次出现前取它第一次出现时的角度。
+    """
+    first_seen = {}
+    for frame in timeline:
+        for ch, angle in frame.targets:
+            first_seen.setdefault(ch, angle)
+
+    current = dict(first_seen)
+    tracks = {}
+    for frame in timeline:
+        touched = set()
+        for ch, angle in frame.targets:
+            current[ch] = angle
+            touched.add(tuple(c for c in servo_pose.group_of(ch) if c in first_seen))
+        for channels in touched:
+            values = tuple(current[ch] for ch in channels)
+            track = tracks.setdefault(channels, [])
+            if track and track[-1][1] == values:
+                continue
+            if track and track[-1][0] == frame.time_ms:
+                track[-1] = (frame.time_ms, values)
+                if len(track) > 1 and track[-2][1] == values:
+                    track.pop()
+                continue
+            if track:
+                track.append((frame.time_ms, track[-1][1]))
+            track.append((frame.time_ms, values))
+    return tracks
+
+
+def reduce_timeline(timeline, tolerance=DEFAULT_TOLERANCE, max_step=DEFAULT_MAX_STEP,
+                    resolution_ms=DEFAULT_RESOLUTION_MS):
+    """精简 Timeline，返回新的 Timeline
+
+    Args:
+        tolerance: 允许的最大角度误差（度）
+        max_step: 相邻关键帧的最大角度变化（度），None 或 0 表示不限
+        resolution_ms: 关键帧时间对齐的粒度，同一粒度内各组的关键帧合并成一帧
+    """
+    merged = {}
+    for channels, track in group_tracks(timeline).items():
+        keyframes = [track[i] for i in simplify(track, tolerance)]
+        for time_ms, values in limit_steps(keyframes, max_step):
+            if resolution_ms:
+                time_ms = int(round(time_ms / resolution_ms)) * resolution_ms
+            merged.setdefault(time_ms, {}).update(zip(channels, values))
+
+    # 保持点与上一次发出的角度相同，去掉这些不改变姿态的目标
+    frames = []
+    current = {}
+    for time_ms, targets in sorted(merged.items()):
+        changed = tuple(sorted((ch, a) for ch, a in targets.items() if current.get(ch) != a))
+        if changed:
+            current.update(changed)
+            frames.append(Frame(time_ms, changed, ()))
+    return Timeline(frames, timeline.duration_ms, list(timeline.warnings))
+
+
+def _script_line(channels, targets):
+    """一个舵机组在一帧中的目标写成一条 "舵机X 角度" 命令"""
+    if channels[0] in (0, 1):
+        angle = targets[0] if 0 in targets else 180 - targets[1]
+        return f"舵机0 {angle}"
+    ch = channels[0]
+    if ch in servo_pose.PAIR_GROUPS:
+        ch = servo_pose.PAIR_GROUPS[ch][0] if servo_pose.PAIR_GROUPS[ch][0] in targets else ch
+    return f"舵机{ch} {targets[ch]}"
+
+
+def timeline_to_script(timeline, title=None):
+    """把 Timeline 写成表情脚本文本（联动舵机只写主动舵机，编译时再按分组规则展开）"""
+    lines = [f"# {title}"] if title else []
+    time_ms = 0
+    for frame in timeline:
+        delay = int(round(frame.time_ms - time_ms))
+        if delay > 0:
+            lines.append(f"延时 {delay}")
+            time_ms += delay
+        targets = dict(frame.targets)
+        written = set()
+        for ch, _ in frame.targets:
+            group = tuple(c for c in servo_pose.group_of(ch) if c in targets)
+            if group not in written:
+                written.add(group)
+                lines.append(_script_line(group, targets))
+    tail = int(round(timeline.duration_ms - time_ms))
+    if tail > 0:
+        lines.append(f"延时 {tail}")
+    return "\n".join(lines) + "\n"
+
+
+def load_timeline(file_path, config):
+    """读取动作录制（.srec/.npz）或表情脚本（.txt），返回 Timeline"""
+    if os.path.splitext(file_path)[1].lower() in ('.srec', '.npz'):
+        from motion_recorder import Recording
+        return Recording.load(file_path).to_timeline(config)
+    return compile_script(load_script_file(file_path), config)
+
+
+def _encoded_size(timeline):
+    return sum(len(payload) for _, payload in timeline.encoded_frames())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="把密集动作轨迹精简成关键帧脚本")
+    parser.add_argument('input', help="动作录制（.srec/.npz）或表情脚本（.txt）")
+    parser.add_argument('-o', '--output', help="输出的表情脚本文件")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help="允许的最大角度误差（度）")
+    parser.add_argument('--max-step', type=int, default=DEFAULT_MAX_STEP, help="相邻关键帧的最大角度变化，0表示不限")
+    parser.add_argument('--resolution', type=int, default=DEFAULT_RESOLUTION_MS, help="关键帧时间粒度（毫秒）")
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      'servo_config.json'))
+    parser.add_argument('--stats', action='store_true', help="显示精简前后的帧数和串口字节数")
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    timeline = load_timeline(args.input, config)
+    reduced = reduce_timeline(timeline, args.tolerance, args.max_step, args.resolution)
+
+    if args.stats or not args.output:
+        before, after = _encoded_size(timeline), _encoded_size(reduced)
+        print(f"帧数: {len(timeline)} -> {len(reduced)}  串口字节: {before} -> {after}"
+              f"（{before / max(1, after):.1f}倍）  时长: {timeline.duration_ms / 1000.0:.2f}秒")
+    if args.output:
+        title = f"由 {os.path.basename(args.input)} 精简生成（误差 {args.tolerance}°）"
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(timeline_to_script(reduced, title))
+        print(f"已写入 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
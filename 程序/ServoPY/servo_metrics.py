@@ -0,0 +1,252 @@
+# filename: servo_metrics.py
+# 用途：串口命令往返延迟与吞吐量统计
+#
+# 每条命令记录三个时间点：入队（enqueue）、写入串口（write）、收到全部应答（ack）。
+# 统计内容：滚动窗口延迟百分位数、延迟直方图、命令/秒、字节/秒、
+# 合并/丢弃/超时/错误计数、流控等待次数、队列深度和未应答命令数。
+# 可输出一行状态栏文本，或 Prometheus 文本格式（node_exporter textfile collector）。
+
+import os
+import threading
+import time
+from collections import deque
+
+# 直方图桶上限（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def percentile(ordered, pct):
+    """已排序样本的线性插值百分位数"""
+    if not ordered:
+        return None
+    pos = (len(ordered) - 1) * pct / 100.0
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+class TransportMetrics:
+    """线程安全的传输统计"""
+
+    def __init__(self, window=1024, rate_window=5.0):
+        """
+        Args:
+            window: 计算延迟百分位数的最近样本数
+            rate_window: 计算命令/秒的时间窗口（秒）
+        """
+        self.rate_window = rate_window
+        self._lock = threading.Lock()
+        self._latency = deque(maxlen=window)      # 入队 -> 应答
+        self._wire_latency = deque(maxlen=window) # 写入 -> 应答
+        self._writes = deque()                    # (时间, 通道命令数, 字节数)
+        self._buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+
+        self.commands_total = 0
+        self.bytes_total = 0
+        self.acked_total = 0
+        self.errors_total = 0
+        self.coalesced_total = 0
+        self.dropped_total = 0
+        self.timeouts_total = 0
+        self.stalls_total = 0
+        self.skipped_total = 0
+        self.drift_total = 0
+        self.queue_depth = 0
+        self.in_flight = 0
+
+    def record_write(self, record, now=None):
+        now = time.perf_counter() if now is None else now
+        with self._lock:
+            count = max(1, len(record.expected))
+            self.commands_total += count
+            self.bytes_total += len(record.payload)
+            self._writes.append((now, count, len(record.payload)))
+            self._trim(now)
+
+    def record_ack(self, record):
+        with self._lock:
+            if record.status == 'error':
+                self.errors_total += 1
+            else:
+                self.acked_total += 1
+            if record.t_ack is None:
+                return
+            # 定时命令从执行时刻算起
+            start = record.t_enqueue if record.due is None else max(record.t_enqueue, record.due)
+            latency = record.t_ack - start
+            self._latency.append(latency)
+            if record.t_write is not None:
+                self._wire_latency.append(record.t_ack - max(record.t_write, start))
+            self.latency_sum += latency
+            self.latency_count += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    self._buckets[i] += 1
+                    break
+            else:
+                self._buckets[-1] += 1
+
+    def record_coalesced(self, count=1):
+        with self._lock:
+            self.coalesced_total += count
+
+    def record_dropped(self, count=1):
+        with self._lock:
+            self.dropped_total += count
+
+    def record_timeout(self, count=1):
+        with self._lock:
+            self.timeouts_total += count
+
+    def record_stall(self, count=1):
+        with self._lock:
+            self.stalls_total += count
+
+    def record_skipped(self, count=1):
+        with self._lock:
+            self.skipped_total += count
+
+    def record_drift(self, count=1):
+        with self._lock:
+            self.drift_total += count
+
+    def set_depths(self, queue_depth, in_flight):
+        self.queue_depth = queue_depth
+        self.in_flight = in_flight
+
+    def _trim(self, now):
+        limit = now - self.rate_window
+        while self._writes and self._writes[0][0] < limit:
+            self._writes.popleft()
+
+    def snapshot(self):
+        """返回当前统计数据（延迟单位：毫秒）"""
+        now = time.perf_counter()
+        with self._lock:
+            self._trim(now)
+            latency = sorted(self._latency)
+            wire = sorted(self._wire_latency)
+            if self._writes:
+                # 刚开始发送时窗口未满，按实际经过时间计算（至少1秒）
+                span = min(self.rate_window, max(1.0, now - self._writes[0][0]))
+                cmds = sum(w[1] for w in self._writes)
+                nbytes = sum(w[2] for w in self._writes)
+            else:
+                span, cmds, nbytes = self.rate_window, 0, 0
+            snap = {
+                'latency_p50_ms': _ms(percentile(latency, 50)),
+                'latency_p90_ms': _ms(percentile(latency, 90)),
+                'latency_p99_ms': _ms(percentile(latency, 99)),
+                'latency_max_ms': _ms(latency[-1] if latency else None),
+                'wire_p50_ms': _ms(percentile(wire, 50)),
+                'wire_p99_ms': _ms(percentile(wire, 99)),
+                'commands_per_sec': cmds / span,
+                'bytes_per_sec': nbytes / span,
+                'commands_total': self.commands_total,
+                'bytes_total': self.bytes_total,
+                'acked_total': self.acked_total,
+                'errors_total': self.errors_total,
+                'coalesced_total': self.coalesced_total,
+                'dropped_total': self.dropped_total,
+                'timeouts_total': self.timeouts_total,
+                'stalls_total': self.stalls_total,
+                'skipped_total': self.skipped_total,
+                'drift_total': self.drift_total,
+                'queue_depth': self.queue_depth,
+                'in_flight': self.in_flight,
+            }
+        return snap
+
+    def status_text(self):
+        """状态栏显示的一行摘要"""
+        s = self.snapshot()
+        p50 = '-' if s['latency_p50_ms'] is None else f"{s['latency_p50_ms']:.1f}"
+        p99 = '-' if s['latency_p99_ms'] is None else f"{s['latency_p99_ms']:.1f}"
+        return (f"延迟 p50 {p50}ms / p99 {p99}ms | {s['commands_per_sec']:.1f} 命令/秒 | "
+                f"队列 {s['queue_depth']} 未应答 {s['in_flight']} | "
+                f"合并 {s['coalesced_total']} 丢弃 {s['dropped_total']} "
+                f"超时 {s['timeouts_total']} 错误 {s['errors_total']}")
+
+    def prometheus_text(self, labels=None):
+        """Prometheus 文本格式"""
+        s = self.snapshot()
+        label_str = ''
+        if labels:
+            label_str = ','.join(f'{k}="{_label_value(v)}"' for k, v in sorted(labels.items()))
+
+        def name(metric, extra=''):
+            inner = ','.join(x for x in (label_str, extra) if x)
+            return f"{metric}{{{inner}}}" if inner else metric
+
+        lines = []
+        with self._lock:
+            buckets = list(self._buckets)
+            latency_sum = self.latency_sum
+            latency_count = self.latency_count
+
+        lines.append("# HELP servo_command_latency_seconds 命令从入队到收到全部应答的时间")
+        lines.append("# TYPE servo_command_latency_seconds histogram")
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, buckets):
+            cumulative += count
+            le = 'le="%s"' % bound
+            lines.append(f"{name('servo_command_latency_seconds_bucket', le)} {cumulative}")
+        cumulative += buckets[-1]
+        le = 'le="+Inf"'
+        lines.append(f"{name('servo_command_latency_seconds_bucket', le)} {cumulative}")
+        lines.append(f'{name("servo_command_latency_seconds_sum")} {latency_sum:.6f}')
+        lines.append(f'{name("servo_command_latency_seconds_count")} {latency_count}')
+
+        lines.append("# HELP servo_command_latency_rolling_seconds 最近样本的延迟百分位数")
+        lines.append("# TYPE servo_command_latency_rolling_seconds gauge")
+        for q, key in (('0.5', 'latency_p50_ms'), ('0.9', 'latency_p90_ms'), ('0.99', 'latency_p99_ms')):
+            if s[key] is not None:
+                quantile = 'quantile="%s"' % q
+                lines.append(f"{name('servo_command_latency_rolling_seconds', quantile)} {s[key] / 1000:.6f}")
+
+        counters = (
+            ('servo_commands_total', 'commands_total', "写入串口的舵机通道命令数"),
+            ('servo_bytes_written_total', 'bytes_total', "写入串口的字节数"),
+            ('servo_commands_acked_total', 'acked_total', "收到应答的命令数"),
+            ('servo_command_errors_total', 'errors_total', "收到ERROR应答的命令数"),
+            ('servo_commands_coalesced_total', 'coalesced_total', "在队列中被新命令合并的命令数"),
+            ('servo_commands_dropped_total', 'dropped_total', "被丢弃的命令数"),
+            ('servo_command_timeouts_total', 'timeouts_total', "应答超时的命令数"),
+            ('servo_flow_control_stalls_total', 'stalls_total', "发送窗口已满、等待应答的次数"),
+            ('servo_commands_skipped_total', 'skipped_total', "差量发送时因角度未变化而省去的通道命令数"),
+            ('servo_state_drift_total', 'drift_total', "STATUS 校正时与镜像不一致的通道数"),
+        )
+        for metric, key, help_text in counters:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{name(metric)} {s[key]}")
+
+        gauges = (
+            ('servo_commands_per_second', 'commands_per_sec', "最近窗口内的命令/秒"),
+            ('servo_bytes_per_second', 'bytes_per_sec', "最近窗口内的字节/秒"),
+            ('servo_queue_depth', 'queue_depth', "待发送队列深度"),
+            ('servo_commands_in_flight', 'in_flight', "已发送未应答的命令数"),
+        )
+        for metric, key, help_text in gauges:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{name(metric)} {s[key]:g}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file_path, labels=None):
+        """原子地写出 Prometheus 文本文件（先写临时文件再替换）"""
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text(labels))
+        os.replace(tmp_path, file_path)
+
+
+def _label_value(value):
+    """按 Prometheus 文本格式转义标签值中的反斜杠、双引号和换行"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000.0
@@ -0,0 +1,115 @@
+# filename: servo_pose.py
+# 用途：舵机分组（反向联动）姿态计算，供 ZS_BOX、脚本编译器和基准测试共用
+#
+# 分组规则与 ZS_BOX.execute_script 一致：
+#   舵机0/1   下颚组，使用 JS 命令，舵机0=角度，舵机1=180-角度
+#   舵机2/3   上嘴角组，舵机2为主动舵机，舵机3按相对中间值的偏移量反向联动
+#   舵机4/5   下嘴角组，舵机4为主动舵机
+#   舵机6/7   上眼睑组，舵机6为主动舵机
+#   舵机8/9   下眼睑组，舵机8为主动舵机
+#   舵机12/14 眉梢组，指定的舵机为主动舵机
+#   舵机13/15 眉头组，指定的舵机为主动舵机（舵机15中间值取最小/最大值的平均）
+#   舵机10/11 眼球，单独控制
+
+# 配置缺失时使用的默认标定值 (最小值, 中间值, 最大值)
+DEFAULT_CALIBRATION = {
+    2: (56, 79, 98),
+    3: (38, 55, 75),
+    4: (82, 109, 137),
+    5: (35, 62, 95),
+    6: (63, 93, 123),
+    7: (25, 66, 106),
+    8: (99, 132, 163),
+    9: (61, 79, 103),
+    12: (66, 86, 103),
+    13: (35, 59, 89),
+    14: (68, 87, 112),
+    15: (106, 121, 136),
+}
+
+# 舵机ID -> (主动舵机, 联动舵机)
+PAIR_GROUPS = {
+    2: (2, 3), 3: (2, 3),
+    4: (4, 5), 5: (4, 5),
+    6: (6, 7), 7: (6, 7),
+    8: (8, 9), 9: (8, 9),
+    12: (12, 14), 14: (14, 12),
+    13: (13, 15), 15: (15, 13),
+}
+
+GROUP_NAMES = {
+    (0, 1): "下颚组",
+    (2, 3): "上嘴角组",
+    (4, 5): "下嘴角组",
+    (6, 7): "上眼睑组",
+    (8, 9): "下眼睑组",
+    (12, 14): "眉梢组",
+    (13, 15): "眉头组",
+}
+
+
+def calibration(config, servo_id):
+    """返回舵机的 (最小值, 中间值, 最大值)"""
+    dmin, dmid, dmax = DEFAULT_CALIBRATION.get(servo_id, (0, 90, 180))
+    smin = config.get(f'servo_{servo_id}_min', dmin)
+    smax = config.get(f'servo_{servo_id}_max', dmax)
+    if servo_id == 15:
+        # 舵机15使用真实中间值
+        smid = (smin + smax) / 2
+    else:
+        smid = config.get(f'servo_{servo_id}_mid', dmid)
+    return smin, smid, smax
+
+
+def mirror_angle(config, lead_id, follower_id, lead_angle):
+    """根据主动舵机相对中间值的偏移量（百分比），计算联动舵机的反向角度"""
+    lead_min, lead_mid, lead_max = calibration(config, lead_id)
+    follower_min, follower_mid, follower_max = calibration(config, follower_id)
+
+    if lead_max == lead_min:
+        offset_percent = 0
+    else:
+        offset_percent = (lead_angle - lead_mid) / (lead_max - lead_min)
+
+    follower_angle = follower_mid - (offset_percent * (follower_max - follower_min))
+    follower_angle = max(follower_min, min(follower_max, follower_angle))
+    return int(follower_angle)
+
+
+def clamp_servo_angle(config, servo_id, angle):
+    """按配置的最小/最大值限制单个舵机角度（与 send_servo_command 一致）"""
+    smin = config.get(f'servo_{servo_id}_min', 0)
+    smax = config.get(f'servo_{servo_id}_max', 180)
+    if smin > smax:
+        smin, smax = smax, smin
+    angle = max(smin, min(smax, angle))
+    return max(0, min(180, int(angle)))
+
+
+def jaw_pose(angle):
+    """下颚组在设备上的实际角度（JS命令：舵机0=角度，舵机1=180-角度）"""
+    angle = max(0, min(180, int(angle)))
+    return [(0, angle), (1, 180 - angle)]
+
+
+def group_pose(config, servo_id, angle):
+    """计算一条 "舵机X 角度" 命令在设备上产生的所有通道目标
+
+    Returns:
+        [(通道, 角度), ...]
+    """
+    if servo_id == 0 or servo_id == 1:
+        return jaw_pose(angle)
+    if servo_id in PAIR_GROUPS:
+        lead_id, follower_id = PAIR_GROUPS[servo_id]
+        return [(lead_id, angle), (follower_id, mirror_angle(config, lead_id, follower_id, angle))]
+    return [(servo_id, clamp_servo_angle(config, servo_id, angle))]
+
+
+def group_of(servo_id):
+    """返回舵机所属分组的通道元组，单独控制的舵机返回 (servo_id,)"""
+    if servo_id == 0 or servo_id == 1:
+        return (0, 1)
+    if servo_id in PAIR_GROUPS:
+        return tuple(sorted(PAIR_GROUPS[servo_id]))
+    return (servo_id,)
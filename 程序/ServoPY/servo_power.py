@@ -0,0 +1,191 @@
+# filename: servo_power.py
+# 用途：供电预算调度，把一帧中的大幅度动作错开到相邻的几个PWM周期，避免电流峰值拉低5V电源
+#
+# 16个舵机共用一路5V电源（经PCA9685），整脸换姿态时所有舵机同时启动，
+# 启动电流叠加可能使ESP32掉电重启。这里按舵机型号（与 Servo.ino 中 servoTypes 一致：
+# 舵机0/1为MG996R，其余为MG90s）和转动角度估算每个舵机在各个PWM周期的电流：
+#   启动周期  运行电流 + (堵转电流 - 运行电流) × min(1, 角度/SATURATE_DEG)
+#   之后      运行电流，直到按转速估算的转动时间结束
+# 再按电流从大到小，把每个舵机组放到最早的、不会使任一周期总电流超过预算的周期
+# （首次适应递减），从而在预算内用最少的周期完成整个动作。
+# 联动舵机组（下颚、嘴角、眼睑、眉毛）作为一个整体调度，保证同时启动。
+# 上一次转动尚未结束的舵机继续转动时没有启动电流，各周期都按运行电流计算，因此
+# 经过速度/加速度限制、每20ms一帧的轨迹（head_daemon 的实时姿态流）不会被当作一连串的启动。
+# 整段时间轴（stagger_timeline）应在速度/加速度限制之前对关键帧调度，
+# 每个动作按一次完整的转动估算。
+#
+# 配置项（servo_config.json）：
+#   power_budget_a   电源允许的峰值电流（安），0表示不限制，默认 4.0（5V 5A电源留出ESP32和余量）
+#   power_period_ms  调度周期（毫秒），默认20（SERVO_FREQ=50Hz）
+#   servo_X_type     舵机X的型号 "MG996R" / "MG90S"
+
+import math
+import time
+from collections import namedtuple
+
+import servo_pose
+from servo_script import Frame, Timeline
+
+# peak_a: 启动（接近堵转）电流；run_a: 转动时电流；speed_dps: 5V下的转速（度/秒）
+ServoModel = namedtuple('ServoModel', 'peak_a run_a speed_dps')
+
+SERVO_MODELS = {
+    'MG996R': ServoModel(2.5, 0.5, 300.0),
+    'MG90S': ServoModel(0.7, 0.15, 500.0),
+}
+
+# 与 Servo.ino 的 servoTypes 对应：前两个MG996R，其余MG90s
+DEFAULT_TYPES = ['MG996R', 'MG996R'] + ['MG90S'] * 14
+
+DEFAULT_BUDGET_A = 4.0
+DEFAULT_PERIOD_MS = 20
+# 转动角度达到该值时启动电流按堵转电流计算
+SATURATE_DEG = 30
+# 上一次角度未知时按该角度估算
+UNKNOWN_MOVE_DEG = 90
+# 单帧最多错开的周期数
+MAX_PERIODS = 50
+
+
+def servo_model(config, ch):
+    name = str(config.get(f'servo_{ch}_type', DEFAULT_TYPES[ch])).upper()
+    return SERVO_MODELS.get(name, SERVO_MODELS['MG90S'])
+
+
+def move_profile(model, delta, period_ms=DEFAULT_PERIOD_MS, running=False):
+    """一次转动在各个周期的估算电流（安）
+
+    Args:
+        delta: 转动角度
+        running: 舵机已在转动（上一次转动尚未结束），没有启动电流
+    """
+    delta = abs(delta)
+    if delta == 0:
+        return []
+    periods = max(1, int(math.ceil(delta / model.speed_dps * 1000.0 / period_ms)))
+    if running:
+        return [model.run_a] * periods
+    ratio = min(1.0, delta / SATURATE_DEG)
+    return [model.run_a + (model.peak_a - model.run_a) * ratio] + [model.run_a * ratio] * (periods - 1)
+
+
+class PowerScheduler:
+    """记录各通道当前角度和尚未结束的转动电流，把新的一帧拆成按周期错开的几部分"""
+
+    def __init__(self, config, budget_a=None, period_ms=None):
+        self.config = config
+        self.budget_a = config.get('power_budget_a', DEFAULT_BUDGET_A) if budget_a is None else budget_a
+        self.period_ms = period_ms or config.get('power_period_ms', DEFAULT_PERIOD_MS)
+        self.positions = {}
+        self._load = {}  # 周期序号 -> 已安排的电流
+        self._moving_until = {}  # 通道 -> 最近一次转动估计结束的周期序号
+
+    def reset(self, positions=None):
+        self.positions = dict(positions or {})
+        self._load.clear()
+        self._moving_until.clear()
+
+    def estimate(self, targets):
+        """一帧同时发出时启动周期的估算总电流（安）"""
+        total = 0.0
+        for ch, angle in dict(targets).items():
+            previous = self.positions.get(ch, angle - UNKNOWN_MOVE_DEG)
+            profile = move_profile(servo_model(self.config, ch), angle - previous, self.period_ms)
+            total += profile[0] if profile else 0.0
+        return total
+
+    def stagger(self, targets, now_ms=None):
+        """拆分一帧舵机目标
+
+        Args:
+            targets: [(通道, 角度), ...] 或 {通道: 角度}
+            now_ms: 这一帧的时刻（毫秒），默认取当前时间；同一调度器的时刻需单调递增
+
+        Returns:
+            [(相对本帧的延迟毫秒, {通道: 角度}), ...]，按延迟排列，第一部分延迟为0
+        """
+        targets = dict(targets)
+        if now_ms is None:
+            now_ms = time.monotonic() * 1000.0
+        base = int(now_ms // self.period_ms)
+        for index in [i for i in self._load if i < base]:
+            del self._load[index]
+
+        units = {}
+        for ch in targets:
+            group = tuple(c for c in servo_pose.group_of(ch) if c in targets)
+            units.setdefault(group, [])
+        planned = []
+        for group in units:
+            profile = []
+            for ch in group:
+                previous = self.positions.get(ch, targets[ch] - UNKNOWN_MOVE_DEG)
+                # 上一次转动持续到前一个周期（限速轨迹的连续各帧）时视为继续转动
+                running = self._moving_until.get(ch, base - 2) >= base - 1
+                for i, amps in enumerate(move_profile(servo_model(self.config, ch), targets[ch] - previous,
+                                                      self.period_ms, running)):
+                    if i < len(profile):
+                        profile[i] += amps
+                    else:
+                        profile.append(amps)
+            planned.append((max(profile) if profile else 0.0, group, profile))
+
+        parts = {}
+        for _, group, profile in sorted(planned, key=lambda item: -item[0]):
+            offset = self._place(base, profile)
+            for i, amps in enumerate(profile):
+                self._load[base + offset + i] = self._load.get(base + offset + i, 0.0) + amps
+            part = parts.setdefault(offset, {})
+            for ch in group:
+                if targets[ch] != self.positions.get(ch):
+                    self._moving_until[ch] = base + offset + max(0, len(profile) - 1)
+                part[ch] = targets[ch]
+                self.positions[ch] = targets[ch]
+        return [(offset * self.period_ms, part) for offset, part in sorted(parts.items())]
+
+    def _place(self, base, profile):
+        if not profile or not self.budget_a:
+            return 0
+        # 单个舵机组本身超过预算时，只要求不与其他转动叠加
+        budget = max(self.budget_a, max(profile))
+        for offset in range(MAX_PERIODS):
+            if all(self._load.get(base + offset + i, 0.0) + amps <= budget + 1e-9
+                   for i, amps in enumerate(profile)):
+                return offset
+        return MAX_PERIODS
+
+
+def stagger_timeline(timeline, config, budget_a=None, initial=None):
+    """对整个 Timeline 做供电预算调度，返回新的 Timeline
+
+    应在 servo_trajectory.limit_timeline 之前对编译出的关键帧调用，每个动作按一次完整的转动估算。
+    错开后的部分如果晚于后续帧对同一通道的设置，则丢弃（后续帧优先）。
+
+    Args:
+        initial: 开始时各通道角度 {通道: 角度}，未知的通道按 UNKNOWN_MOVE_DEG 估算
+    """
+    scheduler = PowerScheduler(config, budget_a)
+    if not scheduler.budget_a:
+        return timeline
+    scheduler.reset(initial)
+    events = []
+    for index, frame in enumerate(timeline):
+        for offset, part in scheduler.stagger(frame.targets, frame.time_ms):
+            events.append((frame.time_ms + offset, index, part, frame.line_nums))
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    latest = {}  # 通道 -> 已生效的最新帧序号
+    merged = {}
+    for time_ms, index, part, line_nums in events:
+        applied = {ch: a for ch, a in part.items() if latest.get(ch, -1) <= index}
+        if not applied:
+            continue
+        for ch in applied:
+            latest[ch] = index
+        targets, lines = merged.setdefault(time_ms, ({}, []))
+        targets.update(applied)
+        lines.extend(n for n in line_nums if n not in lines)
+    frames = [Frame(t, tuple(sorted(targets.items())), tuple(lines))
+              for t, (targets, lines) in sorted(merged.items())]
+    duration = max([timeline.duration_ms] + [frame.time_ms for frame in frames])
+    return Timeline(frames, duration, list(timeline.warnings))
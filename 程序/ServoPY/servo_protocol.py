@@ -0,0 +1,338 @@
+# filename: servo_protocol.py
+# 用途：ESP32舵机固件（Servo.ino）串口协议的编码与应答解析
+#
+# 命令格式（以换行结束）：
+#   S<ch>,<angle>            单个舵机
+#   S<ch>,<angle>;<ch>,<angle>;...   批量命令
+#   JS<angle>                下颚同步（舵机0=angle，舵机1=180-angle）
+#   M<ms>,<easing>:<ch>,<angle>;<ch>,<angle>;...
+#                            分段插值：各舵机从当前角度在 ms 毫秒内按缓动曲线转到目标，
+#                            设备每个PWM周期（20ms）更新一次角度（固件 CAPS 中 segment=1）
+#   T<seq>                   对时：设备应答收到该行和发出应答时的 millis()
+#   @<device_ms>:<命令>      定时执行：设备在自己的 millis() 到达 device_ms 时执行命令，
+#                            已经过了执行时刻的立即执行（固件 CAPS 中 schedule=1）
+#   STATUS / RESET / HELP / DEBUG / CAPS
+#
+# 应答格式：
+#   OK:S<ch>,<angle>         每个舵机设置成功各一行（批量命令每个通道一行）
+#   OK:JS<angle>             下颚同步完成（旧版固件没有此应答）
+#   OK:M<ch>,<angle>         分段插值已开始，每个通道一行
+#   ERROR:<原因>
+#   STATUS:S0=90,S1=90,...
+#   CAPS:version=1,batch=1,js=1,...   固件支持的协议功能（旧版固件没有此命令）
+#   TIME:<seq>,<收到时刻>,<应答时刻>   对时应答，时刻为设备 millis()
+#   定时命令在执行时才给出被包装命令的 OK 应答；无法排队时立即应答
+#   ERROR:@<device_ms> <原因>
+#   DEBUG:... / RESET:...
+
+SERVO_COUNT = 16
+
+# 分段插值的缓动曲线编号（与 Servo.ino 的 EASE_* 一致）
+EASINGS = {
+    'linear': 0,
+    'inout': 1,
+    'in': 2,
+    'out': 3,
+}
+DEFAULT_EASING = 'inout'
+MAX_SEGMENT_MS = 65535
+# 设备更新插值角度的周期（SERVO_FREQ=50Hz）
+SEGMENT_TICK_MS = 20
+# 设备 millis() 为32位无符号数，约49.7天回绕
+DEVICE_CLOCK_WRAP = 1 << 32
+# 固件定时命令队列长度
+SCHEDULE_SIZE = 16
+
+
+def clamp_angle(angle):
+    """把角度限制在固件接受的 0-180 整数范围内"""
+    angle = int(angle)
+    if angle < 0:
+        return 0
+    if angle > 180:
+        return 180
+    return angle
+
+
+def format_single(channel, angle):
+    """单舵机命令，例如 b"S2,74\\n" """
+    return f"S{int(channel)},{clamp_angle(angle)}\n".encode()
+
+
+def format_batch(targets):
+    """批量命令，例如 b"S2,74;3,112\\n"
+
+    Args:
+        targets: [(通道, 角度), ...]
+    """
+    parts = [f"{int(ch)},{clamp_angle(ang)}" for ch, ang in targets]
+    return ("S" + ";".join(parts) + "\n").encode()
+
+
+def format_jaw(angle):
+    """下颚同步命令，例如 b"JS90\\n" """
+    return f"JS{clamp_angle(angle)}\n".encode()
+
+
+def format_segment(targets, duration_ms, easing=DEFAULT_EASING):
+    """分段插值命令，例如 b"M400,1:2,74;3,112\\n"
+
+    Args:
+        targets: [(通道, 角度), ...] 或 {通道: 角度}
+        duration_ms: 插值时长（毫秒），0 表示立即到位
+        easing: EASINGS 中的名称
+    """
+    duration_ms = max(0, min(MAX_SEGMENT_MS, int(round(duration_ms))))
+    items = sorted(dict(targets).items())
+    parts = [f"{int(ch)},{clamp_angle(ang)}" for ch, ang in items]
+    return f"M{duration_ms},{EASINGS[easing]}:{';'.join(parts)}\n".encode()
+
+
+def ease(easing, t):
+    """缓动曲线：t 为 0~1 的时间进度，返回 0~1 的位置进度（与固件 easeProgress 相同）
+
+    easing 为 EASINGS 中的名称或编号。
+    """
+    easing = EASINGS.get(easing, easing)
+    t = min(1.0, max(0.0, t))
+    if easing == EASINGS['linear']:
+        return t
+    if easing == EASINGS['in']:
+        return t * t
+    if easing == EASINGS['out']:
+        return t * (2.0 - t)
+    return t * t * (3.0 - 2.0 * t)
+
+
+def format_time_request(seq):
+    """对时命令，例如 b"T7\\n" """
+    return f"T{int(seq)}\n".encode()
+
+
+def format_scheduled(payload, device_ms):
+    """给命令字节的每一行加上定时前缀，例如 b"@123456:S2,74\\n"
+
+    Args:
+        payload: 一条或多条命令（bytes 或 str）
+        device_ms: 执行时刻（设备 millis()，自动按32位回绕）
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8', errors='replace')
+    prefix = f"@{int(device_ms) % DEVICE_CLOCK_WRAP}:"
+    return "".join(prefix + line + "\n" for line in payload.split("\n") if line.strip()).encode()
+
+
+def split_scheduled(line):
+    """拆分定时命令 "@<device_ms>:<命令>"，返回 (device_ms, 命令)；不是定时命令时 device_ms 为 None"""
+    if not line.startswith('@'):
+        return None, line
+    at, sep, command = line[1:].partition(':')
+    if not sep or not at.strip().isdigit():
+        return None, line
+    return int(at), command.strip()
+
+
+def is_jaw_pair(targets_dict):
+    """判断目标中舵机0和1是否满足 JS 命令的反向同步关系"""
+    if 0 in targets_dict and 1 in targets_dict:
+        return targets_dict[0] + targets_dict[1] == 180
+    return False
+
+
+def encode_frame(targets, use_batch=True, use_jaw_sync=True):
+    """把一帧舵机目标编码成要写入串口的字节
+
+    舵机0/1满足反向同步时使用 JS 命令，其余通道优先合并成一条批量命令，
+    不支持批量命令时逐条发送单舵机命令。
+
+    Args:
+        targets: [(通道, 角度), ...] 或 {通道: 角度}
+        use_batch: 设备是否支持批量命令
+        use_jaw_sync: 设备是否支持 JS 命令
+
+    Returns:
+        bytes，可能包含多行命令
+    """
+    if isinstance(targets, dict):
+        targets_dict = dict(targets)
+    else:
+        targets_dict = {}
+        for ch, ang in targets:
+            targets_dict[int(ch)] = ang
+
+    chunks = []
+    if use_jaw_sync and is_jaw_pair(targets_dict):
+        chunks.append(format_jaw(targets_dict.pop(0)))
+        targets_dict.pop(1)
+
+    rest = sorted(targets_dict.items())
+    if not rest:
+        return b"".join(chunks)
+    if use_batch and len(rest) > 1:
+        chunks.append(format_batch(rest))
+    else:
+        chunks.extend(format_single(ch, ang) for ch, ang in rest)
+    return b"".join(chunks)
+
+
+def expected_oks(payload):
+    """命令字节中每个舵机设置期望收到的 OK 应答内容
+
+    Args:
+        payload: 一条或多条命令（bytes 或 str）
+
+    Returns:
+        [(通道, 角度), ...]，顺序与固件执行顺序一致；JS/RESET 等命令没有 OK 应答
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8', errors='replace')
+    oks = []
+    for line in payload.split('\n'):
+        line = split_scheduled(line.strip())[1]
+        if line.startswith('M'):
+            # 分段插值：每个通道一条 OK:M 应答
+            line = line.partition(':')[2]
+        elif not line.startswith('S') or line == 'STATUS':
+            continue
+        else:
+            line = line[1:]
+        for part in line.split(';'):
+            if not part:
+                continue
+            ch, _, ang = part.partition(',')
+            try:
+                # 固件把空通道号当作通道0
+                oks.append((int(ch.strip() or 0), int(ang)))
+            except ValueError:
+                # 格式错误的命令会收到 ERROR 应答
+                continue
+    return oks
+
+
+def expected_replies(payload, jaw_ack=False):
+    """命令字节执行完成前设备会给出的全部应答标记，用于发送窗口的应答匹配
+
+    Args:
+        payload: 一条或多条命令（bytes 或 str）
+        jaw_ack: 设备是否对 JS 命令应答 OK:JS<angle>
+
+    Returns:
+        按执行顺序排列的标记列表：(通道, 角度) 对应 OK:S 应答，
+        ('JS', 角度) 对应 OK:JS 应答，('RESET',) 对应 RESET 完成；
+        分段插值的 OK:M 应答与 OK:S 相同，为 (通道, 角度)
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8', errors='replace')
+    tokens = []
+    for line in payload.split('\n'):
+        line = split_scheduled(line.strip())[1]
+        if line == 'RESET':
+            tokens.append(('RESET',))
+        elif line.startswith('JS'):
+            if jaw_ack:
+                try:
+                    tokens.append(('JS', int(line[2:].strip() or 0)))
+                except ValueError:
+                    # 固件 toInt() 解析失败时为0
+                    tokens.append(('JS', 0))
+        else:
+            tokens.extend(expected_oks(line))
+    return tokens
+
+
+def payload_targets(payload):
+    """命令字节执行后舵机角度的变化，用于维护设备状态镜像
+
+    Returns:
+        [(通道, 角度), ...]，按执行顺序；JS 展开为舵机0/1，RESET 为全部舵机90度，
+        超出范围（设备会应答 ERROR）的设置不包含在内
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8', errors='replace')
+    targets = []
+    for line in payload.split('\n'):
+        line = split_scheduled(line.strip())[1]
+        if line == 'RESET':
+            targets.extend((ch, 90) for ch in range(SERVO_COUNT))
+        elif line.startswith('JS'):
+            try:
+                angle = int(line[2:].strip() or 0)
+            except ValueError:
+                angle = 0
+            if 0 <= angle <= 180:
+                targets.extend([(0, angle), (1, 180 - angle)])
+        else:
+            targets.extend((ch, ang) for ch, ang in expected_oks(line)
+                           if 0 <= ch < SERVO_COUNT and 0 <= ang <= 180)
+    return targets
+
+
+def reply_token(kind, content):
+    """把一行应答转换成 expected_replies 中的标记，不是完成应答时返回 None"""
+    if kind == 'OK':
+        return parse_ok(content)
+    if kind == 'RESET' and content.startswith('All servos reset complete'):
+        return ('RESET',)
+    return None
+
+
+def parse_reply(line):
+    """解析一行设备应答
+
+    Returns:
+        (类型, 内容)，类型为 'OK' / 'ERROR' / 'STATUS' / 'DEBUG' / 'RESET' / 'CAPS' / 'TIME' / 'TEXT'
+    """
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', errors='replace')
+    line = line.strip()
+    for kind in ('OK', 'ERROR', 'STATUS', 'DEBUG', 'RESET', 'CAPS', 'TIME'):
+        prefix = kind + ':'
+        if line.startswith(prefix):
+            return kind, line[len(prefix):]
+    return 'TEXT', line
+
+
+def parse_ok(payload):
+    """解析 OK 应答内容
+
+    "S<ch>,<angle>" / "M<ch>,<angle>" 返回 (通道, 角度)，"JS<angle>" 返回 ('JS', 角度)，
+    无法解析时返回 None
+    """
+    if payload.startswith('JS'):
+        try:
+            return 'JS', int(payload[2:])
+        except ValueError:
+            return None
+    if not payload.startswith(('S', 'M')):
+        return None
+    try:
+        ch, ang = payload[1:].split(',', 1)
+        return int(ch), int(ang)
+    except ValueError:
+        return None
+
+
+def parse_time(payload):
+    """解析 TIME 应答内容 "<seq>,<收到时刻>,<应答时刻>"，返回三个整数的元组，无法解析时返回 None"""
+    try:
+        seq, received, sent = (int(item) for item in payload.split(','))
+    except ValueError:
+        return None
+    return seq, received, sent
+
+
+def parse_status(payload):
+    """解析 STATUS 应答内容 "S0=90,S1=90,..."，返回16个通道的角度列表"""
+    angles = [None] * SERVO_COUNT
+    for item in payload.split(','):
+        item = item.strip()
+        if not item.startswith('S') or '=' not in item:
+            continue
+        try:
+            ch, ang = item[1:].split('=', 1)
+            ch = int(ch)
+            if 0 <= ch < SERVO_COUNT:
+                angles[ch] = int(ang)
+        except ValueError:
+            continue
+    return angles
@@ -0,0 +1,228 @@
+# filename: servo_script.py
+# 用途：表情脚本（"舵机X 角度" / "延时 毫秒数" / "延时 自动"）的解析与编译
+#
+# 解析规则与 ZS_BOX.execute_script 一致；编译时按舵机分组规则（servo_pose）
+# 展开联动舵机，并把两次延时之间的所有舵机命令合并成一帧，
+# 得到按时间排列的帧序列（Timeline），可以直接编码成串口命令。
+# "延时 自动" 按舵机转动时间模型（servo_slew）等待到全部舵机到位。
+#
+# Timeline 带快照索引：每 SNAPSHOT_INTERVAL 帧保存一次完整的16通道状态，
+# 定位到任意时刻只需二分查找加重放不超过 SNAPSHOT_INTERVAL 帧，
+# 用于预览、从中间继续播放和跳转。
+
+import bisect
+from collections import namedtuple
+
+import servo_pose
+from servo_protocol import encode_frame
+
+# kind: 'servo'（value为角度）/ 'delay'（value为毫秒，"延时 自动"为 None）/ 'invalid'（value为错误说明）
+ScriptCommand = namedtuple('ScriptCommand', 'kind line_num servo_id value text')
+
+# time_ms: 帧相对脚本开始的时间；targets: ((通道, 角度), ...)；line_nums: 产生该帧的脚本行号
+Frame = namedtuple('Frame', 'time_ms targets line_nums')
+
+# "延时 自动" 中可以使用的写法
+AUTO_DELAY_WORDS = ('自动', 'auto')
+
+# 快照索引的间隔（帧数）
+SNAPSHOT_INTERVAL = 64
+
+
+def parse_line(line, line_num=0):
+    """解析一行脚本，空行和注释行返回 None"""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+
+    if line.startswith('舵机'):
+        parts = line.split()
+        if len(parts) < 2:
+            return ScriptCommand('invalid', line_num, None, "命令格式错误", line)
+        try:
+            servo_id = int(parts[0][2:])
+            angle = int(parts[1])
+        except ValueError:
+            return ScriptCommand('invalid', line_num, None, "命令格式错误", line)
+        if 0 <= servo_id < 16 and 0 <= angle <= 180:
+            return ScriptCommand('servo', line_num, servo_id, angle, line)
+        return ScriptCommand('invalid', line_num, None, "无效命令", line)
+
+    if line.startswith('延时'):
+        parts = line.split()
+        if len(parts) < 2:
+            return ScriptCommand('invalid', line_num, None, "延时格式错误", line)
+        if parts[1].lower() in AUTO_DELAY_WORDS:
+            return ScriptCommand('delay', line_num, None, None, line)
+        try:
+            return ScriptCommand('delay', line_num, None, int(parts[1]), line)
+        except ValueError:
+            return ScriptCommand('invalid', line_num, None, "延时格式错误", line)
+
+    return ScriptCommand('invalid', line_num, None, "未知命令", line)
+
+
+def iter_script(lines):
+    """逐行解析脚本（生成器），跳过空行和注释"""
+    for line_num, line in enumerate(lines, 1):
+        command = parse_line(line, line_num)
+        if command is not None:
+            yield command
+
+
+def parse_script(text):
+    """解析整段脚本文本，返回 ScriptCommand 列表"""
+    return list(iter_script(text.split('\n')))
+
+
+def load_script_file(file_path):
+    """读取脚本文件内容"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+class Timeline:
+    """编译后的脚本：按时间排列的帧序列"""
+
+    def __init__(self, frames, duration_ms, warnings=None, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.frames = frames
+        self.duration_ms = duration_ms
+        self.warnings = warnings or []
+        self.snapshot_interval = snapshot_interval
+        self._times = None
+        self._snapshots = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def final_pose(self, initial=None):
+        """脚本结束时各通道的角度（未被脚本设置的通道取 initial 中的值）"""
+        pose = list(initial) if initial is not None else [None] * 16
+        for frame in self.frames:
+            for ch, angle in frame.targets:
+                pose[ch] = angle
+        return pose
+
+    def build_index(self):
+        """建立快照索引：第 k 个快照是第 k × snapshot_interval 帧执行前的16通道状态"""
+        times = []
+        snapshots = []
+        pose = [None] * 16
+        for i, frame in enumerate(self.frames):
+            if i % self.snapshot_interval == 0:
+                snapshots.append(tuple(pose))
+            times.append(frame.time_ms)
+            for ch, angle in frame.targets:
+                pose[ch] = angle
+        self._times = times
+        self._snapshots = snapshots
+
+    def seek(self, time_ms):
+        """定位到 time_ms 时刻
+
+        Returns:
+            (各通道角度列表（未设置过为 None）, 之后第一帧的下标)；恰好在 time_ms 的帧视为已执行
+        """
+        if self._times is None or len(self._times) != len(self.frames):
+            self.build_index()
+        count = bisect.bisect_right(self._times, time_ms)
+        if not count:
+            return [None] * 16, 0
+        block = min(count // self.snapshot_interval, len(self._snapshots) - 1)
+        pose = list(self._snapshots[block])
+        for frame in self.frames[block * self.snapshot_interval:count]:
+            for ch, angle in frame.targets:
+                pose[ch] = angle
+        return pose, count
+
+    def state_at(self, time_ms, initial=None):
+        """time_ms 时刻各通道的角度（未被脚本设置的通道取 initial 中的值）"""
+        pose, _ = self.seek(time_ms)
+        if initial is not None:
+            pose = [a if a is not None else b for a, b in zip(pose, initial)]
+        return pose
+
+    def slice_from(self, time_ms):
+        """从 time_ms 开始的 Timeline：第一帧（时刻0）设置该时刻的完整姿态，之后的帧时间前移"""
+        pose, index = self.seek(time_ms)
+        frames = []
+        targets = tuple((ch, angle) for ch, angle in enumerate(pose) if angle is not None)
+        if targets:
+            frames.append(Frame(0, targets, ()))
+        frames.extend(Frame(frame.time_ms - time_ms, frame.targets, frame.line_nums)
+                      for frame in self.frames[index:])
+        return Timeline(frames, max(0, self.duration_ms - time_ms), list(self.warnings),
+                        self.snapshot_interval)
+
+    def scaled(self, speed):
+        """按播放速度缩放的 Timeline：帧时刻和总时长除以 speed
+
+        应在速度/加速度限制和供电预算错开之前调用，加快播放时舵机仍不会超过限制。
+        """
+        if speed == 1:
+            return self
+        frames = [Frame(int(round(frame.time_ms / speed)), frame.targets, frame.line_nums)
+                  for frame in self.frames]
+        return Timeline(frames, int(round(self.duration_ms / speed)), list(self.warnings),
+                        self.snapshot_interval)
+
+    def encoded_frames(self, use_batch=True, use_jaw_sync=True):
+        """把每一帧编码成串口字节，返回 [(time_ms, bytes), ...]"""
+        return [(frame.time_ms, encode_frame(frame.targets, use_batch, use_jaw_sync))
+                for frame in self.frames]
+
+
+def compile_script(script, config, line_gap_ms=0, initial=None):
+    """把脚本编译成 Timeline
+
+    Args:
+        script: 脚本文本，或 parse_script 返回的命令列表
+        config: 舵机配置（servo_config.json 的内容）
+        line_gap_ms: 每条舵机命令之后的固定间隔。ZS_BOX 逐行执行时每条命令后
+            会等待100ms，传入100可得到与界面运行一致的时间轴；默认0表示
+            同一延时区间内的命令合并成一帧同时发送。
+        initial: 开始时各通道角度 {通道: 角度}，用于计算 "延时 自动"
+    """
+    commands = parse_script(script) if isinstance(script, str) else script
+    slew = None
+    if any(command.kind == 'delay' and command.value is None for command in commands):
+        from servo_slew import SlewTracker
+        slew = SlewTracker(config, initial)
+
+    frames = []
+    warnings = []
+    time_ms = 0
+    pending = {}
+    pending_lines = []
+
+    def flush():
+        if pending:
+            frames.append(Frame(time_ms, tuple(sorted(pending.items())), tuple(pending_lines)))
+            pending.clear()
+            del pending_lines[:]
+
+    for command in commands:
+        if command.kind == 'servo':
+            targets = servo_pose.group_pose(config, command.servo_id, command.value)
+            for ch, angle in targets:
+                pending[ch] = angle
+            pending_lines.append(command.line_num)
+            if slew is not None:
+                slew.move(targets, time_ms)
+            if line_gap_ms:
+                flush()
+                time_ms += line_gap_ms
+        elif command.kind == 'delay':
+            flush()
+            if command.value is None:
+                time_ms += slew.dwell_ms(time_ms)
+            else:
+                time_ms += max(0, command.value)
+        else:
+            warnings.append(f"第{command.line_num}行 {command.value}: {command.text}")
+
+    flush()
+    return Timeline(frames, time_ms, warnings)
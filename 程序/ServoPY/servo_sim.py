@@ -0,0 +1,219 @@
+# filename: servo_sim.py
+# 用途：虚拟时钟仿真，不连接设备、不按真实时间等待，立即得到脚本的运行结果
+#
+# 按编译后的 Timeline 在虚拟时钟上推进：每帧编码成串口字节，按波特率计算传输时间
+# （前一帧没发完时排队），在最后一个字节到达设备时更新各通道角度。得到：
+#   - 每个通道的角度变化时间线、结束姿态
+#   - 总时长、串口字节数、峰值总线占用率（滑动窗口内传输时间占比）和最大排队延迟
+# 可选与界面一致的时间（--gui）：运行前归零（RESET + 等待）、每条舵机命令后100ms、
+# 延时按100ms向下取整，用于估算在 ZS_BOX 中运行的时长。
+#
+# 用法：
+#   python servo_sim.py 表情脚本/07_完整表情演示.txt
+#   python servo_sim.py 表情脚本/*.txt --gui --json
+#   python servo_sim.py 录制脚本.txt --limit --stagger   # 与 head_daemon/servo_fleet 播放时的处理一致
+#   python servo_sim.py 录制脚本.txt --segments          # 由设备分段插值（M 命令），比较串口字节数
+#   python servo_sim.py 表情脚本/*.txt --strict     # 有警告或总线过载时返回非0（用于检查）
+
+import os
+import sys
+import json
+import glob
+import argparse
+from collections import deque
+
+import servo_caps
+from servo_script import compile_script, parse_script, load_script_file
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BAUD = 115200
+LOAD_WINDOW_MS = 100
+# 与 ZS_BOX / 固件一致的时间常数
+GUI_LINE_GAP_MS = 100        # execute_script 每条舵机命令后 sleep(0.1)
+GUI_DELAY_STEP_MS = 100      # 延时按 sleep(0.1) 循环，向下取整到100ms
+GUI_RESET_WAIT_MS = 1500     # reset_all_servos 发送 RESET 后等待
+GUI_PRE_SCRIPT_MS = 1000     # execute_script_with_reset 归零后再等待
+RESET_STEP_MS = 50           # 固件 RESET 每个舵机之间的延时
+RESET_ANGLE = 90
+
+
+class SimResult:
+    """仿真结果"""
+
+    def __init__(self):
+        self.channels = {}        # 通道 -> [(time_ms, 角度), ...]
+        self.duration_ms = 0
+        self.frames = 0
+        self.bytes_total = 0
+        self.peak_load = 0.0      # 峰值总线占用率（0~1，大于1表示排队）
+        self.max_backlog_ms = 0.0
+        self.warnings = []
+
+    def final_pose(self):
+        return {ch: history[-1][1] for ch, history in sorted(self.channels.items())}
+
+    def pose_at(self, time_ms):
+        pose = {}
+        for ch, history in self.channels.items():
+            for t, angle in history:
+                if t > time_ms:
+                    break
+                pose[ch] = angle
+        return dict(sorted(pose.items()))
+
+    def summary(self):
+        return {
+            'duration_ms': round(self.duration_ms, 1),
+            'frames': self.frames,
+            'bytes': self.bytes_total,
+            'peak_load': round(self.peak_load, 3),
+            'max_backlog_ms': round(self.max_backlog_ms, 1),
+            'final_pose': {str(ch): angle for ch, angle in self.final_pose().items()},
+            'warnings': self.warnings,
+        }
+
+
+def gui_commands(commands):
+    """按 ZS_BOX.execute_script 的实际等待时间调整延时命令"""
+    return [c._replace(value=c.value // GUI_DELAY_STEP_MS * GUI_DELAY_STEP_MS)
+            if c.kind == 'delay' and c.value is not None else c
+            for c in commands]
+
+
+def simulate(script, config, caps=None, baud=DEFAULT_BAUD, gui=False, transform=None):
+    """在虚拟时钟上运行脚本
+
+    Args:
+        script: 脚本文本、命令列表或已编译的 Timeline
+        config: 舵机配置
+        caps: 设备功能（servo_caps），决定批量/JS命令编码，默认按新固件
+        gui: 使用与 ZS_BOX 界面运行一致的时间（运行前后归零、每行100ms）
+        transform: 可选，对 Timeline 的处理函数（如 servo_trajectory.limit_timeline、segment_timeline）
+
+    Returns:
+        SimResult
+    """
+    if hasattr(script, 'frames'):
+        timeline = script
+    else:
+        commands = parse_script(script) if isinstance(script, str) else list(script)
+        if gui:
+            commands = gui_commands(commands)
+        timeline = compile_script(commands, config, GUI_LINE_GAP_MS if gui else 0)
+    if transform is not None:
+        timeline = transform(timeline)
+    options = servo_caps.protocol_options(caps or {'batch': True, 'js': True})
+    byte_ms = 10000.0 / baud  # 8N1：每字节10位
+
+    result = SimResult()
+    result.warnings = list(timeline.warnings)
+    offset = 0
+    if gui:
+        # 运行前归零：RESET 后固件逐个把舵机转到90度
+        for ch in range(16):
+            result.channels.setdefault(ch, []).append((ch * RESET_STEP_MS, RESET_ANGLE))
+        offset = GUI_RESET_WAIT_MS + GUI_PRE_SCRIPT_MS
+
+    line_free = 0.0
+    sent = deque()  # 窗口内各帧的 (开始, 结束) 传输区间
+    busy = 0.0
+    encoded = timeline.encoded_frames(options['use_batch'], options['use_jaw_sync'])
+    for frame, (_, payload) in zip(timeline, encoded):
+        time_ms = frame.time_ms + offset
+        # 前一帧还没发完时排在它后面，目标在最后一个字节到达设备时生效
+        start = max(float(time_ms), line_free)
+        end = start + len(payload) * byte_ms
+        line_free = end
+        result.max_backlog_ms = max(result.max_backlog_ms, start - time_ms)
+        result.frames += 1
+        result.bytes_total += len(payload)
+        # 分段插值的目标在插值结束时到达
+        arrive = end + getattr(frame, 'duration_ms', 0)
+        for ch, angle in frame.targets:
+            history = result.channels.setdefault(ch, [])
+            if not history or history[-1][1] != angle:
+                history.append((arrive, angle))
+
+        sent.append((start, end))
+        busy += end - start
+        while sent[0][1] <= end - LOAD_WINDOW_MS:
+            s, e = sent.popleft()
+            busy -= e - s
+        # 窗口左端落在第一帧传输中间时只计窗口内的部分
+        window_busy = busy - max(0.0, end - LOAD_WINDOW_MS - sent[0][0])
+        result.peak_load = max(result.peak_load, window_busy / LOAD_WINDOW_MS)
+
+    end_ms = max(float(timeline.duration_ms + offset), line_free)
+    if gui:
+        # 运行结束后 ZS_BOX 再次归零
+        for ch in range(16):
+            result.channels.setdefault(ch, []).append((end_ms + ch * RESET_STEP_MS, RESET_ANGLE))
+        end_ms += GUI_RESET_WAIT_MS
+    result.duration_ms = end_ms
+    return result
+
+
+def load_config(path=None):
+    with open(path or os.path.join(BASE_DIR, 'servo_config.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="虚拟时钟仿真表情脚本（不连接设备）")
+    parser.add_argument('scripts', nargs='+', help="表情脚本文件，可用通配符")
+    parser.add_argument('--config', help="舵机配置文件，默认 servo_config.json")
+    parser.add_argument('--baud', type=int, default=DEFAULT_BAUD)
+    parser.add_argument('--legacy', action='store_true', help="按旧版固件编码（无批量/JS命令）")
+    parser.add_argument('--gui', action='store_true', help="使用与 ZS_BOX 界面运行一致的时间")
+    parser.add_argument('--limit', action='store_true', help="按速度/加速度限制生成轨迹（servo_trajectory）")
+    parser.add_argument('--stagger', action='store_true', help="按供电预算错开动作（servo_power）")
+    parser.add_argument('--segments', action='store_true',
+                        help="按分段插值命令发送，由设备插值（servo_trajectory.segment_timeline）")
+    parser.add_argument('--json', action='store_true', help="以 JSON 输出结果")
+    parser.add_argument('--strict', action='store_true', help="有警告或总线过载时返回非0")
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    caps = servo_caps.LEGACY_CAPS if args.legacy else None
+
+    if args.segments and (args.limit or args.stagger):
+        parser.error("--segments 不能与 --limit/--stagger 同时使用")
+
+    def transform(timeline):
+        if args.segments:
+            import servo_trajectory
+            timeline = servo_trajectory.segment_timeline(timeline, config)
+        # 与播放时一致：先按关键帧错开，再生成限速轨迹
+        if args.stagger:
+            import servo_power
+            timeline = servo_power.stagger_timeline(timeline, config)
+        if args.limit:
+            import servo_trajectory
+            timeline = servo_trajectory.limit_timeline(timeline, config)
+        return timeline
+
+    paths = []
+    for pattern in args.scripts:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    reports = {}
+    failed = False
+    for path in paths:
+        commands = load_script_file(path)
+        result = simulate(commands, config, caps, args.baud, args.gui, transform)
+        reports[path] = result.summary()
+        if result.warnings or result.peak_load > 1.0:
+            failed = True
+        if not args.json:
+            print(f"{os.path.basename(path)}: 时长 {result.duration_ms / 1000.0:.2f}秒  帧数 {result.frames}  "
+                  f"字节 {result.bytes_total}  峰值总线占用 {result.peak_load * 100:.1f}%  "
+                  f"最大排队 {result.max_backlog_ms:.1f}ms")
+            for warning in result.warnings:
+                print(f"  警告: {warning}")
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+    return 1 if args.strict and failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,301 @@
+# filename: servo_slew.py
+# 用途：舵机转动时间模型，自动计算每个姿态之后最短需要的延时
+#
+# 按每个舵机的最大速度和最大加速度（servo_trajectory.motion_limits，默认取型号转速）
+# 估算从上一个角度转到新角度的时间，再加上到位后的稳定时间。跟踪每个通道预计到位的
+# 时刻，某一时刻"姿态完成"所需的延时即所有通道中最晚到位时刻与当前时刻之差。
+#
+# 用途：
+#   - 脚本中写 "延时 自动"，编译器（servo_script.compile_script）和 ZS_BOX 逐行执行时
+#     按模型等待到全部舵机到位，不必再凭经验写 延时 1500 / 延时 2000
+#   - check：列出脚本中每个延时的实际值和物理最短值，标出不够舵机到位的延时
+#   - tighten：把延时缩短到 最短值 + 保持时间，提高连续表演的节奏
+#   - sweep：按逐渐提高的速度让舵机往返，记录看起来仍能跟上的最高速度
+#   - set：直接录入某个舵机或某种型号的转速
+#
+# 配置项（servo_config.json）：
+#   servo_X_max_vel   舵机X转速（度/秒），sweep/set 写入这一项
+#   servo_X_max_acc   舵机X最大加速度（度/秒²）
+#   slew_settle_ms    到位后的稳定时间（毫秒），默认40
+#
+# 用法：
+#   python servo_slew.py check 表情脚本/*.txt
+#   python servo_slew.py tighten 表情脚本/02_微笑表情.txt --hold 300 > 微笑_紧凑.txt
+#   python servo_slew.py sweep 6 --port COM3 --save
+#   python servo_slew.py set MG90S 450 --save
+
+import os
+import sys
+import json
+import glob
+import math
+import time
+import argparse
+
+import servo_power
+from servo_pose import group_pose
+from servo_script import load_script_file, parse_script
+from servo_trajectory import MotionLimiter, motion_limits, profile_duration
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SETTLE_MS = 40
+# sweep 依次尝试的转速（度/秒）
+SWEEP_SPEEDS = (60, 90, 120, 180, 240, 300, 400, 500, 600, 800)
+
+
+def move_time_ms(config, ch, distance):
+    """舵机从静止转过 distance 度并稳定下来的时间（毫秒）"""
+    if not distance:
+        return 0.0
+    max_vel, max_acc = motion_limits(config, ch)
+    settle = config.get('slew_settle_ms', DEFAULT_SETTLE_MS)
+    return profile_duration(distance, max_vel, max_acc) * 1000.0 + settle
+
+
+class SlewTracker:
+    """跟踪各通道的角度和预计到位时刻"""
+
+    def __init__(self, config, initial=None):
+        """
+        Args:
+            initial: 开始时各通道角度 {通道: 角度}；未知的通道按转过
+                servo_power.UNKNOWN_MOVE_DEG 度估算
+        """
+        self.config = config
+        self.angles = dict(initial or {})
+        self.arrival = {}
+
+    def move(self, targets, time_ms):
+        """在 time_ms 时刻发出一组目标"""
+        for ch, angle in dict(targets).items():
+            previous = self.angles.get(ch)
+            distance = servo_power.UNKNOWN_MOVE_DEG if previous is None else abs(angle - previous)
+            if distance:
+                self.arrival[ch] = max(self.arrival.get(ch, time_ms), time_ms + move_time_ms(self.config, ch, distance))
+            self.angles[ch] = angle
+
+    def dwell_ms(self, time_ms):
+        """从 time_ms 起还需要等待多久全部舵机才到位（向上取整到毫秒）"""
+        latest = max(self.arrival.values(), default=time_ms)
+        return max(0, int(math.ceil(latest - time_ms)))
+
+
+def check_commands(commands, config, initial=None):
+    """逐条计算脚本中每个延时的物理最短值
+
+    Returns:
+        [(延时命令, 最短延时毫秒)]；"延时 自动" 的命令 value 为 None
+    """
+    tracker = SlewTracker(config, initial)
+    time_ms = 0
+    result = []
+    for command in commands:
+        if command.kind == 'servo':
+            tracker.move(group_pose(config, command.servo_id, command.value), time_ms)
+        elif command.kind == 'delay':
+            required = tracker.dwell_ms(time_ms)
+            result.append((command, required))
+            time_ms += required if command.value is None else command.value
+    return result
+
+
+def tighten_commands(commands, config, initial=None, hold_ms=0, lengthen=False):
+    """把延时改为 物理最短值 + hold_ms（只缩短；lengthen=True 时也延长不够到位的延时）
+
+    "延时 自动" 替换为计算出的具体值。返回新的命令列表。
+    """
+    tracker = SlewTracker(config, initial)
+    time_ms = 0
+    result = []
+    for command in commands:
+        if command.kind == 'servo':
+            tracker.move(group_pose(config, command.servo_id, command.value), time_ms)
+        elif command.kind == 'delay':
+            value = tracker.dwell_ms(time_ms) + hold_ms
+            if command.value is not None and command.value < value and not lengthen:
+                value = command.value
+            command = command._replace(value=value, text=f"延时 {value}")
+            time_ms += value
+        result.append(command)
+    return result
+
+
+def tighten_text(text, config, initial=None, hold_ms=0, lengthen=False):
+    """改写脚本文本中的延时行，其余行（注释、空行）保持不变"""
+    commands = parse_script(text)
+    values = {c.line_num: c.value for c in tighten_commands(commands, config, initial, hold_ms, lengthen)
+              if c.kind == 'delay'}
+    lines = text.split('\n')
+    for line_num, value in values.items():
+        line = lines[line_num - 1]
+        indent = line[:len(line) - len(line.lstrip())]
+        lines[line_num - 1] = f"{indent}延时 {value}" + ('\r' if line.endswith('\r') else '')
+    return '\n'.join(lines)
+
+
+def script_duration_ms(commands):
+    return sum(c.value or 0 for c in commands if c.kind == 'delay')
+
+
+def _load_config(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_config(path, config):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+
+def _expand(patterns):
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+
+def cmd_check(args, config):
+    initial = {ch: 90 for ch in range(16)} if args.after_reset else None
+    for path in _expand(args.scripts):
+        commands = parse_script(load_script_file(path))
+        checked = check_commands(commands, config, initial)
+        written = sum(c.value for c, _ in checked if c.value is not None)
+        minimum = sum(required for _, required in checked)
+        print(f"{os.path.basename(path)}: 延时合计 {written}ms，物理最短 {minimum}ms")
+        for command, required in checked:
+            if command.value is None:
+                print(f"  第{command.line_num}行 延时 自动 -> {required}ms")
+            elif command.value < required:
+                print(f"  第{command.line_num}行 {command.text}: 不够舵机到位，至少需要 {required}ms")
+            elif args.verbose:
+                print(f"  第{command.line_num}行 {command.text}: 最短 {required}ms")
+    return 0
+
+
+def cmd_tighten(args, config):
+    initial = {ch: 90 for ch in range(16)} if args.after_reset else None
+    for path in _expand(args.scripts):
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            text = f.read()
+        result = tighten_text(text, config, initial, args.hold, args.lengthen)
+        before = script_duration_ms(parse_script(text))
+        after = script_duration_ms(parse_script(result))
+        if args.in_place:
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                f.write(result)
+            print(f"{os.path.basename(path)}: {before}ms -> {after}ms", file=sys.stderr)
+        else:
+            sys.stdout.write(result)
+    return 0
+
+
+def cmd_set(args, config):
+    if args.servo.isdigit():
+        channels = [int(args.servo)]
+    else:
+        name = args.servo.upper()
+        if name not in servo_power.SERVO_MODELS:
+            print(f"未知型号: {args.servo}（可用: {'、'.join(servo_power.SERVO_MODELS)}）")
+            return 1
+        channels = [ch for ch in range(16)
+                    if str(config.get(f'servo_{ch}_type', servo_power.DEFAULT_TYPES[ch])).upper() == name]
+    for ch in channels:
+        config[f'servo_{ch}_max_vel'] = args.dps
+    print(f"舵机 {', '.join(map(str, channels))} 转速设为 {args.dps:g}度/秒")
+    if args.save:
+        _save_config(args.config, config)
+        print(f"已保存到 {args.config}")
+    return 0
+
+
+def sweep(transport, config, ch, speed, low, high):
+    """以 speed 度/秒在 low 和 high 之间往返一次"""
+    limiter = MotionLimiter(dict(config, **{f'servo_{ch}_max_vel': speed}))
+    limiter.reset({ch: low})
+    transport.send_frame({ch: low}).wait(1.0)
+    time.sleep(0.5)
+    for target in (high, low):
+        limiter.set_target(ch, target)
+        while limiter.moving:
+            for channel, angle in limiter.step().items():
+                transport.send_frame({channel: angle}, ('S', channel))
+            time.sleep(limiter.step_ms / 1000.0)
+        time.sleep(0.3)
+
+
+def cmd_sweep(args, config):
+    from servo_transport import ServoTransport, open_serial_port
+
+    ch = args.servo
+    low = config.get(f'servo_{ch}_min', 0)
+    high = config.get(f'servo_{ch}_max', 180)
+    serial_port = open_serial_port(args.port, args.baud, timeout=0.2)
+    transport = None
+    fitted = None
+    try:
+        if not args.port.startswith('virtual'):
+            time.sleep(2)  # 等待ESP32重启
+        transport = ServoTransport(serial_port).start()
+        print(f"舵机{ch} 在 {low}°~{high}° 之间往返，速度逐渐提高。"
+              "每次往返后回答舵机是否跟上（动作连贯、到达两端），直接回车表示跟上。")
+        for speed in SWEEP_SPEEDS:
+            print(f"{speed}度/秒 ...", end=' ', flush=True)
+            sweep(transport, config, ch, speed, low, high)
+            answer = input("跟上了吗？[Y/n] ").strip().lower()
+            if answer in ('n', 'no', '否'):
+                break
+            fitted = speed
+        transport.send_frame({ch: config.get(f'servo_{ch}_mid', 90)}).wait(1.0)
+    finally:
+        if transport is not None:
+            transport.close()
+        serial_port.close()
+    if fitted is None:
+        print("最低速度也没有跟上，未修改配置")
+        return 1
+    config[f'servo_{ch}_max_vel'] = fitted
+    print(f"舵机{ch} 转速: {fitted}度/秒")
+    if args.save:
+        _save_config(args.config, config)
+        print(f"已保存到 {args.config}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="舵机转动时间模型与最短延时计算")
+    parser.add_argument('--config', default=os.path.join(BASE_DIR, 'servo_config.json'))
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    check_parser = sub.add_parser('check', help="检查脚本中的延时")
+    check_parser.add_argument('scripts', nargs='+')
+    check_parser.add_argument('-v', '--verbose', action='store_true', help="列出全部延时")
+
+    tighten_parser = sub.add_parser('tighten', help="把延时缩短到物理最短值")
+    tighten_parser.add_argument('scripts', nargs='+')
+    tighten_parser.add_argument('--hold', type=int, default=0, help="舵机到位后保持的时间（毫秒）")
+    tighten_parser.add_argument('--lengthen', action='store_true', help="同时延长不够舵机到位的延时")
+    tighten_parser.add_argument('-i', '--in-place', action='store_true', help="直接修改脚本文件")
+
+    for sub_parser in (check_parser, tighten_parser):
+        sub_parser.add_argument('--no-reset', dest='after_reset', action='store_false',
+                                help="脚本开始前舵机不在90°（默认按运行前归零计算）")
+
+    sweep_parser = sub.add_parser('sweep', help="往返测试拟合舵机转速")
+    sweep_parser.add_argument('servo', type=int)
+    sweep_parser.add_argument('--port', required=True, help="串口名，或 virtual")
+    sweep_parser.add_argument('--baud', type=int, default=115200)
+    sweep_parser.add_argument('--save', action='store_true', help="写入配置文件")
+
+    set_parser = sub.add_parser('set', help="录入舵机或型号的转速")
+    set_parser.add_argument('servo', help="舵机编号或型号（MG90S / MG996R）")
+    set_parser.add_argument('dps', type=float, help="转速（度/秒）")
+    set_parser.add_argument('--save', action='store_true', help="写入配置文件")
+
+    args = parser.parse_args(argv)
+    config = _load_config(args.config)
+    handlers = {'check': cmd_check, 'tighten': cmd_tighten, 'sweep': cmd_sweep, 'set': cmd_set}
+    return handlers[args.command](args, config)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,340 @@
+# filename: servo_trajectory.py
+# 用途：按每个舵机的最大速度和最大加速度生成运动轨迹
+#
+# 舵机收到目标后会全速转过去，MG90s 会撞到限位、下颚会过冲。这里用离散时间的
+# 时间最优跟踪器代替直接跳变：每个周期（默认20ms，与PWM周期一致）
+#   期望速度 = 方向 × min(最大速度, sqrt(2 × 最大加速度 × 剩余角度))
+#   实际速度 = 期望速度限制在 上一周期速度 ± 最大加速度 × 周期 内
+# 即以最大加速度加速、匀速、再恰好在目标处减速到0；运动中收到新目标时从当前
+# 位置和速度继续规划，因此同样适用于滑条这类连续变化的目标流。
+#
+# 联动舵机组（下颚0/1、嘴角、眼睑、眉毛，见 servo_pose）两个通道的目标和当前角度满足
+# 联动关系时，只对主动舵机做限制，联动舵机每个周期按 servo_pose.group_pose 从主动舵机的
+# 角度换算，保证运动中下颚两通道之和始终为180（仍可用 JS 命令发送）、左右对称的舵机同步。
+# 主动舵机的限制取自身限制和联动舵机限制按行程比例换算后的较小值。
+#
+# 配置项（servo_config.json）：
+#   servo_X_max_vel   舵机X最大速度（度/秒），0表示不限，默认按型号取 servo_power 中的转速
+#   servo_X_max_acc   舵机X最大加速度（度/秒²），0表示不限，默认按型号
+#   motion_step_ms    轨迹周期（毫秒），默认20
+#
+# 固件支持分段插值（CAPS 中 segment=1）时，segment_timeline 把编译出的关键帧（未经
+# limit_timeline 采样）中每个舵机组的一次转动换成一条 M 命令（目标、时长、缓动曲线），
+# 由设备按PWM周期插值，串口上不再传送逐周期的采样帧。各组的时长分别计算：
+# 取 MotionLimiter 对该组使用的限制（联动舵机组为主动舵机带动联动舵机时的限制），
+# 在该缓动曲线下不超过最大速度/加速度所需的最短时间。
+
+import math
+from collections import namedtuple
+
+import servo_pose
+import servo_power
+from servo_protocol import DEFAULT_EASING, MAX_SEGMENT_MS, SEGMENT_TICK_MS, format_segment
+from servo_script import Frame, Timeline
+
+DEFAULT_STEP_MS = 20
+# 按型号的默认最大加速度（度/秒²）
+DEFAULT_ACCELERATION = {
+    'MG996R': 2000.0,
+    'MG90S': 4000.0,
+}
+# 缓动曲线的 (峰值速度系数, 峰值加速度系数)：转过 d 度用时 T 时
+# 峰值速度 = 系数 × d / T，峰值加速度 = 系数 × d / T²
+EASING_LIMITS = {
+    'linear': (1.0, 0.0),
+    'inout': (1.5, 6.0),
+    'in': (2.0, 2.0),
+    'out': (2.0, 2.0),
+}
+# 起始角度未知时按这个距离估算分段时长
+UNKNOWN_MOVE_DEG = 90
+# 联动舵机组的两个通道
+COUPLED_GROUPS = ((0, 1), (2, 3), (4, 5), (6, 7), (8, 9), (12, 14), (13, 15))
+
+Segment = namedtuple('Segment', 'time_ms targets line_nums duration_ms easing')
+
+
+def motion_limits(config, ch):
+    """返回舵机的 (最大速度, 最大加速度)，0 表示不限"""
+    name = str(config.get(f'servo_{ch}_type', servo_power.DEFAULT_TYPES[ch])).upper()
+    default_acc = DEFAULT_ACCELERATION.get(name, DEFAULT_ACCELERATION['MG90S'])
+    max_vel = float(config.get(f'servo_{ch}_max_vel', servo_power.servo_model(config, ch).speed_dps))
+    max_acc = float(config.get(f'servo_{ch}_max_acc', default_acc))
+    return max_vel, max_acc
+
+
+def follow_angle(config, lead, follower, angle):
+    """主动舵机转到 angle 时联动舵机的角度（servo_pose.group_pose）"""
+    return dict(servo_pose.group_pose(config, lead, angle))[follower]
+
+
+def follow_ratio(config, lead, follower):
+    """联动舵机转动角度与主动舵机转动角度之比"""
+    if lead in (0, 1):
+        return 1.0
+    lead_min, _, lead_max = servo_pose.calibration(config, lead)
+    follower_min, _, follower_max = servo_pose.calibration(config, follower)
+    if lead_max == lead_min:
+        return 0.0
+    return abs(follower_max - follower_min) / abs(lead_max - lead_min)
+
+
+def _tighter(limit, other):
+    """两个限制中较小的一个，0 表示不限"""
+    if not other:
+        return limit
+    return min(limit, other) if limit else other
+
+
+def profile_duration(distance, max_vel, max_acc):
+    """从静止到静止转过 distance 度的最短时间（秒）"""
+    distance = abs(distance)
+    if not distance:
+        return 0.0
+    if not max_acc:
+        return distance / max_vel if max_vel else 0.0
+    if not max_vel or distance <= max_vel * max_vel / max_acc:
+        return 2.0 * math.sqrt(distance / max_acc)  # 三角形速度曲线
+    return distance / max_vel + max_vel / max_acc
+
+
+class MotionLimiter:
+    """多通道速度/加速度限制器：设置目标后每个周期调用 step() 得到各通道的新角度"""
+
+    def __init__(self, config, step_ms=None):
+        self.config = config
+        self.step_ms = step_ms or config.get('motion_step_ms', DEFAULT_STEP_MS)
+        self.positions = {}
+        self.velocities = {}
+        self.targets = {}
+        self._limits = {}
+        self._sent = {}
+
+    def set_config(self, config):
+        """校准配置变化后使用新的速度/加速度限制，当前运动状态保留"""
+        self.config = config
+        self._limits = {}
+
+    def reset(self, positions=None):
+        """忘记当前运动状态（其他途径改变了舵机角度时调用），未知位置的通道下一个目标直接跳变"""
+        self.positions = {ch: float(a) for ch, a in (positions or {}).items()}
+        self.velocities.clear()
+        self.targets = dict(positions or {})
+        self._sent = dict(positions or {})
+
+    def set_target(self, ch, angle):
+        if ch not in self.positions:
+            self.positions[ch] = float(angle)
+            self.velocities[ch] = 0.0
+        self.targets[ch] = angle
+
+    def place(self, ch, angle):
+        """已知通道当前停在 angle（由其他途径发出），之后的目标从这里开始平滑移动"""
+        self.positions[ch] = float(angle)
+        self.velocities[ch] = 0.0
+        self.targets[ch] = angle
+        self._sent[ch] = angle
+
+    def set_targets(self, targets):
+        for ch, angle in dict(targets).items():
+            self.set_target(ch, angle)
+
+    @property
+    def moving(self):
+        return any(self.positions[ch] != self.targets[ch] or self._sent.get(ch) != self.targets[ch]
+                   for ch in self.targets)
+
+    def _channel_limits(self, ch, follower=None):
+        """通道的 (最大速度, 最大加速度)；带动联动舵机时同时满足联动舵机的限制"""
+        key = (ch, follower)
+        if key not in self._limits:
+            max_vel, max_acc = motion_limits(self.config, ch)
+            if follower is not None:
+                ratio = follow_ratio(self.config, ch, follower)
+                if ratio:
+                    follower_vel, follower_acc = motion_limits(self.config, follower)
+                    max_vel = _tighter(max_vel, follower_vel / ratio)
+                    max_acc = _tighter(max_acc, follower_acc / ratio)
+            self._limits[key] = (max_vel, max_acc)
+        return self._limits[key]
+
+    def _couplings(self):
+        """{联动舵机: 主动舵机}，只包含目标和当前角度都满足联动关系的舵机组"""
+        coupled = {}
+        for group in COUPLED_GROUPS:
+            if not all(ch in self.targets for ch in group):
+                continue
+            for lead in sorted({servo_pose.PAIR_GROUPS.get(ch, (0, 1))[0] for ch in group}):
+                follower = group[1] if lead == group[0] else group[0]
+                position = follow_angle(self.config, lead, follower, int(round(self.positions[lead])))
+                if (follow_angle(self.config, lead, follower, self.targets[lead]) == self.targets[follower]
+                        and abs(position - self.positions[follower]) <= 1):
+                    coupled[follower] = lead
+                    break
+        return coupled
+
+    def _step_channel(self, ch, dt, limits):
+        target = self.targets[ch]
+        pos = self.positions[ch]
+        error = target - pos
+        if not error:
+            self.velocities[ch] = 0.0
+            return
+        max_vel, max_acc = limits
+        vel = self.velocities.get(ch, 0.0)
+        desired = abs(error) / dt
+        if max_vel:
+            desired = min(desired, max_vel)
+        if max_acc:
+            desired = min(desired, math.sqrt(2.0 * max_acc * abs(error)))
+            desired = math.copysign(desired, error)
+            desired = max(vel - max_acc * dt, min(vel + max_acc * dt, desired))
+        else:
+            desired = math.copysign(desired, error)
+        if desired * error > 0 and abs(desired * dt) >= abs(error):
+            self.positions[ch] = float(target)
+            self.velocities[ch] = 0.0
+        else:
+            self.positions[ch] = pos + desired * dt
+            self.velocities[ch] = desired
+
+    def step(self, dt=None):
+        """推进一个周期
+
+        Args:
+            dt: 周期长度（秒），默认 step_ms
+
+        Returns:
+            {通道: 角度}，只包含取整后与上次返回值不同的通道
+        """
+        dt = self.step_ms / 1000.0 if dt is None else dt
+        coupled = self._couplings()
+        leads = {lead: follower for follower, lead in coupled.items()}
+        angles = {}
+        for ch in self.targets:
+            if ch in coupled:
+                continue
+            self._step_channel(ch, dt, self._channel_limits(ch, leads.get(ch)))
+            angles[ch] = int(round(self.positions[ch]))
+            if self.positions[ch] == self.targets[ch]:
+                angles[ch] = self.targets[ch]
+        for follower, lead in coupled.items():
+            angle = follow_angle(self.config, lead, follower, angles[lead])
+            self.velocities[follower] = (angle - self.positions[follower]) / dt
+            self.positions[follower] = float(angle)
+            angles[follower] = angle
+        changed = {}
+        for ch in self.targets:
+            angle = angles[ch]
+            if self._sent.get(ch) != angle:
+                self._sent[ch] = angle
+                changed[ch] = angle
+        return changed
+
+
+def limit_timeline(timeline, config, step_ms=None, initial=None):
+    """把 Timeline 中的跳变替换为满足速度/加速度限制的轨迹，返回新的 Timeline
+
+    Args:
+        initial: 开始时各通道角度 {通道: 角度}；未知的通道第一次设置时直接跳变
+    """
+    limiter = MotionLimiter(config, step_ms)
+    limiter.reset(initial)
+    period = limiter.step_ms
+    frames = list(timeline)
+    result = []
+    index = 0
+    time_ms = frames[0].time_ms if frames else 0
+    while index < len(frames) or limiter.moving:
+        lines = []
+        while index < len(frames) and frames[index].time_ms <= time_ms:
+            limiter.set_targets(frames[index].targets)
+            lines.extend(frames[index].line_nums)
+            index += 1
+        changed = limiter.step()
+        if changed:
+            result.append(Frame(time_ms, tuple(sorted(changed.items())), tuple(lines)))
+        if not limiter.moving and index < len(frames):
+            # 静止期间直接跳到下一帧，避免生成空周期
+            time_ms = max(time_ms + period, frames[index].time_ms)
+        else:
+            time_ms += period
+    duration = max([timeline.duration_ms] + [frame.time_ms for frame in result])
+    return Timeline(result, duration, list(timeline.warnings))
+
+
+def segment_duration(distance, max_vel, max_acc, easing=DEFAULT_EASING):
+    """按缓动曲线转过 distance 度且不超过最大速度/加速度的最短时间（秒）"""
+    distance = abs(distance)
+    vel_factor, acc_factor = EASING_LIMITS[easing]
+    duration = 0.0
+    if max_vel:
+        duration = vel_factor * distance / max_vel
+    if max_acc and acc_factor:
+        duration = max(duration, math.sqrt(acc_factor * distance / max_acc))
+    return duration
+
+
+class SegmentTimeline(Timeline):
+    """由分段插值命令组成的 Timeline，frames 为 Segment（targets 为分段终点）"""
+
+    def encoded_frames(self, use_batch=True, use_jaw_sync=True):
+        """每一段编码成一条 M 命令，返回 [(time_ms, bytes), ...]"""
+        return [(segment.time_ms, format_segment(segment.targets, segment.duration_ms, segment.easing))
+                for segment in self.frames]
+
+
+def _group_seconds(limiter, targets, positions, easing):
+    """一个舵机组一次转动的分段时长（秒），联动舵机只随主动舵机计算"""
+    followers = {}
+    for group in COUPLED_GROUPS:
+        if not all(ch in targets and ch in positions for ch in group):
+            continue
+        for lead in sorted({servo_pose.PAIR_GROUPS.get(ch, (0, 1))[0] for ch in group}):
+            follower = group[1] if lead == group[0] else group[0]
+            if all(follow_angle(limiter.config, lead, follower, angles[lead]) == angles[follower]
+                   for angles in (targets, positions)):
+                followers[follower] = lead
+                break
+    leads = {lead: follower for follower, lead in followers.items()}
+    seconds = 0.0
+    for ch, angle in targets.items():
+        if ch in followers:
+            continue
+        start = positions.get(ch)
+        distance = UNKNOWN_MOVE_DEG if start is None else angle - start
+        limits = limiter._channel_limits(ch, leads.get(ch))
+        seconds = max(seconds, segment_duration(distance, *limits, easing=easing))
+    return seconds
+
+
+def segment_timeline(timeline, config, initial=None, easing=DEFAULT_EASING):
+    """把关键帧换成分段插值命令，返回 SegmentTimeline
+
+    应对编译出的关键帧调用（不经过 limit_timeline 和 stagger_timeline）。每一帧中每个
+    发生变化的舵机组（servo_pose.group_of）生成一条 M 命令，组内通道同时开始、同时到位，
+    时长按该组的速度/加速度限制计算并向上取整到设备的插值周期，不受同一帧中其他组的影响。
+
+    Args:
+        initial: 开始时各通道角度 {通道: 角度}；未知的通道按 UNKNOWN_MOVE_DEG 估算时长
+        easing: 缓动曲线名称（servo_protocol.EASINGS）
+    """
+    limiter = MotionLimiter(config)
+    positions = dict(initial or {})
+    segments = []
+    end_ms = 0
+    for frame in timeline:
+        groups = {}
+        for ch, angle in frame.targets:
+            if positions.get(ch) != angle:
+                groups.setdefault(servo_pose.group_of(ch), {})[ch] = angle
+        for _, targets in sorted(groups.items()):
+            seconds = _group_seconds(limiter, targets, positions, easing)
+            duration = int(math.ceil(seconds * 1000.0 / SEGMENT_TICK_MS - 1e-9)) * SEGMENT_TICK_MS
+            duration = min(duration, MAX_SEGMENT_MS)
+            segments.append(Segment(frame.time_ms, tuple(sorted(targets.items())), frame.line_nums,
+                                    duration, easing))
+            end_ms = max(end_ms, frame.time_ms + duration)
+            positions.update(targets)
+    return SegmentTimeline(segments, max(timeline.duration_ms, end_ms), list(timeline.warnings),
+                           timeline.snapshot_interval)
@@ -0,0 +1,566 @@
+# filename: servo_transport.py
+# 用途：串口命令传输层
+#
+# 所有命令先进入发送队列，由写线程按顺序写入串口；读线程解析设备应答，
+# 把 OK:/ERROR: 应答按固件执行顺序匹配到已发送的命令上。
+# 每条命令记录入队、写入、应答三个时间点，统计数据见 servo_metrics。
+#
+# 带 key 的命令（例如滑条产生的同一舵机命令）在尚未写出时会被新命令合并，
+# 只发送最新的角度。
+#
+# 流控：固件 loop() 每次只读一行命令，处理期间输出大量 DEBUG 信息，
+# 主机连续写入时 ESP32 的串口接收缓冲区（默认256字节）会溢出，命令被静默丢弃。
+# 因此写线程最多保留 window 条未应答命令、max_bytes_in_flight 字节未应答数据，
+# 收到 OK:/ERROR:（或超时）后才释放额度写出下一条。
+# 没有应答的命令（HELP/STATUS/DEBUG、旧固件的 JS）不占用额度。
+# 应答与某条未应答命令相同的命令（例如连续两次 S2,74）等前一条完成后才写出，
+# 保证每个应答只可能属于一条命令。
+#
+# 设备状态镜像：按设备应答（OK:S/OK:JS/RESET完成/STATUS）维护设备上各舵机的实际角度，
+# 并记录排队和未应答命令完成后设备将处于的角度。send_frame(delta=True) 只发送与之不同的
+# 通道，表情切换时不再重发没有变化的舵机。命令失败、超时或被丢弃时对应通道回退到
+# 设备实际角度，下一次会重新发送。设置 reconcile_interval 后空闲时定期发送 STATUS，
+# 用设备报告的角度校正镜像（例如ESP32掉电重启后舵机回到90度）。
+#
+# 定时命令（servo_clock，带 due 的命令）在设备端排队，到执行时刻才应答：
+# 等待执行期间不占用发送窗口，不会因后续命令先应答而被判为丢失，
+# 超时从执行时刻开始计算；设备无法排队时应答 ERROR:@<执行时刻>，按执行时刻匹配。
+
+import threading
+import time
+from collections import deque
+
+from servo_metrics import TransportMetrics
+from servo_protocol import (SERVO_COUNT, clamp_angle, encode_frame, expected_replies, is_jaw_pair,
+                            parse_reply, parse_status, payload_targets, reply_token)
+
+# 命令状态
+QUEUED = 'queued'        # 在发送队列中
+WRITTEN = 'written'      # 已写入串口，等待应答
+SENT = 'sent'            # 已写入串口，该命令没有应答（JS/RESET等）
+ACKED = 'acked'          # 收到全部 OK 应答
+ERROR = 'error'          # 收到 ERROR 应答
+COALESCED = 'coalesced'  # 尚未发送就被同 key 的新命令替代
+DROPPED = 'dropped'      # 队列已满被丢弃，或设备没有应答而后续命令已应答
+TIMEOUT = 'timeout'      # 应答超时
+CLOSED = 'closed'        # 传输层关闭时仍未完成
+SKIPPED = 'skipped'      # 差量发送时所有通道都没有变化，没有写出
+REJECTED = 'rejected'    # 舵机组被更高优先级的来源占用，没有写出（servo_arbiter）
+
+# 空闲时 STATUS 校正的默认间隔（秒）
+DEFAULT_RECONCILE_INTERVAL = 5.0
+# 定时命令的应答最多比主机估计的执行时刻早到的时间（对时误差），秒
+SCHEDULE_SLACK = 0.05
+
+
+class CommandRecord:
+    """一条（或一组同时写出的）命令及其时间戳"""
+
+    def __init__(self, payload, key=None, jaw_ack=False, on_finish=None, due=None):
+        self.payload = payload
+        self.key = key
+        self.due = due  # 定时命令在设备上执行的主机时刻（perf_counter），None 表示收到即执行
+        self.expected = expected_replies(payload, jaw_ack)
+        self.targets = payload_targets(payload)
+        self.on_finish = on_finish
+        self.pending = deque(self.expected)
+        self.replies = []
+        self.t_enqueue = time.perf_counter()
+        self.t_write = None
+        self.t_ack = None
+        self.status = QUEUED
+        self._event = threading.Event()
+
+    def waiting(self, now):
+        """定时命令是否还没到执行时刻（此时设备不会应答）"""
+        return self.due is not None and now < self.due - SCHEDULE_SLACK
+
+    def finish(self, status):
+        self.status = status
+        self._event.set()
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """等待命令完成，收到全部OK（或无需应答的命令已写出）时返回 True"""
+        self._event.wait(timeout)
+        return self.status in (ACKED, SENT, SKIPPED)
+
+
+class ServoTransport:
+    """带发送队列、应答匹配和延迟统计的串口传输"""
+
+    def __init__(self, serial_port, metrics=None, ack_timeout=1.0, max_queue=256,
+                 window=4, max_bytes_in_flight=192, jaw_ack=False,
+                 on_line=None, on_error=None, reconcile_interval=None):
+        """
+        Args:
+            serial_port: 已打开的 serial.Serial（或 VirtualServoDevice）
+            metrics: TransportMetrics，默认新建
+            ack_timeout: 等待应答的超时时间（秒），RESET 命令额外加上复位耗时
+            max_queue: 发送队列最大长度，超出时丢弃最旧的命令
+            window: 最多同时未应答的命令数，None 表示不限制
+            max_bytes_in_flight: 最多同时未应答的字节数（应小于设备接收缓冲区），None 表示不限制
+            jaw_ack: 设备是否对 JS 命令应答 OK:JS；收到第一条 OK:JS 后自动开启
+            on_line: 收到非应答行（DEBUG/STATUS/RESET等）时的回调 on_line(kind, text)
+            on_error: 串口出错时的回调 on_error(exception)，在读/写线程中调用
+            reconcile_interval: 空闲时发送 STATUS 校正设备状态镜像的间隔（秒），None 表示不发送；
+                旧版固件把 STATUS 当作舵机命令应答 ERROR，只应在 CAPS 报告 status=1 时开启
+        """
+        self.serial_port = serial_port
+        self.metrics = metrics or TransportMetrics()
+        self.ack_timeout = ack_timeout
+        self.max_queue = max_queue
+        self.window = window
+        self.max_bytes_in_flight = max_bytes_in_flight
+        self.jaw_ack = jaw_ack
+        self.on_line = on_line
+        self.on_error = on_error
+        self.reconcile_interval = reconcile_interval
+
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._queued_by_key = {}
+        self._in_flight = deque()
+        self._bytes_in_flight = 0
+        self._query = None
+        self._query_lock = threading.Lock()
+        self._running = False
+        # 设备状态镜像：设备应答的实际角度、全部命令完成后的角度、各通道未完成的命令数
+        self._device_angles = [None] * SERVO_COUNT
+        self._commanded = {}
+        self._outstanding = [0] * SERVO_COUNT
+        self._status_requests = 0
+        self._last_reconcile = time.perf_counter()
+        self._writer = None
+        self._reader = None
+
+    # ---------------- 生命周期 ----------------
+
+    def start(self):
+        self._running = True
+        self._writer = threading.Thread(target=self._write_loop, name="servo-writer", daemon=True)
+        self._reader = threading.Thread(target=self._read_loop, name="servo-reader", daemon=True)
+        self._writer.start()
+        self._reader.start()
+        return self
+
+    def close(self):
+        """停止读写线程，未完成的命令标记为 CLOSED（不关闭串口本身）"""
+        with self._cond:
+            self._running = False
+            for record in list(self._queue) + list(self._in_flight):
+                record.finish(CLOSED)
+            self._queue.clear()
+            self._queued_by_key.clear()
+            self._in_flight.clear()
+            self._bytes_in_flight = 0
+            self._update_depths()
+            self._cond.notify_all()
+        for thread in (self._writer, self._reader):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(timeout=2)
+
+    @property
+    def running(self):
+        return self._running
+
+    # ---------------- 发送接口 ----------------
+
+    def send(self, payload, key=None, due=None):
+        """命令入队，返回 CommandRecord
+
+        Args:
+            payload: 要写入的字节（可包含多行命令）
+            key: 合并键，队列中尚未写出的同 key 命令会被替换
+            due: 定时命令（servo_protocol.format_scheduled）在设备上执行的主机时刻（perf_counter）
+        """
+        if isinstance(payload, str):
+            payload = payload.encode()
+        record = CommandRecord(payload, key, self.jaw_ack, due=due)
+        with self._cond:
+            if not self._running:
+                record.finish(CLOSED)
+                return record
+            record.on_finish = self._settle
+            old = self._queued_by_key.get(key) if key is not None else None
+            if old is not None:
+                # 丢弃队列中的旧命令；新命令排在队尾，保证不会被其他后来的命令覆盖
+                self._queue.remove(old)
+                old.finish(COALESCED)
+                self.metrics.record_coalesced()
+            elif len(self._queue) >= self.max_queue:
+                dropped = self._queue.popleft()
+                if dropped.key is not None:
+                    self._queued_by_key.pop(dropped.key, None)
+                dropped.finish(DROPPED)
+                self.metrics.record_dropped()
+            self._queue.append(record)
+            if key is not None:
+                self._queued_by_key[key] = record
+            for ch, angle in record.targets:
+                self._outstanding[ch] += 1
+                self._commanded[ch] = angle
+            self._update_depths()
+            self._cond.notify_all()
+        return record
+
+    def send_frame(self, targets, key=None, use_batch=True, use_jaw_sync=True, delta=False):
+        """编码一帧舵机目标并入队
+
+        Args:
+            delta: 只发送与设备状态镜像（含尚未完成的命令）不同的通道；
+                全部相同时不写出，返回状态为 SKIPPED 的记录
+        """
+        if not delta:
+            return self.send(encode_frame(targets, use_batch, use_jaw_sync), key)
+        targets = {int(ch): clamp_angle(angle) for ch, angle in dict(targets).items()}
+        with self._cond:
+            changed = {ch: angle for ch, angle in targets.items() if self._commanded.get(ch) != angle}
+            if use_jaw_sync and (0 in changed or 1 in changed) and is_jaw_pair(targets):
+                # 下颚两个舵机一起用 JS 命令发送
+                changed[0], changed[1] = targets[0], targets[1]
+            if len(changed) < len(targets):
+                self.metrics.record_skipped(len(targets) - len(changed))
+            if changed:
+                return self.send(encode_frame(changed, use_batch, use_jaw_sync), key)
+        record = CommandRecord(b"", key)
+        record.finish(SKIPPED)
+        return record
+
+    def reconcile(self, timeout=1.0):
+        """立即发送 STATUS 并用应答校正设备状态镜像，返回是否收到 STATUS 应答"""
+        lines = self.query(b"STATUS\n", lambda kind, text: kind in ('STATUS', 'ERROR'), timeout)
+        return any(parse_reply(line)[0] == 'STATUS' for line in lines)
+
+    def device_state(self):
+        """设备状态镜像：16个通道最近一次由设备确认的角度，未知为 None"""
+        with self._cond:
+            return list(self._device_angles)
+
+    def query(self, payload, match, timeout=1.0):
+        """发送命令并收集设备输出的行，直到 match(kind, text) 返回 True 或超时
+
+        Returns:
+            收到的原始行列表（已去除换行）
+        """
+        with self._query_lock:
+            query = {'lines': [], 'match': match, 'event': threading.Event()}
+            with self._cond:
+                self._query = query
+            self.send(payload)
+            query['event'].wait(timeout)
+            with self._cond:
+                self._query = None
+            return query['lines']
+
+    def wait_idle(self, timeout=None):
+        """等待发送队列和未应答命令全部完成"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while (self._queue or self._in_flight) and self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is not None else 0.1)
+            return True
+
+    def wait_queue_below(self, limit=1, timeout=None):
+        """等待发送队列长度小于 limit，供上层按发送进度投递命令（而不是全部堆进队列）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while len(self._queue) >= limit and self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return self._running
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    # ---------------- 内部线程 ----------------
+
+    def _update_depths(self):
+        self.metrics.set_depths(len(self._queue), len(self._in_flight))
+
+    def _has_credit(self, record):
+        """发送窗口是否允许写出该命令（需持有锁）"""
+        if not record.expected or not self._in_flight:
+            return True
+        # 与未应答命令等待同一应答的命令先不写出：应答内容相同，无法区分属于哪一条，
+        # 前一条在设备端丢失时后一条的 OK 会被算到前一条上
+        pending = {token for r in self._in_flight for token in r.pending}
+        if not pending.isdisjoint(record.expected):
+            return False
+        # 设备已读出、等待执行时刻的定时命令不占用接收缓冲区
+        now = time.perf_counter()
+        waiting = [r for r in self._in_flight if r.waiting(now)]
+        if self.window is not None and len(self._in_flight) - len(waiting) >= self.window:
+            return False
+        in_flight_bytes = self._bytes_in_flight - sum(len(r.payload) for r in waiting)
+        if (self.max_bytes_in_flight is not None
+                and in_flight_bytes + len(record.payload) > self.max_bytes_in_flight):
+            return False
+        return True
+
+    def _add_in_flight(self, record):
+        self._in_flight.append(record)
+        self._bytes_in_flight += len(record.payload)
+
+    def _remove_in_flight(self, record):
+        self._in_flight.remove(record)
+        self._bytes_in_flight -= len(record.payload)
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                stalled = False
+                while self._running and (not self._queue or not self._has_credit(self._queue[0])):
+                    if self._queue and not stalled:
+                        stalled = True
+                        self.metrics.record_stall()
+                    self._cond.wait()
+                if not self._running:
+                    return
+                record = self._queue.popleft()
+                if record.key is not None and self._queued_by_key.get(record.key) is record:
+                    del self._queued_by_key[record.key]
+                record.status = WRITTEN
+                # 先计入未应答，保证读线程收到应答时能找到该命令
+                record.t_write = time.perf_counter()
+                if record.expected:
+                    self._add_in_flight(record)
+                self._update_depths()
+                self._cond.notify_all()
+            try:
+                self.serial_port.write(record.payload)
+            except Exception as e:
+                with self._cond:
+                    if record in self._in_flight:
+                        self._remove_in_flight(record)
+                    self._update_depths()
+                record.finish(ERROR)
+                self._fail(e)
+                return
+            self.metrics.record_write(record, record.t_write)
+            if not record.expected:
+                record.finish(SENT)
+                with self._cond:
+                    self._cond.notify_all()
+
+    def _read_loop(self):
+        while self._running:
+            try:
+                raw = self.serial_port.readline()
+            except Exception as e:
+                self._fail(e)
+                return
+            now = time.perf_counter()
+            if raw:
+                text = raw.decode('utf-8', errors='replace').strip()
+                if text:
+                    self._handle_line(text, now)
+            self._expire(now)
+            self._maybe_reconcile(now)
+
+    def _handle_line(self, text, now):
+        kind, content = parse_reply(text)
+        with self._cond:
+            query = self._query
+            if query is not None:
+                query['lines'].append(text)
+                if query['match'](kind, content):
+                    query['event'].set()
+
+            handled = False
+            token = reply_token(kind, content)
+            if token is not None:
+                self._apply_reply(token)
+                handled = self._match_reply(token, text, now)
+                if not handled and token[0] == 'JS' and not self.jaw_ack:
+                    # 固件支持 JS 应答，之后的 JS 命令也占用发送窗口
+                    self.jaw_ack = True
+                    handled = True
+            elif kind == 'ERROR' and content.startswith('@'):
+                handled = self._match_schedule_error(content, text, now)
+            elif kind == 'ERROR' and self._in_flight:
+                # 归属第一条不在等待执行时刻的命令
+                record = next((r for r in self._in_flight if not r.waiting(now)), self._in_flight[0])
+                record.replies.append(text)
+                if record.pending:
+                    record.pending.popleft()
+                record.status = ERROR
+                if not record.pending:
+                    self._complete(record, ERROR, now)
+                handled = True
+            elif kind == 'STATUS':
+                self._apply_status(content)
+                if self._status_requests:
+                    # 定期校正的应答不转给 on_line
+                    self._status_requests -= 1
+                    handled = True
+            self._cond.notify_all()
+
+        if not handled and self.on_line is not None:
+            self.on_line(kind, text)
+
+    def _match_reply(self, token, text, now):
+        """按固件执行顺序匹配完成应答（需持有锁）"""
+        for record in self._in_flight:
+            if record.pending and record.pending[0] == token and not record.waiting(now):
+                break
+        else:
+            # 已超时命令迟到的应答
+            return False
+
+        # 固件按顺序执行命令，排在前面却没有应答的命令已在设备端丢失；
+        # 定时命令按执行时刻应答，只按超时判断
+        for lost in list(self._in_flight):
+            if lost is record:
+                break
+            if lost.due is None:
+                self._remove_in_flight(lost)
+                lost.finish(DROPPED)
+                self.metrics.record_dropped()
+
+        record.replies.append(text)
+        record.pending.popleft()
+        if not record.pending:
+            self._complete(record, ERROR if record.status == ERROR else ACKED, now)
+        return True
+
+    def _match_schedule_error(self, content, text, now):
+        """设备无法排队定时命令时的 ERROR:@<执行时刻> 应答（需持有锁）"""
+        prefix = content.split(None, 1)[0] + ':'
+        for record in self._in_flight:
+            lines = [line for line in record.payload.decode('utf-8', errors='replace').split('\n')
+                     if line.startswith(prefix)]
+            if not lines:
+                continue
+            record.replies.append(text)
+            record.status = ERROR
+            # 该行的应答不会再出现
+            for token in expected_replies('\n'.join(lines), self.jaw_ack):
+                if token in record.pending:
+                    record.pending.remove(token)
+            if not record.pending:
+                self._complete(record, ERROR, now)
+            return True
+        return False
+
+    # ---------------- 设备状态镜像 ----------------
+
+    def _set_device_angle(self, ch, angle):
+        """设备确认的角度（需持有锁）；该通道没有未完成的命令时同步更新预期角度"""
+        if not 0 <= ch < SERVO_COUNT:
+            return
+        self._device_angles[ch] = angle
+        if not self._outstanding[ch]:
+            self._commanded[ch] = angle
+
+    def _apply_reply(self, token):
+        if token == ('RESET',):
+            for ch in range(SERVO_COUNT):
+                self._set_device_angle(ch, 90)
+        elif token[0] == 'JS':
+            self._set_device_angle(0, token[1])
+            self._set_device_angle(1, 180 - token[1])
+        else:
+            self._set_device_angle(*token)
+
+    def _apply_status(self, content):
+        drift = 0
+        for ch, angle in enumerate(parse_status(content)):
+            if angle is None:
+                continue
+            if self._device_angles[ch] is not None and self._device_angles[ch] != angle:
+                drift += 1
+            self._set_device_angle(ch, angle)
+        if drift:
+            self.metrics.record_drift(drift)
+
+    def _settle(self, record):
+        """命令结束（任何状态）时更新镜像：失败的通道回退到设备实际角度，下一次差量发送会重发"""
+        with self._cond:
+            for ch, angle in record.targets:
+                self._outstanding[ch] -= 1
+                if record.status == SENT:
+                    # 没有应答的命令（旧固件的 JS）写出即视为生效
+                    self._device_angles[ch] = angle
+                failed = record.status not in (ACKED, SENT) and self._commanded.get(ch) == angle
+                if failed or not self._outstanding[ch]:
+                    device = self._device_angles[ch]
+                    if device is None:
+                        self._commanded.pop(ch, None)
+                    else:
+                        self._commanded[ch] = device
+
+    def _maybe_reconcile(self, now):
+        if not self.reconcile_interval or now - self._last_reconcile < self.reconcile_interval:
+            return
+        with self._cond:
+            if self._queue or self._in_flight:
+                return
+            self._last_reconcile = now
+            self._status_requests += 1
+        self.send(b"STATUS\n")
+
+    def _complete(self, record, status, now):
+        """命令收到全部应答（需持有锁）"""
+        self._remove_in_flight(record)
+        record.t_ack = now
+        record.status = status
+        self.metrics.record_ack(record)
+        record.finish(status)
+        self._update_depths()
+
+    def _expire(self, now):
+        with self._cond:
+            expired = False
+            # 每条命令按自己的超时判断：排在前面的定时命令超时包括等待执行的时间，
+            # 不能挡住后面丢失的立即命令
+            for record in list(self._in_flight):
+                if now - record.t_write > self._timeout_of(record):
+                    self._remove_in_flight(record)
+                    record.finish(TIMEOUT)
+                    self.metrics.record_timeout()
+                    expired = True
+            if expired:
+                self._update_depths()
+                self._cond.notify_all()
+
+    def _timeout_of(self, record):
+        timeout = self.ack_timeout
+        # RESET 逐个复位16个舵机，每个间隔50ms
+        if ('RESET',) in record.expected:
+            timeout += 1.0
+        if record.due is not None:
+            timeout += max(0.0, record.due - record.t_write)
+        return timeout
+
+    def _fail(self, exc):
+        if not self._running:
+            return
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self.on_error is not None:
+            self.on_error(exc)
+
+
+def open_serial_port(port, baudrate=115200, timeout=1, **virtual_options):
+    """打开串口；port 为 "virtual" 或以 "virtual:" 开头时返回本地模拟设备"""
+    if port == 'virtual' or port.startswith('virtual:'):
+        from virtual_servo import VirtualServoDevice
+        return VirtualServoDevice(baudrate=baudrate, timeout=timeout, port=port, **virtual_options)
+    import serial
+    return serial.Serial(port, baudrate, timeout=timeout)
@@ -0,0 +1,192 @@
+# filename: servo_watch.py
+# 用途：监视校准配置和表情脚本文件的变化，在后台线程中回调，实现不断开串口的热加载
+#
+# Linux 上通过 ctypes 直接使用 inotify（不需要额外的包），监视文件所在的目录，
+# 因此编辑器"写临时文件再改名"的保存方式也能检测到；其他系统（Windows）按
+# POLL_INTERVAL_S 比较文件的修改时间和大小。
+# 一次保存往往触发多个事件（截断、写入、关闭），收到事件后等待 debounce_ms
+# 没有新事件再合并成一次回调。
+#
+# 在程序中使用：
+#   watcher = FileWatcher([config_path, script_dir], on_change).start()
+#   ...
+#   watcher.stop()
+# on_change(changed_paths) 在监视线程中调用，changed_paths 为变化的文件绝对路径集合。
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import threading
+
+POLL_INTERVAL_S = 0.5
+DEFAULT_DEBOUNCE_MS = 50
+
+# inotify 事件（linux/inotify.h）
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class FileWatcher:
+    """监视文件和目录，变化后在后台线程中回调 callback(变化的文件路径集合)"""
+
+    def __init__(self, paths, callback, debounce_ms=DEFAULT_DEBOUNCE_MS, use_inotify=True):
+        """
+        Args:
+            paths: 要监视的文件或目录（目录监视其中的文件，不递归）
+            callback: 回调函数，在监视线程中调用
+            use_inotify: False 时总是按修改时间轮询
+        """
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.callback = callback
+        self.debounce_ms = debounce_ms
+        self._libc = _load_libc() if use_inotify else None
+        self._fd = None
+        self._watches = {}  # inotify 监视号 -> 目录
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def backend(self):
+        return 'inotify' if self._libc is not None else 'poll'
+
+    def start(self):
+        if self._libc is not None and not self._init_inotify():
+            self._libc = None
+        self._thread = threading.Thread(target=self._run, name="file-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2)
+        # inotify 描述符由监视线程退出时关闭：join 超时后线程可能仍在 select/os.read 中，
+        # 这里关闭的话编号可能被复用，线程会读到别的文件
+
+    def _watched(self, path):
+        """path 是否在监视范围内"""
+        return path in self.paths or os.path.dirname(path) in self.paths
+
+    def _directories(self):
+        return sorted({path if os.path.isdir(path) else os.path.dirname(path) for path in self.paths})
+
+    # ---------------- inotify ----------------
+
+    def _init_inotify(self):
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return False
+        for directory in self._directories():
+            wd = self._libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK)
+            if wd >= 0:
+                self._watches[wd] = directory
+        if not self._watches:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def _read_events(self):
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return changed
+                raise
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                directory = self._watches.get(wd)
+                if directory is not None and name:
+                    path = os.path.join(directory, os.fsdecode(name))
+                    if self._watched(path):
+                        changed.add(path)
+
+    def _run_inotify(self):
+        pending = set()
+        while not self._stop.is_set():
+            timeout = self.debounce_ms / 1000.0 if pending else POLL_INTERVAL_S
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+            if ready:
+                pending |= self._read_events()
+            elif pending:
+                changed, pending = pending, set()
+                self._notify(changed)
+
+    # ---------------- 轮询 ----------------
+
+    def _snapshot(self):
+        state = {}
+        for path in self.paths:
+            try:
+                names = [os.path.join(path, name) for name in os.listdir(path)] if os.path.isdir(path) else [path]
+            except OSError:
+                # 目录在检查后被删除或改名，按没有文件处理，恢复后再次出现
+                names = []
+            for name in names:
+                try:
+                    stat = os.stat(name)
+                except OSError:
+                    continue
+                if not os.path.isdir(name):
+                    state[name] = (stat.st_mtime_ns, stat.st_size)
+        return state
+
+    def _run_poll(self):
+        previous = self._snapshot()
+        while not self._stop.wait(POLL_INTERVAL_S):
+            current = self._snapshot()
+            changed = {path for path in set(previous) | set(current) if previous.get(path) != current.get(path)}
+            if changed:
+                # 等文件写完
+                time.sleep(self.debounce_ms / 1000.0)
+                current = self._snapshot()
+                self._notify(changed)
+            previous = current
+
+    # ---------------- 回调 ----------------
+
+    def _run(self):
+        if self._fd is not None:
+            try:
+                self._run_inotify()
+            finally:
+                fd, self._fd = self._fd, None
+                os.close(fd)
+        else:
+            self._run_poll()
+
+    def _notify(self, changed):
+        try:
+            self.callback(changed)
+        except Exception as e:
+            print(f"文件变化处理出错: {e}")
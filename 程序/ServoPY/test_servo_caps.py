@@ -0,0 +1,48 @@
+# filename: test_servo_caps.py
+# 用途：servo_caps 能力缓存校验的测试
+#
+# 运行：python -m pytest test_servo_caps.py
+
+from datetime import datetime, timedelta
+
+import servo_caps
+from virtual_servo import VirtualServoDevice
+
+
+def negotiate(cache_file, refresh=False, **options):
+    device = VirtualServoDevice(timeout=0.2, **options)
+    try:
+        return servo_caps.negotiate(device, str(cache_file), refresh)
+    finally:
+        device.close()
+
+
+def test_cache_reused_when_caps_unchanged(tmp_path):
+    cache_file = tmp_path / "caps.json"
+    assert negotiate(cache_file)['source'] == 'probe'
+    assert negotiate(cache_file)['source'] == 'cache'
+    assert negotiate(cache_file, refresh=True)['source'] == 'probe'
+
+
+def test_firmware_change_invalidates_cache(tmp_path):
+    cache_file = tmp_path / "caps.json"
+    legacy = negotiate(cache_file, serial_number="HEAD-1", caps=False)
+    assert (legacy['source'], legacy['segment']) == ('probe', False)
+    assert negotiate(cache_file, serial_number="HEAD-1", caps=False)['source'] == 'cache'
+    upgraded = negotiate(cache_file, serial_number="HEAD-1", caps=True)
+    assert (upgraded['source'], upgraded['segment']) == ('probe', True)
+
+
+def test_virtual_serial_reflects_caps():
+    assert VirtualServoDevice(caps=True).serial_number != VirtualServoDevice(caps=False).serial_number
+    assert VirtualServoDevice(port="virtual:2").serial_number != VirtualServoDevice(port="virtual:3").serial_number
+
+
+def test_expired_entry_is_invalid():
+    digest = servo_caps.caps_digest("version=1,batch=1")
+    entry = {'caps_digest': digest, 'probed_at': datetime.now().isoformat(timespec='seconds')}
+    assert servo_caps.cache_valid(entry, digest)
+    assert not servo_caps.cache_valid(entry, servo_caps.caps_digest(None))
+    later = datetime.now() + timedelta(days=servo_caps.CACHE_MAX_AGE_DAYS + 1)
+    assert not servo_caps.cache_valid(entry, digest, later)
+    assert not servo_caps.cache_valid({'batch': True}, digest)
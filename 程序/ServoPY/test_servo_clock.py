@@ -0,0 +1,108 @@
+# filename: test_servo_clock.py
+# 用途：servo_clock 对时、漂移拟合和定时执行的测试（模拟设备的时钟带漂移、接近32位回绕）
+#
+# 运行：python -m pytest test_servo_clock.py
+
+import time
+
+import pytest
+
+import servo_clock
+from servo_protocol import DEVICE_CLOCK_WRAP
+from servo_transport import ServoTransport
+from virtual_servo import VirtualServoDevice
+
+DRIFT_PPM = 20000.0
+# 定时命令实际执行时刻与计划时刻的允许误差（秒）
+DEADLINE_TOLERANCE_S = 0.005
+
+
+@pytest.fixture
+def open_clock(monkeypatch):
+    """打开带时钟漂移的模拟设备，返回 (设备, ClockSync)"""
+    # 测试中的对时只跨越一两秒
+    monkeypatch.setattr(servo_clock, 'DRIFT_MIN_SPAN_S', 0.5)
+    opened = []
+
+    def open_clock(clock_start_ms, clock_drift_ppm=DRIFT_PPM):
+        device = VirtualServoDevice(debug=False, clock_start_ms=clock_start_ms, clock_drift_ppm=clock_drift_ppm)
+        transport = ServoTransport(device).start()
+        opened.append((device, transport))
+        return device, servo_clock.ClockSync(transport)
+
+    yield open_clock
+    for device, transport in opened:
+        transport.close()
+        device.close()
+
+
+def record_executions(device):
+    """记录设备开始执行舵机命令的主机时刻 [(命令, perf_counter)]
+
+    定时命令到期时从 _execute_command 开始执行；之后固件的 DEBUG 输出按波特率占用十几毫秒，
+    不计入定时误差。
+    """
+    executed = []
+    execute = device._execute_command
+
+    def recording(command):
+        if command.startswith("S"):
+            executed.append((command, time.perf_counter()))
+        execute(command)
+
+    device._execute_command = recording
+    return executed
+
+
+def sync_over(clock, span_s, count=4):
+    for i in range(count):
+        if i:
+            time.sleep(span_s / (count - 1))
+        assert clock.sync()
+
+
+def wait_for(executed, deadline, timeout=2.0):
+    end = time.perf_counter() + timeout
+    while not executed and time.perf_counter() < end:
+        time.sleep(0.005)
+    assert executed, "定时命令没有执行"
+    return executed[0][1] - deadline
+
+
+def test_offset_and_drift_fit_across_wraparound(open_clock):
+    # 设备时钟在对时期间回绕
+    device, clock = open_clock(DEVICE_CLOCK_WRAP - 800)
+    sync_over(clock, 1.2)
+    assert device.millis() < DEVICE_CLOCK_WRAP // 2
+    assert abs(clock.drift_ppm - DRIFT_PPM) < 3000
+    now = time.perf_counter()
+    error = servo_clock._signed(clock.device_ms(now) - device.millis())
+    assert abs(error) <= clock.uncertainty_ms + 2
+
+
+def test_scheduled_command_runs_at_deadline(open_clock):
+    device, clock = open_clock(DEVICE_CLOCK_WRAP - 60000)
+    sync_over(clock, 0.6)
+    executed = record_executions(device)
+    # 没有漂移补偿时 0.3 秒后已偏差 6ms
+    deadline = time.perf_counter() + 0.3
+    clock.send_frame_at({5: 120}, deadline)
+    late = wait_for(executed, deadline)
+    assert executed[0][0] == "S5,120"
+    assert abs(late) < DEADLINE_TOLERANCE_S
+    assert device.scheduled_executed == 1
+
+
+def test_schedule_across_wraparound(open_clock):
+    # 对时在回绕之前，执行时刻在回绕之后
+    device, clock = open_clock(DEVICE_CLOCK_WRAP - 300, clock_drift_ppm=1000.0)
+    assert clock.sync()
+    executed = record_executions(device)
+    deadline = time.perf_counter() + 0.5
+    at = clock.device_ms(deadline)
+    assert at < clock.device_ms()
+    clock.send_frame_at({5: 60}, deadline)
+    late = wait_for(executed, deadline)
+    assert abs(late) < DEADLINE_TOLERANCE_S
+    assert device.millis() < DEVICE_CLOCK_WRAP // 2
+    assert device.scheduled_executed == 1
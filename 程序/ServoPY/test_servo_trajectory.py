@@ -0,0 +1,99 @@
+# filename: test_servo_trajectory.py
+# 用途：servo_trajectory 联动舵机组限速的测试
+#
+# 运行：python -m pytest test_servo_trajectory.py
+
+import servo_pose
+import servo_trajectory
+from servo_protocol import encode_frame
+from servo_script import compile_script
+
+NEUTRAL = {ch: 90 for ch in range(16)}
+
+
+def play(timeline, initial):
+    """逐帧应用时间轴，返回每帧之后的完整姿态"""
+    state = dict(initial)
+    states = []
+    for frame in timeline:
+        state.update(frame.targets)
+        states.append(dict(state))
+    return states
+
+
+def initial_pose(config):
+    pose = dict(NEUTRAL)
+    for lead in (2, 4, 6, 8, 12, 13):
+        pose.update(servo_pose.group_pose(config, lead, int(servo_pose.calibration(config, lead)[1])))
+    return pose
+
+
+def test_jaw_stays_in_lockstep_with_unequal_limits():
+    # 舵机1比舵机0慢：独立限速时两通道之和会偏离180，不能再用 JS 发送
+    config = {'servo_1_max_vel': 100.0, 'servo_1_max_acc': 500.0}
+    timeline = compile_script("舵机0 40\n延时 200\n舵机0 150\n延时 200\n", config, initial=NEUTRAL)
+    limited = servo_trajectory.limit_timeline(timeline, config, initial=NEUTRAL)
+    states = play(limited, NEUTRAL)
+    assert states[-1][0] == 150
+    assert all(state[0] + state[1] == 180 for state in states)
+    assert all(b"JS" in encode_frame(frame.targets) for frame in limited if 0 in dict(frame.targets))
+
+
+def test_follower_speed_respected():
+    config = {'servo_1_max_vel': 100.0, 'servo_1_max_acc': 500.0}
+    timeline = compile_script("舵机0 150\n延时 100\n", config, initial=NEUTRAL)
+    limited = servo_trajectory.limit_timeline(timeline, config, initial=NEUTRAL)
+    states = play(limited, NEUTRAL)
+    steps = [abs(b[1] - a[1]) for a, b in zip(states, states[1:])]
+    # 每20ms最多转 100°/s × 0.02s = 2°（取整误差1°）
+    assert max(steps) <= 3
+
+
+def test_mirrored_pairs_stay_symmetric():
+    config = {}
+    initial = initial_pose(config)
+    text = "舵机2 60\n舵机12 70\n舵机14 100\n延时 300\n舵机2 95\n舵机13 40\n延时 300\n"
+    limited = servo_trajectory.limit_timeline(compile_script(text, config, initial=initial), config,
+                                              initial=initial)
+    for state in play(limited, initial):
+        assert servo_trajectory.follow_angle(config, 2, 3, state[2]) == state[3]
+        assert servo_trajectory.follow_angle(config, 14, 12, state[14]) == state[12]
+        assert servo_trajectory.follow_angle(config, 13, 15, state[13]) == state[15]
+
+
+def test_independent_targets_are_not_coupled():
+    # 两个通道分别设置、不满足联动关系时各自限速
+    limiter = servo_trajectory.MotionLimiter({})
+    limiter.reset(NEUTRAL)
+    limiter.set_targets({2: 60, 3: 60})
+    while limiter.moving:
+        limiter.step()
+    assert (limiter.targets[2], limiter.targets[3]) == (60, 60)
+    assert (limiter.positions[2], limiter.positions[3]) == (60.0, 60.0)
+
+
+def test_segments_one_command_per_group_with_own_duration():
+    # 同一帧中下颚大幅转动、眼睑小幅转动：各组一条 M 命令，眼睑不被拉长到下颚的时长
+    config = {}
+    initial = initial_pose(config)
+    eyelid = initial[4] + 10
+    timeline = compile_script(f"舵机0 150\n舵机4 {eyelid}\n延时 500\n", config, initial=initial)
+    segments = servo_trajectory.segment_timeline(timeline, config, initial=initial)
+    by_group = {servo_pose.group_of(segment.targets[0][0]): segment for segment in segments}
+    assert len(segments) == len(by_group) == 2
+    jaw, lid = by_group[(0, 1)], by_group[(4, 5)]
+    assert dict(jaw.targets) == {0: 150, 1: 30}
+    assert lid.duration_ms < jaw.duration_ms
+    limiter = servo_trajectory.MotionLimiter(config)
+    expected = servo_trajectory.segment_duration(150 - initial[0], *limiter._channel_limits(0, 1))
+    assert jaw.duration_ms >= expected * 1000.0 > jaw.duration_ms - 20
+
+
+def test_segments_built_from_keyframes():
+    # 每次转动一条命令，而不是限速轨迹的逐周期采样
+    config = {}
+    script = "舵机0 40\n延时 300\n舵机0 150\n延时 300\n舵机0 90\n延时 300\n"
+    segments = servo_trajectory.segment_timeline(compile_script(script, config, initial=NEUTRAL),
+                                                 config, initial=NEUTRAL)
+    assert [dict(segment.targets)[0] for segment in segments] == [40, 150, 90]
+    assert all(frame.startswith(b"M") for _, frame in segments.encoded_frames())
@@ -0,0 +1,155 @@
+# filename: test_servo_transport.py
+# 用途：servo_transport 发送窗口和应答匹配的测试
+#
+# 运行：python -m pytest test_servo_transport.py
+
+import queue
+import time
+
+import pytest
+
+from servo_protocol import format_scheduled
+from servo_transport import ACKED, DROPPED, ERROR, QUEUED, TIMEOUT, WRITTEN, ServoTransport
+from virtual_servo import VirtualServoDevice
+
+
+class ScriptedPort:
+    """由测试逐行给出应答的串口，用于控制应答顺序"""
+
+    def __init__(self):
+        self.written = []
+        self.lines = queue.Queue()
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+    def readline(self):
+        try:
+            return self.lines.get(timeout=0.02)
+        except queue.Empty:
+            return b""
+
+    def reply(self, text):
+        self.lines.put(text.encode() + b"\r\n")
+
+
+def wait_written(port, count, timeout=1.0):
+    deadline = time.monotonic() + timeout
+    while len(port.written) < count and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return len(port.written)
+
+
+def burst(transport, count):
+    """连续发送 count 条各不相同的舵机命令"""
+    return [transport.send(f"S{i % 16},{40 + i}\n") for i in range(count)]
+
+
+def test_window_prevents_rx_overflow():
+    device = VirtualServoDevice(rx_buffer_size=64)
+    transport = ServoTransport(device, window=4, max_bytes_in_flight=48).start()
+    try:
+        records = burst(transport, 40)
+        assert transport.wait_idle(timeout=10)
+    finally:
+        transport.close()
+        device.close()
+    assert device.bytes_dropped == 0
+    assert [r.status for r in records] == [ACKED] * len(records)
+
+
+def test_unlimited_window_overflows_small_buffer():
+    device = VirtualServoDevice(rx_buffer_size=64)
+    transport = ServoTransport(device, ack_timeout=0.5, window=None, max_bytes_in_flight=None).start()
+    try:
+        records = burst(transport, 40)
+        assert transport.wait_idle(timeout=10)
+    finally:
+        transport.close()
+        device.close()
+    assert device.bytes_dropped > 0
+    assert any(r.status in (DROPPED, TIMEOUT) for r in records)
+
+
+def test_in_order_ok_and_error_attribution():
+    device = VirtualServoDevice()
+    transport = ServoTransport(device).start()
+    try:
+        records = [transport.send(payload) for payload in ("S2,74\n", "S99,10\n", "S3,100\n")]
+        assert transport.wait_idle(timeout=5)
+    finally:
+        transport.close()
+        device.close()
+    assert [r.status for r in records] == [ACKED, ERROR, ACKED]
+    assert records[1].replies[0].startswith("ERROR:Invalid range")
+
+
+def test_reply_skips_lost_command():
+    port = ScriptedPort()
+    transport = ServoTransport(port).start()
+    try:
+        first, second, third = (transport.send(p) for p in ("S2,74\n", "S3,80\n", "S4,90\n"))
+        assert wait_written(port, 3) == 3
+        # 第一条在设备端丢失：第二条的 OK 说明它已不会再有应答
+        port.reply("OK:S3,80")
+        port.reply("ERROR:Invalid range - channel=4, angle=90")
+        assert transport.wait_idle(timeout=2)
+    finally:
+        transport.close()
+    assert (first.status, second.status, third.status) == (DROPPED, ACKED, ERROR)
+
+
+def test_identical_tokens_not_misattributed():
+    port = ScriptedPort()
+    transport = ServoTransport(port, ack_timeout=0.2).start()
+    try:
+        first = transport.send("S2,74\n")
+        second = transport.send("S2,74\n")
+        assert first.wait(0.5) is False
+        # 第一条没有应答：第二条等它超时后才写出，应答只可能属于第二条
+        assert first.status == TIMEOUT
+        assert wait_written(port, 2) == 2
+        port.reply("OK:S2,74")
+        assert second.wait(1)
+    finally:
+        transport.close()
+    assert second.status == ACKED
+    assert second.t_write >= first.t_write + 0.2
+
+
+@pytest.mark.parametrize("payloads", [("S2,74\n", "S2,74\n"), ("S2,74;3,80\n", "S2,74\n")])
+def test_identical_token_held_until_reply(payloads):
+    port = ScriptedPort()
+    transport = ServoTransport(port).start()
+    try:
+        first, second = (transport.send(p) for p in payloads)
+        wait_written(port, 1)
+        time.sleep(0.05)
+        assert port.written == [payloads[0].encode()]
+        for token in ("OK:S2,74", "OK:S3,80")[:len(first.expected)]:
+            port.reply(token)
+        assert first.wait(1)
+        # 第二条写出之前到达的应答会被当作迟到的应答
+        assert wait_written(port, 2) == 2
+        port.reply("OK:S2,74")
+        assert second.wait(1)
+    finally:
+        transport.close()
+    assert port.written == [p.encode() for p in payloads]
+
+
+def test_lost_command_behind_scheduled_times_out():
+    # 排在前面的定时命令要等到执行时刻才超时，后面丢失的立即命令按自己的超时判断
+    port = ScriptedPort()
+    transport = ServoTransport(port, window=4, ack_timeout=0.2).start()
+    try:
+        scheduled = transport.send(format_scheduled(b"S5,120\n", 123456), due=time.perf_counter() + 5.0)
+        lost = transport.send("S2,74\n")
+        deadline = time.monotonic() + 1.0
+        while lost.status in (QUEUED, WRITTEN) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert lost.status == TIMEOUT
+        assert scheduled.status == WRITTEN
+    finally:
+        transport.close()
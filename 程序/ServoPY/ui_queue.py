@@ -0,0 +1,76 @@
+# filename: ui_queue.py
+# 用途：后台线程（脚本播放、回放、传输层回调）向 Tk 主线程投递界面更新
+#
+# Tk 控件只能在主线程中操作。后台线程把更新放进队列后立即返回，不等待界面绘制，
+# 主循环按显示刷新频率（默认约60Hz）取出并执行：
+#   set(key, func, *args)  状态类更新（当前高亮行、滑条角度），同一 key 只保留最新一次
+#   post(func, *args)      事件类更新（日志），全部执行；积压超过 max_events 时丢弃最早的
+# 两类更新在同一个序列中按投递顺序执行，被合并的状态排在它最后一次 set 的位置，
+# 例如先 set 高亮行再 post 日志，日志出现时高亮行已经更新。
+
+import itertools
+import threading
+from collections import OrderedDict
+
+
+class UiUpdateQueue:
+    """合并式界面更新队列"""
+
+    def __init__(self, root, interval_ms=16, max_events=500):
+        self.root = root
+        self.interval_ms = interval_ms
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()  # ('set', key) / ('post', 序号) -> (func, args)，按投递顺序
+        self._event_count = 0
+        self._seq = itertools.count()
+        self._after_id = None
+        self.dropped = 0
+        self.coalesced = 0
+
+    def set(self, key, func, *args):
+        with self._lock:
+            if self._pending.pop(('set', key), None) is not None:
+                self.coalesced += 1
+            self._pending[('set', key)] = (func, args)
+
+    def post(self, func, *args):
+        with self._lock:
+            if self._event_count >= self.max_events:
+                oldest = next(k for k in self._pending if k[0] == 'post')
+                del self._pending[oldest]
+                self._event_count -= 1
+                self.dropped += 1
+            self._pending[('post', next(self._seq))] = (func, args)
+            self._event_count += 1
+
+    def start(self):
+        if self._after_id is None:
+            self._tick()
+        return self
+
+    def stop(self):
+        if self._after_id is not None:
+            try:
+                self.root.after_cancel(self._after_id)
+            except Exception:
+                pass
+            self._after_id = None
+
+    def _tick(self):
+        self.drain()
+        self._after_id = self.root.after(self.interval_ms, self._tick)
+
+    def drain(self):
+        """在主线程中按投递顺序执行积压的更新（状态取最新值，位于最后一次 set 的位置）"""
+        with self._lock:
+            if not self._pending:
+                return
+            updates = list(self._pending.values())
+            self._pending.clear()
+            self._event_count = 0
+        for func, args in updates:
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"界面更新出错: {e}")
@@ -0,0 +1,451 @@
+# filename: virtual_servo.py
+# 用途：模拟 ESP32 舵机固件（Servo.ino）的本地串口设备
+#
+# 接口与 pyserial 的 Serial 对象兼容（write / read / readline / in_waiting / close），
+# 可以直接替代 self.serial_port 使用，用于基准测试、离线调试和流控验证。
+# 模拟内容：
+#   - 按波特率计算的线路传输时间（每字节10位）
+#   - 固件有限大小的串口接收缓冲区，溢出的字节被丢弃（与真实硬件一样静默丢失）
+#   - loop() 每次处理一行命令，处理期间输出的 DEBUG 信息同样占用线路时间
+#   - 与固件一致的命令应答（OK: / ERROR: / STATUS: / RESET: / DEBUG:）
+#   - M 分段插值命令：与固件一样每个PWM周期（20ms）按缓动曲线更新一次角度，
+#     current_angles() 返回各通道此刻的实际角度
+#   - 设备时钟 millis()（可设置起始值和相对主机的漂移）、T 对时命令和 @ 定时执行队列
+
+import heapq
+import threading
+import time
+from collections import deque
+
+from servo_protocol import (DEVICE_CLOCK_WRAP, MAX_SEGMENT_MS, SCHEDULE_SIZE, SEGMENT_TICK_MS, SERVO_COUNT,
+                            ease, split_scheduled)
+
+# ESP32 Arduino 核心默认的串口接收缓冲区大小
+DEFAULT_RX_BUFFER_SIZE = 256
+
+
+class VirtualServoDevice:
+    """本地模拟舵机控制器"""
+
+    def __init__(self, baudrate=115200, rx_buffer_size=DEFAULT_RX_BUFFER_SIZE, debug=True,
+                 simulate_wire=True, command_time=0.0005, reset_step_delay=0.05,
+                 timeout=1, port="virtual", serial_number=None, caps=True,
+                 clock_start_ms=0, clock_drift_ppm=0.0):
+        """
+        Args:
+            baudrate: 波特率，simulate_wire=True 时用于计算传输时间
+            rx_buffer_size: 设备接收缓冲区大小（字节），None 表示不限
+            debug: 固件 debugMode 初始状态
+            simulate_wire: 是否模拟线路传输时间
+            command_time: 每个舵机命令的处理时间（I2C写PCA9685等），秒
+            reset_step_delay: RESET 命令中每个舵机之间的延时（固件为50ms）
+            serial_number: USB序列号（能力缓存的键），None 时按 port 和 caps 生成，
+                模拟新旧固件的设备不会共用缓存
+            caps: 是否支持 CAPS 命令和 OK:JS 应答，False 时模拟旧版固件
+            clock_start_ms: 设备 millis() 的起始值（测试32位回绕时设置为接近 2**32）
+            clock_drift_ppm: 设备时钟相对主机的快慢（百万分之一），模拟晶振误差
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        if serial_number is None:
+            serial_number = f"VIRTUAL-{'CAPS' if caps else 'LEGACY'}-{port.partition(':')[2] or '0001'}"
+        self.serial_number = serial_number
+        self.rx_buffer_size = rx_buffer_size
+        self.debug_mode = debug
+        self.simulate_wire = simulate_wire and bool(baudrate)
+        self.command_time = command_time
+        self.reset_step_delay = reset_step_delay
+        self.caps = caps
+        self.byte_time = 10.0 / baudrate if self.simulate_wire else 0.0
+
+        # 设备状态：angles 为目标角度（STATUS 应答的内容），插值中的通道实际角度见 current_angles()
+        self.angles = [90] * SERVO_COUNT
+        self._segments = {}  # 通道 -> (开始时刻, 时长（秒）, 缓动曲线, 起始角度, 目标角度)
+
+        # 设备时钟和定时命令队列 [(主机时刻, 序号, 命令)]
+        self._boot = time.monotonic()
+        self.clock_start_ms = clock_start_ms
+        self.clock_rate = 1.0 + clock_drift_ppm * 1e-6
+        self._schedule = []
+        self._schedule_seq = 0
+        self._received_at = self._boot
+        self.scheduled_executed = 0
+
+        # 统计信息
+        self.bytes_received = 0
+        self.bytes_dropped = 0
+        self.lines_processed = 0
+        self.servo_commands = 0
+
+        self._cond = threading.Condition()
+        self._in_flight = deque()      # 主机已写出、尚未到达设备的数据 [开始时间, bytes]
+        self._wire_free_at = 0.0       # 主机->设备方向线路空闲时刻
+        self._rx = bytearray()         # 设备接收缓冲区
+        self._tx = bytearray()         # 主机接收缓冲区（设备输出）
+        self.is_open = True
+
+        self._thread = threading.Thread(target=self._device_loop, daemon=True)
+        self._thread.start()
+
+    # ---------------- pyserial 兼容接口 ----------------
+
+    def write(self, data):
+        if not self.is_open:
+            raise IOError("虚拟串口已关闭")
+        data = bytes(data)
+        with self._cond:
+            now = time.monotonic()
+            start = max(now, self._wire_free_at)
+            self._wire_free_at = start + len(data) * self.byte_time
+            self._in_flight.append([start, data])
+            self._cond.notify_all()
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            return len(self._tx)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while len(self._tx) < size and self.is_open:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            data = bytes(self._tx[:size])
+            del self._tx[:size]
+            return data
+
+    def readline(self):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while b"\n" not in self._tx and self.is_open:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            idx = self._tx.find(b"\n")
+            end = len(self._tx) if idx < 0 else idx + 1
+            data = bytes(self._tx[:end])
+            del self._tx[:end]
+            return data
+
+    def reset_input_buffer(self):
+        with self._cond:
+            self._tx.clear()
+
+    def flush(self):
+        # 等待主机写出的数据全部到达设备
+        with self._cond:
+            while self._in_flight and self.is_open:
+                self._pump(time.monotonic())
+                if self._in_flight:
+                    self._cond.wait(max(0.0, self._wire_free_at - time.monotonic()))
+
+    def close(self):
+        with self._cond:
+            self.is_open = False
+            self._cond.notify_all()
+
+    def current_angles(self, now=None):
+        """各通道此刻的实际角度（插值按 SEGMENT_TICK_MS 周期更新）"""
+        now = time.monotonic() if now is None else now
+        with self._cond:
+            angles = list(self.angles)
+            for ch, segment in list(self._segments.items()):
+                angle, done = self._segment_angle(segment, now)
+                angles[ch] = angle
+                if done:
+                    del self._segments[ch]
+            return angles
+
+    def millis(self, now=None):
+        """设备时钟（32位回绕的毫秒数）"""
+        now = time.monotonic() if now is None else now
+        return int(self.clock_start_ms + (now - self._boot) * 1000.0 * self.clock_rate) % DEVICE_CLOCK_WRAP
+
+    # ---------------- 设备内部 ----------------
+
+    @staticmethod
+    def _segment_angle(segment, now):
+        """(当前角度, 是否已完成)"""
+        start, duration, easing, origin, target = segment
+        tick = SEGMENT_TICK_MS / 1000.0
+        elapsed = (now - start) // tick * tick
+        if elapsed >= duration:
+            return target, True
+        return origin + int(round((target - origin) * ease(easing, elapsed / duration))), False
+
+    def _pump(self, now):
+        """把已经传输完成的字节移入设备接收缓冲区，缓冲区满时丢弃（需持有锁）"""
+        while self._in_flight:
+            start, data = self._in_flight[0]
+            if self.byte_time:
+                arrived = min(len(data), int((now - start) / self.byte_time))
+            else:
+                arrived = len(data)
+            if arrived <= 0:
+                break
+            chunk = data[:arrived]
+            self.bytes_received += len(chunk)
+            if self.rx_buffer_size is None:
+                self._rx += chunk
+            else:
+                space = max(0, self.rx_buffer_size - len(self._rx))
+                self._rx += chunk[:space]
+                self.bytes_dropped += len(chunk) - min(space, len(chunk))
+            if arrived < len(data):
+                self._in_flight[0] = [start + arrived * self.byte_time, data[arrived:]]
+                break
+            self._in_flight.popleft()
+
+    def _next_arrival(self):
+        """队首数据全部到达设备的时刻（需持有锁）"""
+        if not self._in_flight:
+            return None
+        start, data = self._in_flight[0]
+        return start + len(data) * self.byte_time
+
+    def _device_loop(self):
+        """对应固件 loop()：每次从接收缓冲区取出一行并处理"""
+        while True:
+            with self._cond:
+                while True:
+                    if not self.is_open:
+                        return
+                    now = time.monotonic()
+                    # 与固件 loop() 一样先执行到期的定时命令
+                    if self._schedule and self._schedule[0][0] <= now:
+                        raw = None
+                        _, _, scheduled = heapq.heappop(self._schedule)
+                        break
+                    self._pump(now)
+                    idx = self._rx.find(b"\n")
+                    if idx >= 0:
+                        raw = bytes(self._rx[:idx])
+                        del self._rx[:idx + 1]
+                        self._received_at = now
+                        break
+                    wakeups = [self._schedule[0][0]] if self._schedule else []
+                    next_arrival = self._next_arrival()
+                    if next_arrival is not None:
+                        wakeups.append(next_arrival)
+                    wait = max(0.0, min(wakeups) - now) if wakeups else None
+                    self._cond.wait(wait)
+            if raw is None:
+                self.scheduled_executed += 1
+                self._execute_command(scheduled)
+                continue
+            command = raw.decode('utf-8', errors='replace').strip()
+            if command:
+                self.lines_processed += 1
+                self._handle_command(command)
+
+    def _emit(self, text):
+        """设备输出一行，按波特率占用线路时间（固件 Serial.println 在发送缓冲区满时阻塞）"""
+        data = (text + "\r\n").encode('utf-8')
+        if self.byte_time:
+            time.sleep(len(data) * self.byte_time)
+        with self._cond:
+            self._tx += data
+            self._cond.notify_all()
+
+    def _debug(self, text):
+        if self.debug_mode:
+            self._emit("DEBUG:" + text)
+
+    def _handle_command(self, command):
+        self._debug(f"Received '{command}'")
+        self._execute_command(command)
+
+    def _execute_command(self, command):
+        """对应固件 executeCommand：定时命令到期时也从这里执行"""
+        if command == "STATUS" and self.caps:
+            # 旧版固件先判断 S 前缀，STATUS 会被当作舵机命令而应答 ERROR
+            items = ",".join(f"S{i}={a}" for i, a in enumerate(self.angles))
+            self._emit("STATUS:" + items)
+        elif command.startswith("S"):
+            if ";" in command:
+                self._debug(f"Received batch command '{{{command}'")
+                for part in command[1:].split(";"):
+                    if part:
+                        self._execute_servo("S" + part)
+            else:
+                self._execute_servo(command)
+        elif command.startswith("M") and self.caps:
+            self._execute_segment(command)
+        elif command.startswith("T") and self.caps:
+            # 收到该行和发出应答时的设备时刻（NTP 的 T2/T3）
+            self._emit(f"TIME:{command[1:].strip()},{self.millis(self._received_at)},{self.millis()}")
+        elif command.startswith("@") and self.caps:
+            self._schedule_command(command)
+        elif command == "DEBUG":
+            self.debug_mode = not self.debug_mode
+            self._emit("DEBUG:Debug mode " + ("ON" if self.debug_mode else "OFF"))
+        elif command == "HELP":
+            for line in HELP_LINES:
+                if self.caps or not line.startswith(("CAPS", "M<", "T<", "@<")):
+                    self._emit(line)
+        elif command == "RESET":
+            self._emit("RESET:Resetting all servos to 90 degrees")
+            for i in range(SERVO_COUNT):
+                self._set_servo(i, 90)
+                if self.reset_step_delay:
+                    time.sleep(self.reset_step_delay)
+            self._emit("RESET:All servos reset complete")
+        elif command == "CAPS" and self.caps:
+            self._emit("CAPS:version=1,batch=1,js=1,js_ack=1,binary=0,status=1,segment=1,schedule=1,"
+                       "debug=%d,baud=115200"
+                       % (1 if self.debug_mode else 0))
+        elif command.startswith("JS"):
+            try:
+                angle = int(command[2:].strip() or "0")
+            except ValueError:
+                angle = 0
+            self._debug(f"Sync setting jaw servos to {angle} degrees")
+            if angle < 0 or angle > 180:
+                self._emit("ERROR:Invalid jaw angle")
+                return
+            with self._cond:
+                self._segments.pop(0, None)
+                self._segments.pop(1, None)
+                self.angles[0] = angle
+                self.angles[1] = 180 - angle
+            self._debug(f"Servo 0 pulse={_pulse(angle)}, Servo 1 pulse={_pulse(180 - angle)}")
+            self.servo_commands += 1
+            if self.command_time:
+                time.sleep(self.command_time)
+            self._debug("Jaw servos synced successfully")
+            if self.caps:
+                self._emit(f"OK:JS{angle}")
+        else:
+            self._emit("ERROR:Unknown command: " + command)
+
+    def _execute_servo(self, command):
+        """对应固件 parseAndExecuteCommand（其中的 DEBUG 输出不受 debugMode 控制）"""
+        self._emit(f"DEBUG:Parsing command: '{command}'")
+        comma = command.find(",")
+        if not (0 < comma < len(command) - 1):
+            self._emit("ERROR:Invalid format - missing comma or incomplete command")
+            return
+        channel_str = command[1:comma].strip() or "0"
+        angle_str = command[comma + 1:].strip()
+        self._emit(f"DEBUG:Extracted - channel='{channel_str}', angle='{angle_str}'")
+        if not channel_str.isdigit():
+            self._emit("ERROR:Invalid channel format")
+            return
+        if not angle_str.isdigit():
+            self._emit("ERROR:Invalid angle format")
+            return
+        channel = int(channel_str)
+        angle = int(angle_str)
+        self._emit(f"DEBUG:Converted - channel={channel}, angle={angle}")
+        if 0 <= channel < SERVO_COUNT and 0 <= angle <= 180:
+            self._emit(f"DEBUG:Calling setServoAngle(channel={channel}, angle={angle}")
+            self._set_servo(channel, angle)
+            self._emit(f"OK:S{channel},{angle}")
+        else:
+            self._emit(f"ERROR:Invalid range - channel={channel}, angle={angle}")
+
+    def _execute_segment(self, command):
+        """对应固件 parseAndExecuteSegmentCommand：M<ms>,<easing>:<ch>,<angle>;..."""
+        header, sep, body = command[1:].partition(":")
+        duration_str, _, easing_str = header.partition(",")
+        duration_str = duration_str.strip()
+        easing_str = easing_str.strip() or "1"
+        if not sep or not duration_str.isdigit() or not easing_str.isdigit():
+            self._emit("ERROR:Invalid segment format")
+            return
+        duration = int(duration_str)
+        easing = int(easing_str)
+        if duration > MAX_SEGMENT_MS or easing > 3:
+            self._emit("ERROR:Invalid segment header")
+            return
+        self._debug(f"Segment {duration}ms easing={easing}")
+        for part in body.split(";"):
+            if not part:
+                continue
+            channel_str, _, angle_str = part.partition(",")
+            channel_str = channel_str.strip()
+            angle_str = angle_str.strip()
+            if not channel_str.isdigit() or not angle_str.isdigit():
+                self._emit("ERROR:Invalid segment target")
+                continue
+            channel = int(channel_str)
+            angle = int(angle_str)
+            if not (0 <= channel < SERVO_COUNT and 0 <= angle <= 180):
+                self._emit(f"ERROR:Invalid range - channel={channel}, angle={angle}")
+                continue
+            if duration == 0:
+                self._set_servo(channel, angle)
+            else:
+                now = time.monotonic()
+                with self._cond:
+                    origin = self.current_angles(now)[channel]
+                    self._segments[channel] = (now, duration / 1000.0, easing, origin, angle)
+                    self.angles[channel] = angle
+                self.servo_commands += 1
+                if self.command_time:
+                    time.sleep(self.command_time)
+            self._emit(f"OK:M{channel},{angle}")
+
+    def _schedule_command(self, command):
+        """对应固件 scheduleCommand：@<device_ms>:<命令>"""
+        at, inner = split_scheduled(command)
+        if at is None or not inner or inner.startswith("@"):
+            self._emit(f"ERROR:{command.partition(':')[0]} Invalid schedule")
+            return
+        now = time.monotonic()
+        # 按32位有符号差值判断先后（与固件 (long)(at - millis()) 相同）
+        delta_ms = (at - self.millis(now) + DEVICE_CLOCK_WRAP // 2) % DEVICE_CLOCK_WRAP - DEVICE_CLOCK_WRAP // 2
+        if delta_ms <= 0:
+            self._debug(f"Late schedule {-delta_ms}ms")
+            self.scheduled_executed += 1
+            self._execute_command(inner)
+            return
+        with self._cond:
+            if len(self._schedule) >= SCHEDULE_SIZE:
+                full = True
+            else:
+                full = False
+                self._schedule_seq += 1
+                due = now + delta_ms / 1000.0 / self.clock_rate
+                heapq.heappush(self._schedule, (due, self._schedule_seq, inner))
+                self._cond.notify_all()
+        if full:
+            self._emit(f"ERROR:@{at} Schedule queue full")
+        else:
+            self._debug(f"Scheduled at {at} in {delta_ms}ms")
+
+    def _set_servo(self, channel, angle):
+        with self._cond:
+            self._segments.pop(channel, None)
+            self.angles[channel] = angle
+        self.servo_commands += 1
+        if self.command_time:
+            time.sleep(self.command_time)
+        self._debug(f"Setting servo {channel} to {angle} degrees, pulse={_pulse(angle)}")
+
+
+def _pulse(angle):
+    """固件 map(angle, 0, 180, MIN, MAX)，MG996R与MG90S当前使用相同的脉冲范围"""
+    return 100 + (angle * (650 - 100)) // 180
+
+
+HELP_LINES = [
+    "=== ESP32-S3 Servo Controller Commands ===",
+    "S<ch>,<angle> - Set servo channel (0-15) to angle (0-180)",
+    "JS<angle> - Synchronously control jaw servos 0 and 1 (reverse motion)",
+    "M<ms>,<easing>:<ch>,<angle>;... - Move servos over ms with easing (0=linear,1=in-out,2=in,3=out)",
+    "T<seq> - Report device clock (TIME:<seq>,<received ms>,<reply ms>)",
+    "@<ms>:<command> - Execute command when device millis() reaches ms",
+    "STATUS - Get current status of all servos",
+    "DEBUG - Toggle debug mode",
+    "RESET - Reset all servos to 90 degrees",
+    "CAPS - Report supported protocol features",
+    "HELP - Show this help message",
+    "==========================================",
+]